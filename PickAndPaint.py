@@ -1,6 +1,19 @@
 import vtk, qt, ctk, slicer
+import os
+from vtk.util import numpy_support
 import numpy
 import time
+import collections
+import logging
+from multiprocessing.pool import ThreadPool
+
+from PickAndPaintInstrumentation import instrumentation, timed, timedSlot
+from PickAndPaintCore import MAXIMUM_RADIUS_ROI, ROI_STORAGE_PER_LANDMARK, ROI_STORAGE_LABEL_MAP, ROI_STORAGE_BITMASK, \
+    ROI_DISTANCE_HOPS, ROI_DISTANCE_EUCLIDEAN, \
+    maximumRadius, polyDataToNumpy, computeLandmarkROI, MeshGeometry, writeROIMask, roiSelection, roiArrayName, \
+    meshHash, MeshTopologyCache, VertexCorrespondence, CohortPropagationEngine, \
+    LandmarkTable, DecimatedProxy, saveSession, loadSession, DISTANCE_TO_REFERENCE, vertexAreas, meshScalar, \
+    roiStatistics, StatisticsWriter, memorySize
 
 
 class PickAndPaint:
@@ -15,25 +28,144 @@ class PickAndPaint:
         """
         self.parent = parent
 
-class PickAndPaintWidget:
-    class fiducialState(object):
-        def __init__(self):
-            self.fiducialLabel = None
-            self.fiducialScale = 2.0
-            self.radiusROI = 0.0
-            self.indexClosestPoint = -1
-            self.arrayName = None
-            self.mouvementSurfaceStatus = True
-            self.propagatedBool = False
+class CoalescingScheduler(object):
+    """ Collapses bursts of requests into a single call of callback.
+
+    The first request starts a single-shot timer. Requests arriving before it
+    fires replace the pending one (latest wins) and are counted as coalesced,
+    and the callback then runs once with the arguments of the last request.
+    Requests made while the callback runs (e.g. events fired by the callback
+    itself) are dropped.
+    """
+    def __init__(self, callback, interval=30):
+        self.callback = callback
+        self.timer = qt.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.connect('timeout()', self.onTimeout)
+        self.pendingArguments = None
+        self.running = False
+        self.requestedCount = 0
+        self.coalescedCount = 0
+        self.droppedCount = 0
+        self.processedCount = 0
+
+    def setInterval(self, interval):
+        self.timer.setInterval(interval)
+
+    def schedule(self, *args):
+        self.requestedCount += 1
+        if self.running:
+            self.droppedCount += 1
+            return
+        if self.timer.isActive():
+            self.coalescedCount += 1
+        else:
+            self.timer.start()
+        self.pendingArguments = args
+
+    def cancel(self):
+        self.timer.stop()
+        self.pendingArguments = None
+
+    def onTimeout(self):
+        args = self.pendingArguments
+        self.pendingArguments = None
+        self.running = True
+        try:
+            self.callback(*args)
+        finally:
+            self.running = False
+        self.processedCount += 1
+
+    def getStatistics(self):
+        return {'requested': self.requestedCount,
+                'coalesced': self.coalescedCount,
+                'dropped': self.droppedCount,
+                'processed': self.processedCount}
+
+
+class LatestResultThreadPool(object):
+    """ Runs functions in a pool of threads and hands their results back to
+    the main thread, where onResult is called from a polling qt.QTimer.
+
+    Only the newest request is applied: requests made obsolete before a
+    thread picks them up are skipped, and results that are stale when they
+    come back are discarded. The functions must not touch VTK/MRML objects.
+    """
+    def __init__(self, numberOfThreads=2, pollInterval=15):
+        self.pool = ThreadPool(numberOfThreads)
+        self.generation = 0
+        self.results = collections.deque()  # appended by the pool threads
+        self.pendingCount = 0
+        self.pollTimer = qt.QTimer()
+        self.pollTimer.setInterval(pollInterval)
+        self.pollTimer.connect('timeout()', self.poll)
+        self.skippedCount = 0
+        self.discardedCount = 0
+        self.appliedCount = 0
+
+    def submit(self, function, args, onResult):
+        self.generation += 1
+        generation = self.generation
+
+        def run():
+            if generation != self.generation:
+                return generation, None, None, onResult
+            try:
+                return generation, function(*args), None, onResult
+            except Exception, e:
+                return generation, None, e, onResult
+
+        self.pendingCount += 1
+        self.pool.apply_async(run, callback=self.results.append)
+        if not self.pollTimer.isActive():
+            self.pollTimer.start()
+
+    def cancel(self):
+        """ Makes every request submitted so far stale. """
+        self.generation += 1
+
+    def poll(self):
+        while self.results:
+            generation, result, error, onResult = self.results.popleft()
+            self.pendingCount -= 1
+            if error is not None:
+                instrumentation.count('backgroundTaskFailures')
+                logging.error("Pick 'n Paint: background task failed: %s", error)
+            elif generation != self.generation:
+                if result is None:
+                    self.skippedCount += 1
+                else:
+                    self.discardedCount += 1
+            else:
+                onResult(result)
+                self.appliedCount += 1
+        if self.pendingCount == 0:
+            self.pollTimer.stop()
+
+    def getStatistics(self):
+        return {'pending': self.pendingCount,
+                'skipped': self.skippedCount,
+                'discarded': self.discardedCount,
+                'applied': self.appliedCount}
 
+
+class PickAndPaintWidget:
     class inputState (object):
         def __init__(self):
             self.inputModelNode = None
             self.fidNodeID = None
             self.MarkupAddedEventTag = None
+            self.MarkupRemovedEventTag = None
             self.PointModifiedEventTag = None
-            self.dictionaryLandmark = dict()  # Key = ID of markups
-            self.dictionaryLandmark.clear()
+            self.dictionaryLandmark = LandmarkTable()  # Key = ID of markups, value = LandmarkRow
+            # Indexes kept in sync with dictionaryLandmark and the fiducial node
+            self.dictionaryLabelToID = dict()  # Key = fiducialLabel, value = ID of markups
+            self.dictionaryIDToMarkupIndex = dict()  # Key = ID of markups, value = index in the fiducial node
+            # Number of the last landmark added: never reused, so the label,
+            # array name and ROI label of a removed landmark stay unique
+            self.landmarkCounter = 0
 
             # ------------------------- PROPAGATION ------------------------
             self.dictionaryPropInput = dict()  # Key = ID of Propagated Model Node
@@ -43,6 +175,46 @@ class PickAndPaintWidget:
                                       #  1: Correspondent Shapes
                                       #  2: Non Correspondent Shapes
 
+        def addLandmark(self, landmarkID, fiducialLabel, markupsIndex):
+            """ Adds a row for the landmark in the landmark table and returns it. """
+            landmarkState = self.dictionaryLandmark.addRow(landmarkID)
+            landmarkState.fiducialLabel = fiducialLabel
+            self.dictionaryLabelToID[fiducialLabel] = landmarkID
+            self.dictionaryIDToMarkupIndex[landmarkID] = markupsIndex
+            return landmarkState
+
+        def findIDFromLabel(self, fiducialLabel):
+            return self.dictionaryLabelToID.get(fiducialLabel)
+
+        def getMarkupIndex(self, fidNode, landmarkID):
+            """ Index of the markup in the fiducial node. The cached index is
+            checked against the node, so markups reordered outside of the
+            module are found again.
+            """
+            markupsIndex = self.dictionaryIDToMarkupIndex.get(landmarkID, -1)
+            if markupsIndex < 0 or markupsIndex >= fidNode.GetNumberOfMarkups() \
+                    or fidNode.GetNthMarkupID(markupsIndex) != landmarkID:
+                self.updateMarkupIndexes(fidNode)
+                markupsIndex = self.dictionaryIDToMarkupIndex.get(landmarkID, -1)
+            return markupsIndex
+
+        def updateMarkupIndexes(self, fidNode):
+            """ Rebuilds the indexes from the fiducial node and forgets the
+            landmarks that were removed from it. Returns their labels.
+            """
+            self.dictionaryIDToMarkupIndex.clear()
+            for i in range(0, fidNode.GetNumberOfMarkups()):
+                markupID = fidNode.GetNthMarkupID(i)
+                if self.dictionaryLandmark.has_key(markupID):
+                    self.dictionaryIDToMarkupIndex[markupID] = i
+            removedLabels = list()
+            for landmarkID in self.dictionaryLandmark.keys():
+                if not self.dictionaryIDToMarkupIndex.has_key(landmarkID):
+                    removedLabels.append(self.dictionaryLandmark[landmarkID].fiducialLabel)
+                    self.dictionaryLandmark.remove(landmarkID)
+            self.dictionaryLabelToID = dict((value.fiducialLabel, ID) for ID, value in self.dictionaryLandmark.iteritems())
+            return removedLabels
+
     def __init__(self, parent=None):
         self.developerMode = True
 
@@ -59,7 +231,6 @@ class PickAndPaintWidget:
             self.parent.show()
 
     def setup(self):
-        print " ----- SetUp ------"
         if self.developerMode:
             self.reloadButton = qt.QPushButton("Reload")
             self.reloadButton.toolTip = "Reload this module"
@@ -71,12 +242,25 @@ class PickAndPaintWidget:
         #                                   Global Variables
         # ------------------------------------------------------------------------------------
         self.logic = PickAndPaintLogic()
+        self.modelRegistry = ModelRegistry(self.logic)
 
         self.dictionaryInput = dict()
         self.dictionaryInput.clear()
 
         self.propInputID = -1
 
+        # Landmark drags fire PointModifiedEvent much faster than the ROIs can
+        # follow: only the latest position is processed
+        self.pointModifiedScheduler = CoalescingScheduler(self.updateActiveLandmark)
+        # ROI previews computed while the radius slider is dragged
+        self.roiPreviewPool = LatestResultThreadPool()
+        # With the decimated proxy, drags only preview the ROI: the full
+        # resolution update runs once the landmark stops moving
+        self.refineTimer = qt.QTimer()
+        self.refineTimer.setSingleShot(True)
+        self.refineTimer.setInterval(300)
+        self.refiningLandmark = False
+
         # ------ REVIEW PROPAGATED MESHES --------------
         self.propMarkupsNode = slicer.vtkMRMLMarkupsFiducialNode()
         self.propMarkupsNode.SetName('PropagationMarkupsNode')
@@ -154,13 +338,58 @@ class PickAndPaintWidget:
         self.radiusDefinitionWidget = ctk.ctkSliderWidget()
         self.radiusDefinitionWidget.singleStep = 1.0
         self.radiusDefinitionWidget.minimum = 0.0
-        self.radiusDefinitionWidget.maximum = 20.0
+        self.radiusDefinitionWidget.maximum = MAXIMUM_RADIUS_ROI
         self.radiusDefinitionWidget.value = 0.0
+        # While the slider is dragged, ROI previews are computed in the
+        # background (onRadiusValueIsChanging). The ROI is set on release.
         self.radiusDefinitionWidget.tracking = False
 
+        self.roiDistanceComboBox = qt.QComboBox()
+        self.roiDistanceComboBox.addItem("Edges")
+        self.roiDistanceComboBox.addItem("Geodesic distance (mm)")
+        self.roiDistanceComboBox.addItem("Euclidean distance (mm)")
+        self.roiDistanceComboBox.toolTip = "Edges: the ROI size depends on the mesh resolution.\n" \
+                                           "Geodesic: shortest path along the surface edges.\n" \
+                                           "Euclidean: sphere around the landmark, may cross thin parts."
+
+        self.roiStorageComboBox = qt.QComboBox()
+        self.roiStorageComboBox.addItem("One array per landmark")
+        self.roiStorageComboBox.addItem("Label map (uint16)")
+        self.roiStorageComboBox.addItem("Bitmask (overlapping ROIs)")
+        self.roiStorageComboBox.toolTip = "Label map and bitmask keep all the ROIs of a model in a single array"
+
         roiBoxLayout = qt.QFormLayout()
         roiBoxLayout.addRow("Select a Fiducial:", self.fiducialComboBoxROI)
         roiBoxLayout.addRow("Value of radius", self.radiusDefinitionWidget)
+        roiBoxLayout.addRow("Radius unit:", self.roiDistanceComboBox)
+        roiBoxLayout.addRow("ROI storage:", self.roiStorageComboBox)
+
+        self.updateIntervalSpinBox = qt.QSpinBox()
+        self.updateIntervalSpinBox.minimum = 0
+        self.updateIntervalSpinBox.maximum = 1000
+        self.updateIntervalSpinBox.singleStep = 10
+        self.updateIntervalSpinBox.suffix = " ms"
+        self.updateIntervalSpinBox.value = self.pointModifiedScheduler.timer.interval
+        self.updateIntervalSpinBox.toolTip = "Moves of a landmark within this interval are processed together"
+        roiBoxLayout.addRow("Update interval:", self.updateIntervalSpinBox)
+
+        self.incrementalUpdateCheckBox = qt.QCheckBox("Only update the vertices entering or leaving the ROI")
+        self.incrementalUpdateCheckBox.setChecked(True)
+        roiBoxLayout.addRow("Incremental:", self.incrementalUpdateCheckBox)
+
+        self.proxyCheckBox = qt.QCheckBox("Preview on a decimated mesh while dragging")
+        self.proxyCheckBox.toolTip = "The ROI follows the landmark on a coarse copy of the model and is " \
+                                     "computed at full resolution when the landmark is released"
+        self.proxySizeSpinBox = qt.QSpinBox()
+        self.proxySizeSpinBox.minimum = 1
+        self.proxySizeSpinBox.maximum = 50
+        self.proxySizeSpinBox.value = 10
+        self.proxySizeSpinBox.suffix = " %"
+        self.proxySizeSpinBox.toolTip = "Size of the decimated mesh, in percent of the vertices of the model"
+        proxyLayout = qt.QHBoxLayout()
+        proxyLayout.addWidget(self.proxyCheckBox)
+        proxyLayout.addWidget(self.proxySizeSpinBox)
+        roiBoxLayout.addRow("Drag preview:", proxyLayout)
         self.roiGroupBox.setLayout(roiBoxLayout)
 
         self.ROICollapsibleButton = ctk.ctkCollapsibleButton()
@@ -196,15 +425,140 @@ class PickAndPaintWidget:
         self.propagateButton = qt.QPushButton("Propagate")
         self.propagateButton.enabled = True
 
+        # Non correspondent propagation in worker processes
+        self.propagationProcessesSpinBox = qt.QSpinBox()
+        self.propagationProcessesSpinBox.minimum = 0
+        self.propagationProcessesSpinBox.maximum = 64
+        self.propagationProcessesSpinBox.value = 0
+        self.propagationProcessesSpinBox.specialValueText = "None"
+        self.propagationProcessesSpinBox.toolTip = "Number of processes computing the ROIs of non correspondent meshes"
+        processesLayout = qt.QFormLayout()
+        processesLayout.addRow("Worker processes:", self.propagationProcessesSpinBox)
+
+        # Non correspondent propagation through precomputed vertex maps
+        self.correspondenceMapCheckBox = qt.QCheckBox("Propagate through vertex maps")
+        self.correspondenceMapCheckBox.toolTip = "The closest vertex maps between the models are computed once, " \
+                                                 "then ROIs are mapped instead of grown on each model"
+        self.rigidAlignmentCheckBox = qt.QCheckBox("Rigid alignment (ICP)")
+        self.rigidAlignmentCheckBox.toolTip = "Align the models on the reference before computing the maps"
+        correspondenceMapLayout = qt.QHBoxLayout()
+        correspondenceMapLayout.addWidget(self.correspondenceMapCheckBox)
+        correspondenceMapLayout.addWidget(self.rigidAlignmentCheckBox)
+        processesLayout.addRow(correspondenceMapLayout)
+
+        self.propagationProgressBar = qt.QProgressBar()
+        self.propagationProgressBar.hide()
+        self.propagationCancelButton = qt.QPushButton("Cancel")
+        self.propagationCancelButton.hide()
+        self.propagationCancelled = False
+        progressLayout = qt.QHBoxLayout()
+        progressLayout.addWidget(self.propagationProgressBar)
+        progressLayout.addWidget(self.propagationCancelButton)
+
+        # Statistics of a per-vertex scalar over the ROIs of the reference and propagated models
+        self.statisticsScalarComboBox = qt.QComboBox()
+        self.statisticsScalarComboBox.toolTip = "Point data array the statistics are computed on"
+        self.exportStatisticsButton = qt.QPushButton("Export ROI statistics...")
+        self.exportStatisticsButton.toolTip = "Mean, standard deviation, percentiles and area of the scalar " \
+                                              "over each ROI of each model, in a .csv (or .parquet) file"
+        statisticsLayout = qt.QHBoxLayout()
+        statisticsLayout.addWidget(qt.QLabel("Scalar:"))
+        statisticsLayout.addWidget(self.statisticsScalarComboBox)
+        statisticsLayout.addWidget(self.exportStatisticsButton)
+
         propagationBoxLayout = qt.QVBoxLayout()
         propagationBoxLayout.addLayout(self.shapesLayout)
         propagationBoxLayout.addWidget(self.propagationInputComboBox)
+        propagationBoxLayout.addLayout(processesLayout)
         propagationBoxLayout.addWidget(self.propagateButton)
+        propagationBoxLayout.addLayout(progressLayout)
+        propagationBoxLayout.addLayout(statisticsLayout)
 
         self.propagationCollapsibleButton.setLayout(propagationBoxLayout)
         self.propagationCollapsibleButton.checked = False
         self.propagationCollapsibleButton.enabled = True
 
+        #  ----------------------------- Settings ----------------------------------
+        self.settingsCollapsibleButton = ctk.ctkCollapsibleButton()
+        self.settingsCollapsibleButton.setText(" Settings: ")
+        self.parent.layout().addWidget(self.settingsCollapsibleButton)
+
+        # On-disk cache of the mesh adjacency and edge lengths, kept between sessions
+        settings = qt.QSettings()
+        self.topologyCacheDirectory = str(settings.value('PickAndPaint/TopologyCacheDirectory',
+                                                         os.path.join(slicer.app.temporaryPath,
+                                                                      'PickAndPaintTopologyCache')))
+        self.topologyCacheCheckBox = qt.QCheckBox("Cache mesh topology on disk")
+        self.topologyCacheCheckBox.toolTip = "Adjacency and edge lengths are stored in " + self.topologyCacheDirectory
+        self.topologyCacheCheckBox.setChecked(str(settings.value('PickAndPaint/TopologyCacheEnabled', 'true')).lower() == 'true')
+        self.topologyCacheSizeSpinBox = qt.QSpinBox()
+        self.topologyCacheSizeSpinBox.minimum = 64
+        self.topologyCacheSizeSpinBox.maximum = 1024 * 1024
+        self.topologyCacheSizeSpinBox.singleStep = 256
+        self.topologyCacheSizeSpinBox.suffix = " MB"
+        self.topologyCacheSizeSpinBox.value = int(settings.value('PickAndPaint/TopologyCacheSize', 2048))
+        self.topologyCacheClearButton = qt.QPushButton("Clear")
+
+        topologyCacheLayout = qt.QHBoxLayout()
+        topologyCacheLayout.addWidget(self.topologyCacheCheckBox)
+        topologyCacheLayout.addWidget(self.topologyCacheSizeSpinBox)
+        topologyCacheLayout.addWidget(self.topologyCacheClearButton)
+
+        # Timing of the callbacks and logic stages, see PickAndPaintInstrumentation
+        self.timingCheckBox = qt.QCheckBox("Record timings")
+        self.traceCheckBox = qt.QCheckBox("Record trace")
+        self.traceCheckBox.toolTip = "Keep every timed call to save them as a Chrome trace (chrome://tracing)"
+        self.printTimingsButton = qt.QPushButton("Print timings")
+        self.saveTraceButton = qt.QPushButton("Save trace...")
+        timingLayout = qt.QHBoxLayout()
+        timingLayout.addWidget(self.timingCheckBox)
+        timingLayout.addWidget(self.traceCheckBox)
+        timingLayout.addWidget(self.printTimingsButton)
+        timingLayout.addWidget(self.saveTraceButton)
+
+        # Landmarks and ROIs of every input saved to / restored from a .npz file
+        self.saveSessionButton = qt.QPushButton("Save session...")
+        self.saveSessionButton.toolTip = "Save the landmarks and the ROIs of all the models"
+        self.loadSessionButton = qt.QPushButton("Load session...")
+        self.loadSessionButton.toolTip = "Restore saved landmarks and ROIs on the models of the scene with the same names"
+        sessionLayout = qt.QHBoxLayout()
+        sessionLayout.addWidget(self.saveSessionButton)
+        sessionLayout.addWidget(self.loadSessionButton)
+
+        # Memory held for each model, released for inactive models over the budget
+        self.memoryBudgetSpinBox = qt.QSpinBox()
+        self.memoryBudgetSpinBox.minimum = 64
+        self.memoryBudgetSpinBox.maximum = 1024 * 1024
+        self.memoryBudgetSpinBox.singleStep = 256
+        self.memoryBudgetSpinBox.suffix = " MB"
+        self.memoryBudgetSpinBox.value = int(settings.value('PickAndPaint/MemoryBudget', 1024))
+        self.memoryBudgetSpinBox.toolTip = "Over this budget, locators, adjacency, vertex maps, distance fields " \
+                                           "and ROI arrays of the inactive models are released, and rebuilt when needed"
+        self.memoryRefreshButton = qt.QPushButton("Refresh")
+        memoryBudgetLayout = qt.QHBoxLayout()
+        memoryBudgetLayout.addWidget(qt.QLabel("Memory budget:"))
+        memoryBudgetLayout.addWidget(self.memoryBudgetSpinBox)
+        memoryBudgetLayout.addWidget(self.memoryRefreshButton)
+        self.memoryTable = qt.QTableWidget()
+        self.memoryTable.setColumnCount(len(ModelRegistry.CATEGORIES) + 2)
+        self.memoryTable.setHorizontalHeaderLabels(["Model", "ROI arrays", "Locator", "Adjacency", "Vertex maps",
+                                                    "Proxy", "Distance fields", "Total"])
+        self.memoryTable.toolTip = "Memory held for each model, in MB"
+        self.memoryTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.memoryTable.verticalHeader().hide()
+
+        settingsLayout = qt.QVBoxLayout()
+        settingsLayout.addLayout(topologyCacheLayout)
+        settingsLayout.addLayout(timingLayout)
+        settingsLayout.addLayout(sessionLayout)
+        settingsLayout.addLayout(memoryBudgetLayout)
+        settingsLayout.addWidget(self.memoryTable)
+        self.settingsCollapsibleButton.setLayout(settingsLayout)
+        self.settingsCollapsibleButton.checked = False
+        self.onTopologyCacheSettingsChanged()
+        self.onMemoryBudgetChanged()
+        self.onTimingSettingsChanged()
+
         self.layout.addStretch(1)
         # ------------------------------------------------------------------------------------
         #                                   CONNECTIONS
@@ -216,23 +570,52 @@ class PickAndPaintWidget:
         self.fiducialComboBoxROI.connect('currentIndexChanged(QString)', self.onFiducialComboBoxROIChanged)
         self.radiusDefinitionWidget.connect('valueChanged(double)', self.onRadiusValueChanged)
         self.radiusDefinitionWidget.connect('valueIsChanging(double)', self.onRadiusValueIsChanging)
+        self.roiStorageComboBox.connect('currentIndexChanged(int)', self.onROIStorageModeChanged)
+        self.updateIntervalSpinBox.connect('valueChanged(int)', self.pointModifiedScheduler.setInterval)
+        self.incrementalUpdateCheckBox.connect('toggled(bool)', self.onIncrementalUpdateToggled)
+        self.refineTimer.connect('timeout()', self.refineActiveLandmark)
+        self.roiDistanceComboBox.connect('currentIndexChanged(int)', self.onROIDistanceModeChanged)
+        self.topologyCacheCheckBox.connect('toggled(bool)', self.onTopologyCacheSettingsChanged)
+        self.topologyCacheSizeSpinBox.connect('valueChanged(int)', self.onTopologyCacheSettingsChanged)
+        self.topologyCacheClearButton.connect('clicked()', self.onTopologyCacheClearButton)
+        self.timingCheckBox.connect('toggled(bool)', self.onTimingSettingsChanged)
+        self.traceCheckBox.connect('toggled(bool)', self.onTimingSettingsChanged)
+        self.printTimingsButton.connect('clicked()', self.onPrintTimingsButton)
+        self.saveTraceButton.connect('clicked()', self.onSaveTraceButton)
+        self.saveSessionButton.connect('clicked()', self.onSaveSessionButton)
+        self.loadSessionButton.connect('clicked()', self.onLoadSessionButton)
 
         self.propagationInputComboBox.connect('checkedNodesChanged()', self.onPropagationInputComboBoxCheckedNodesChanged)
         self.propagateButton.connect('clicked()', self.onPropagateButton)
+        self.propagationCancelButton.connect('clicked()', self.onPropagationCancelButton)
+        self.exportStatisticsButton.connect('clicked()', self.onExportStatisticsButton)
+        self.memoryBudgetSpinBox.connect('valueChanged(int)', self.onMemoryBudgetChanged)
+        self.memoryRefreshButton.connect('clicked()', self.updateMemoryTable)
 
+        @vtk.calldata_type(vtk.VTK_OBJECT)
+        def onNodeRemoved(caller, event, node):
+            self.onNodeRemoved(node)
+        self.nodeRemovedEventTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, onNodeRemoved)
 
         def onCloseScene(obj, event):
+            # The reloaded module observes the scene again
+            self.removeSceneObservers()
             # initialize Parameters
             globals()["PickAndPaint"] = slicer.util.reloadScriptedModule("PickAndPaint")
-        slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, onCloseScene)
+        self.closeSceneEventTag = slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, onCloseScene)
+
+    def removeSceneObservers(self):
+        """ Stops observing the scene, before the module is reloaded. """
+        slicer.mrmlScene.RemoveObserver(self.nodeRemovedEventTag)
+        slicer.mrmlScene.RemoveObserver(self.closeSceneEventTag)
 
 
+    @timed
     def UpdateInterface(self):
-        print " OnUpdateInterface "
-        if self.inputModelSelector.currentNode():
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
             activeInputID = self.inputModelSelector.currentNode().GetID()
-            selectedFidReflID = self.logic.findIDFromLabel(self.dictionaryInput[activeInputID].dictionaryLandmark,
-                                                           self.fiducialComboBoxROI.currentText)
+            selectedFidReflID = self.dictionaryInput[activeInputID].findIDFromLabel(self.fiducialComboBoxROI.currentText)
             if activeInputID != -1:
                 # Reset all Values
                 if self.dictionaryInput[activeInputID].dictionaryLandmark and selectedFidReflID:
@@ -252,8 +635,8 @@ class PickAndPaintWidget:
                                             self.fiducialComboBoxROI.currentText,
                                             "UpdateInterface")
 
+    @timedSlot
     def onCurrentNodeChanged(self):
-        print " ------------------------------------ onCurrentNodeChanged ------------------------------------"
         if self.inputModelSelector.currentNode():
             activeInputID = self.inputModelSelector.currentNode().GetID()
             if activeInputID:
@@ -263,15 +646,8 @@ class PickAndPaintWidget:
                     fidNode  = slicer.vtkMRMLMarkupsFiducialNode()
                     slicer.mrmlScene.AddNode(fidNode)
                     self.dictionaryInput[activeInputID].fidNodeID = fidNode.GetID()
-
-                    # Observers Fiducials Node:
-                    self.dictionaryInput[activeInputID].MarkupAddedEventTag = \
-                        fidNode.AddObserver(fidNode.MarkupAddedEvent, self.onMarkupAddedEvent)
-
-                    self.dictionaryInput[activeInputID].PointModifiedEventTag = \
-                        fidNode.AddObserver(fidNode.PointModifiedEvent, self.onPointModifiedEvent)
+                    self.observeFiducialNode(self.dictionaryInput[activeInputID], fidNode)
                 else:
-                    print "Key already exists"
                     slicer.modules.markups.logic().SetActiveListID(slicer.mrmlScene.GetNodeByID(self.dictionaryInput[activeInputID].fidNodeID))
 
 
@@ -287,28 +663,37 @@ class PickAndPaintWidget:
                                 self.fiducialComboBoxROI.addItem(landmarkLabel)
 
                 for node in self.propagationInputComboBox.checkedNodes():
-                    print node.GetName()
                     self.propagationInputComboBox.setCheckState(node, 0)
+                self.updateStatisticsScalars()
+                self.updateModelRegistry()
 
                 self.logic.UpdateThreeDView(self.inputModelSelector.currentNode(),
                                             self.dictionaryInput,
                                             self.fiducialComboBoxROI.currentText,
                                             'onCurrentNodeChanged')
-            else:
-                print ' Input chosen: None! '
+
+    def observeFiducialNode(self, activeInputState, fidNode):
+        # Observers Fiducials Node:
+        activeInputState.MarkupAddedEventTag = \
+            fidNode.AddObserver(fidNode.MarkupAddedEvent, self.onMarkupAddedEvent)
+
+        activeInputState.MarkupRemovedEventTag = \
+            fidNode.AddObserver(fidNode.MarkupRemovedEvent, self.onMarkupRemovedEvent)
+
+        activeInputState.PointModifiedEventTag = \
+            fidNode.AddObserver(fidNode.PointModifiedEvent, self.onPointModifiedEvent)
 
     def onAddButton(self):
         self.interactionNode.SetCurrentInteractionMode(1)
 
+    @timedSlot
     def onFiducialsScaleChanged(self):
-        print " ------------------------------------ onFiducialsScaleChanged ------------------------------------ "
-        if self.inputModelSelector.currentNode():
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
             activeInput = self.inputModelSelector.currentNode()
             fidNode = slicer.app.mrmlScene().GetNodeByID(self.dictionaryInput[activeInput.GetID()].fidNodeID)
             if activeInput:
-                for value in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.itervalues():
-                    value.fiducialScale = self.fiducialsScaleWidget.value
-                    print value.fiducialScale
+                self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.column('fiducialScale')[:] = self.fiducialsScaleWidget.value
                 if fidNode:
                     displayFiducialNode = fidNode.GetMarkupsDisplayNode()
                     disabledModify = displayFiducialNode.StartModify()
@@ -316,45 +701,67 @@ class PickAndPaintWidget:
                     displayFiducialNode.SetTextScale(self.fiducialsScaleWidget.value)
                     displayFiducialNode.EndModify(disabledModify)
                 else:
-                    print "Error with fiducialNode"
+                    logging.error("Pick 'n Paint: the fiducial node of %s was removed", activeInput.GetName())
 
+    @timedSlot
     def onSurfaceDeplacementStateChanged(self):
-        print " ------------------------------------ onSurfaceDeplacementStateChanged ------------------------------------"
-        if self.inputModelSelector.currentNode():
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
             activeInput = self.inputModelSelector.currentNode()
             fidNode = slicer.app.mrmlScene().GetNodeByID(self.dictionaryInput[activeInput.GetID()].fidNodeID)
+            # The removed markups are forgotten first, which reorders the table rows
+            self.dictionaryInput[activeInput.GetID()].updateMarkupIndexes(fidNode)
 
-            selectedFidReflID = self.logic.findIDFromLabel(self.dictionaryInput[activeInput.GetID()].dictionaryLandmark,
-                                                           self.fiducialComboBoxROI.currentText)
+            selectedFidReflID = self.dictionaryInput[activeInput.GetID()].findIDFromLabel(self.fiducialComboBoxROI.currentText)
             if selectedFidReflID:
                 if self.surfaceDeplacementCheckBox.isChecked():
                     self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].mouvementSurfaceStatus = True
-                    for key, value in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.iteritems():
-                        markupsIndex = fidNode.GetMarkupIndexByID(key)
-                        if value.mouvementSurfaceStatus:
-                           value.indexClosestPoint = self.logic.getClosestPointIndex(fidNode,
-                                                                                     slicer.util.getNode(activeInput.GetID()),
-                                                                                     markupsIndex)
-                           self.logic.replaceLandmark(slicer.util.getNode(activeInput.GetID()),
-                                                      fidNode,
-                                                      markupsIndex,
-                                                      value.indexClosestPoint)
+                    # All the landmarks moving on the surface are snapped together
+                    landmarks = self.dictionaryInput[activeInput.GetID()].dictionaryLandmark
+                    rows = numpy.nonzero(landmarks.column('flags') & LandmarkTable.FLAG_MOVE_ON_SURFACE)[0]
+                    markupsIndices = [self.dictionaryInput[activeInput.GetID()].getMarkupIndex(fidNode, landmarks.ids[row])
+                                      for row in rows]
+                    landmarks.column('indexClosestPoint')[rows] = self.logic.snapLandmarks(activeInput, fidNode, markupsIndices)
                 else:
                     self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].mouvementSurfaceStatus = False
 
+    @timedSlot
     def onFiducialComboBoxROIChanged(self):
-        print "-------- ComboBox changement --------"
         self.UpdateInterface()
 
-    def onRadiusValueIsChanging(self):
-        print " ------------------------------------ onRadiusValueIsChanging ------------------------------------"
-
+    @timedSlot
+    def onRadiusValueIsChanging(self, value):
+        if self.inputModelSelector.currentNode() and value != 0 \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
+            activeInput = self.inputModelSelector.currentNode()
+            selectedFidReflID = self.dictionaryInput[activeInput.GetID()].findIDFromLabel(self.fiducialComboBoxROI.currentText)
+            if selectedFidReflID:
+                activeLandmarkState = self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID]
+                graph = self.logic.getDistanceGraph(activeInput)
+                self.roiPreviewPool.submit(computeLandmarkROI,
+                                           (graph,
+                                            activeLandmarkState.indexClosestPoint,
+                                            activeLandmarkState.distanceField,
+                                            value,
+                                            self.logic.roiDistanceMode),
+                                           lambda result: self.applyROIPreview(activeInput, activeLandmarkState, result))
+
+    @timed
+    def applyROIPreview(self, activeInput, activeLandmarkState, result):
+        field, listID = result
+        if field[0] != activeLandmarkState.indexClosestPoint:
+            return  # The landmark moved meanwhile
+        activeLandmarkState.distanceField = field
+        self.logic.updateLandmarkROI(activeInput, activeLandmarkState, listID)
+        self.logic.displayLandmarkROI(activeInput, activeLandmarkState)
+
+    @timedSlot
     def onRadiusValueChanged(self):
-        print " ------------------------------------ onRadiusValueChanged ---------------------------------------"
-        if self.inputModelSelector.currentNode():
+        self.roiPreviewPool.cancel()
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
             activeInput = self.inputModelSelector.currentNode()
-            selectedFidReflID = self.logic.findIDFromLabel(self.dictionaryInput[activeInput.GetID()].dictionaryLandmark,
-                                                           self.fiducialComboBoxROI.currentText)
+            selectedFidReflID = self.dictionaryInput[activeInput.GetID()].findIDFromLabel(self.fiducialComboBoxROI.currentText)
             if selectedFidReflID and self.radiusDefinitionWidget.value != 0:
                 activeLandmarkState = self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID]
                 activeLandmarkState.radiusROI = self.radiusDefinitionWidget.value
@@ -363,14 +770,319 @@ class PickAndPaintWidget:
                     self.surfaceDeplacementCheckBox.setChecked(True)
                     activeLandmarkState.mouvementSurfaceStatus = True
 
-                self.radiusDefinitionWidget.setEnabled(False)
-                listID = self.logic.defineNeighbor(activeInput,
-                                                   activeLandmarkState.indexClosestPoint,
-                                                   activeLandmarkState.radiusROI)
-                self.logic.addArrayFromIdList(listID, activeInput, activeLandmarkState.arrayName)
-                self.logic.displayROI(activeInput, activeLandmarkState.arrayName)
-                self.radiusDefinitionWidget.setEnabled(True)
-            self.radiusDefinitionWidget.tracking = False
+                listID = self.logic.getLandmarkROI(activeInput, activeLandmarkState)
+                self.logic.updateLandmarkROI(activeInput, activeLandmarkState, listID)
+                self.logic.displayLandmarkROI(activeInput, activeLandmarkState)
+
+    @timedSlot
+    def onROIStorageModeChanged(self, index):
+        if index == ROI_STORAGE_BITMASK and self.getLargestROILabel() > 64:
+            logging.warning("Pick 'n Paint: a bitmask holds at most 64 landmarks")
+            self.roiStorageComboBox.setCurrentIndex(self.logic.roiStorageMode)
+            return
+        # Rewrite the ROIs of every input, on the reference and the propagated models
+        self.logic.setROIStorageMode(index, [landmarkState for value in self.dictionaryInput.itervalues()
+                                             for landmarkState in value.dictionaryLandmark.itervalues()])
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
+            self.UpdateInterface()
+
+    def getLargestROILabel(self):
+        """ Largest ROI label of the landmarks of all the inputs, 0 without landmarks. """
+        return max([int(value.dictionaryLandmark.column('roiLabel').max())
+                    for value in self.dictionaryInput.itervalues() if len(value.dictionaryLandmark)] or [0])
+
+    @timedSlot
+    def onROIDistanceModeChanged(self, index):
+        self.logic.roiDistanceMode = index
+        self.radiusDefinitionWidget.suffix = "" if index == ROI_DISTANCE_HOPS else " mm"
+        self.radiusDefinitionWidget.maximum = maximumRadius(index)
+        self.radiusDefinitionWidget.singleStep = 1.0 if index == ROI_DISTANCE_HOPS else 0.5
+        if self.inputModelSelector.currentNode():
+            activeInput = self.inputModelSelector.currentNode()
+            if self.dictionaryInput.has_key(activeInput.GetID()):
+                # Same radius values, new unit: recompute the ROIs of the reference model
+                for value in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.itervalues():
+                    if value.radiusROI > 0:
+                        listID = self.logic.getLandmarkROI(activeInput, value)
+                        self.logic.updateLandmarkROI(activeInput, value, listID)
+                self.UpdateInterface()
+
+    def onTopologyCacheSettingsChanged(self):
+        settings = qt.QSettings()
+        settings.setValue('PickAndPaint/TopologyCacheEnabled', self.topologyCacheCheckBox.checked)
+        settings.setValue('PickAndPaint/TopologyCacheSize', self.topologyCacheSizeSpinBox.value)
+        self.topologyCacheSizeSpinBox.enabled = self.topologyCacheCheckBox.checked
+        self.topologyCacheClearButton.enabled = self.topologyCacheCheckBox.checked
+        if self.topologyCacheCheckBox.checked:
+            self.logic.setTopologyCache(self.topologyCacheDirectory,
+                                        self.topologyCacheSizeSpinBox.value * 1024 * 1024)
+        else:
+            self.logic.setTopologyCache(None, 0)
+
+    def onMemoryBudgetChanged(self):
+        qt.QSettings().setValue('PickAndPaint/MemoryBudget', self.memoryBudgetSpinBox.value)
+        self.modelRegistry.memoryBudget = self.memoryBudgetSpinBox.value * 1024 * 1024
+        self.updateModelRegistry()
+
+    def getActiveModelIDs(self):
+        """ IDs of the current input and of the models its ROIs are propagated on. """
+        activeInput = self.inputModelSelector.currentNode()
+        if activeInput is None or not self.dictionaryInput.has_key(activeInput.GetID()):
+            return []
+        return [activeInput.GetID()] + list(self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.keys())
+
+    @timed
+    def updateModelRegistry(self):
+        """ Gives the active models back their released ROI arrays, releases
+        the derived data of inactive models over the memory budget and shows
+        the memory held for each model.
+        """
+        activeIDs = self.getActiveModelIDs()
+        self.modelRegistry.touch(activeIDs, self.dictionaryInput)
+        self.modelRegistry.enforceBudget(activeIDs, self.dictionaryInput)
+        self.updateMemoryTable()
+
+    def updateMemoryTable(self):
+        modelIDs = self.modelRegistry.getModelIDs(self.dictionaryInput)
+        self.memoryTable.setRowCount(len(modelIDs))
+        for row, modelID in enumerate(reversed(modelIDs)):  # Most recently used first
+            model = slicer.mrmlScene.GetNodeByID(modelID)
+            memory = self.modelRegistry.getMemory(modelID, self.dictionaryInput)
+            values = [memory[category] for category in ModelRegistry.CATEGORIES]
+            cells = [model.GetName() if model else modelID] + ["%.1f" % (value / 1048576.0)
+                                                               for value in values + [sum(values)]]
+            for column, text in enumerate(cells):
+                self.memoryTable.setItem(row, column, qt.QTableWidgetItem(text))
+
+    def onNodeRemoved(self, node):
+        """ Releases what the module holds for a model or fiducial node
+        removed from the scene.
+        """
+        if not node.IsA('vtkMRMLModelNode') and not node.IsA('vtkMRMLMarkupsFiducialNode'):
+            return
+        nodeID = node.GetID()
+        for inputID, value in self.dictionaryInput.items():
+            if inputID == nodeID or value.fidNodeID == nodeID:
+                self.removeInput(inputID)
+            elif value.dictionaryPropInput.has_key(nodeID):
+                del value.dictionaryPropInput[nodeID]
+        if node.IsA('vtkMRMLModelNode'):
+            self.modelRegistry.forget(nodeID, self.dictionaryInput)
+            self.updateMemoryTable()
+
+    def removeInput(self, inputID):
+        """ Forgets the landmarks of an input: observers and fiducial node,
+        ROI arrays on the propagated models, cached distance fields.
+        """
+        activeInputState = self.dictionaryInput.pop(inputID)
+        fidNode = slicer.mrmlScene.GetNodeByID(activeInputState.fidNodeID)
+        if fidNode is not None:
+            for tag in [activeInputState.MarkupAddedEventTag, activeInputState.MarkupRemovedEventTag,
+                        activeInputState.PointModifiedEventTag]:
+                if tag is not None:
+                    fidNode.RemoveObserver(tag)
+            if slicer.mrmlScene.GetNodeByID(inputID) is None:
+                # Landmarks of a removed model
+                slicer.mrmlScene.RemoveNode(fidNode)
+        modelIDs = set([inputID]).union(activeInputState.dictionaryPropInput.keys())
+        for landmarkState in activeInputState.dictionaryLandmark.itervalues():
+            modelIDs.update(landmarkState.writtenROIs.keys())
+        arrayNames = set(self.logic.getROIArrayName(landmarkState)
+                         for landmarkState in activeInputState.dictionaryLandmark.itervalues())
+        for modelID in modelIDs:
+            model = slicer.mrmlScene.GetNodeByID(modelID)
+            if model is not None and model.GetPolyData() is not None:
+                for arrayName in arrayNames:
+                    model.GetPolyData().GetPointData().RemoveArray(arrayName)
+                model.GetPolyData().Modified()
+        activeInputState.dictionaryLandmark.clear()
+        self.modelRegistry.lastUse.pop(inputID, None)
+        currentNode = self.inputModelSelector.currentNode()
+        if currentNode is None or (currentNode.GetID() == inputID and slicer.mrmlScene.GetNodeByID(inputID) is None):
+            self.fiducialComboBoxROI.clear()
+        elif currentNode.GetID() == inputID:
+            # Only the fiducial node of the selected model was removed: start
+            # again from a new input state and fiducial node
+            self.onCurrentNodeChanged()
+
+    def onTopologyCacheClearButton(self):
+        if self.logic.topologyCache is not None:
+            self.logic.topologyCache.clear()
+
+    def onTimingSettingsChanged(self):
+        instrumentation.enable(self.timingCheckBox.checked, self.traceCheckBox.checked)
+        self.traceCheckBox.enabled = self.timingCheckBox.checked
+        self.printTimingsButton.enabled = self.timingCheckBox.checked
+        self.saveTraceButton.enabled = self.timingCheckBox.checked and self.traceCheckBox.checked
+
+    def onPrintTimingsButton(self):
+        print instrumentation.report()
+        print " Point modified events: ", self.pointModifiedScheduler.getStatistics()
+        locators = [entry['geometry'].locator for entry in self.logic.adjacencyCache.itervalues()
+                    if entry['geometry'].locator is not None]
+        print " Point locators: ", {'entries': len(locators),
+                                    'memoryUsed': sum(locator.getMemorySize() for locator in locators)}
+
+    def onSaveTraceButton(self):
+        path = qt.QFileDialog.getSaveFileName(self.parent, "Save trace", "PickAndPaintTrace.json", "JSON (*.json)")
+        if path:
+            instrumentation.exportTrace(str(path))
+
+    def updateStatisticsScalars(self):
+        """ Lists the point data arrays of the reference model, but the ROI
+        arrays, as scalars of the ROI statistics.
+        """
+        self.statisticsScalarComboBox.clear()
+        self.statisticsScalarComboBox.addItem(DISTANCE_TO_REFERENCE)
+        activeInput = self.inputModelSelector.currentNode()
+        if activeInput is None or activeInput.GetPolyData() is None:
+            return
+        pointData = activeInput.GetPolyData().GetPointData()
+        for i in range(0, pointData.GetNumberOfArrays()):
+            arrayName = pointData.GetArrayName(i)
+            if arrayName and not arrayName.endswith(("_ROI", "_ROI_Labels", "_ROI_Bits")):
+                self.statisticsScalarComboBox.addItem(arrayName)
+
+    @timedSlot
+    def onExportStatisticsButton(self):
+        activeInput = self.inputModelSelector.currentNode()
+        if activeInput is None or not self.dictionaryInput.has_key(activeInput.GetID()):
+            return
+        path = qt.QFileDialog.getSaveFileName(self.parent, "Export ROI statistics", "PickAndPaintStatistics.csv",
+                                              "CSV (*.csv);;Parquet (*.parquet)")
+        if not path:
+            return
+        try:
+            writer = StatisticsWriter(str(path))
+        except (ValueError, IOError), e:
+            logging.error("Pick 'n Paint: cannot write the statistics: %s", e)
+            return
+        activeInputState = self.dictionaryInput[activeInput.GetID()]
+        scalarName = str(self.statisticsScalarComboBox.currentText)
+        landmarkStates = [value for value in activeInputState.dictionaryLandmark.itervalues() if value.radiusROI > 0]
+        models = [activeInput] + [slicer.mrmlScene.GetNodeByID(ID) for ID in activeInputState.dictionaryPropInput.iterkeys()]
+        try:
+            # One model at a time: only its values and statistics are held in memory
+            for model in models:
+                if model is None:
+                    continue
+                try:
+                    self.logic.writeROIStatistics(writer, activeInput, model, landmarkStates, scalarName,
+                                                  activeInputState.propagationType != 2)
+                except ValueError, e:
+                    logging.warning("Pick 'n Paint: no statistics for %s: %s", model.GetName(), e)
+        finally:
+            writer.close()
+
+    def onSaveSessionButton(self):
+        path = qt.QFileDialog.getSaveFileName(self.parent, "Save session", "PickAndPaintSession.npz",
+                                              "Pick 'n Paint session (*.npz)")
+        if not path:
+            return
+        inputs = list()
+        for inputID, value in self.dictionaryInput.iteritems():
+            inputModel = slicer.mrmlScene.GetNodeByID(inputID)
+            fidNode = slicer.mrmlScene.GetNodeByID(value.fidNodeID)
+            if inputModel is None or fidNode is None:
+                continue
+            value.updateMarkupIndexes(fidNode)
+            markupsIndices = [value.dictionaryIDToMarkupIndex[ID] for ID in value.dictionaryLandmark.keys()]
+            targets = [slicer.mrmlScene.GetNodeByID(ID) for ID in value.dictionaryPropInput.iterkeys()]
+            inputs.append({'model': self.logic.getModelDescription(inputModel),
+                           'targets': [self.logic.getModelDescription(node) for node in targets if node],
+                           'propagationType': value.propagationType,
+                           'landmarks': value.dictionaryLandmark,
+                           'positions': self.logic.getFiducialPositions(fidNode, markupsIndices)})
+        saveSession(str(path), inputs)
+
+    def onLoadSessionButton(self):
+        path = qt.QFileDialog.getOpenFileName(self.parent, "Load session", "", "Pick 'n Paint session (*.npz)")
+        if not path:
+            return
+        try:
+            inputs = loadSession(str(path))
+        except Exception, e:
+            logging.error("Pick 'n Paint: cannot load the session: %s", e)
+            return
+        messages = list()
+        for sessionInput in inputs:
+            messages.extend(self.restoreSessionInput(sessionInput))
+        if self.inputModelSelector.currentNode():
+            self.onCurrentNodeChanged()
+            self.UpdateInterface()
+        for message in messages:
+            logging.warning("Pick 'n Paint: %s", message)
+
+    @timed
+    def restoreSessionInput(self, sessionInput):
+        """ Recreates one input of a session file: a fiducial node with its
+        landmarks, the ROIs saved on the model and on the propagated models.
+        ROIs are only grown again on a model whose mesh changed since the
+        session was saved. Returns what could not be restored, as messages.
+        """
+        activeInput = self.logic.findSessionModel(sessionInput['model'])
+        if activeInput is None:
+            return [sessionInput['model']['name'] + ": model not found, landmarks not restored"]
+        if self.dictionaryInput.has_key(activeInput.GetID()):
+            return [activeInput.GetName() + ": the model already has landmarks, they are kept"]
+        messages = list()
+        activeInputState = self.dictionaryInput[activeInput.GetID()] = self.inputState()
+        activeInputState.propagationType = sessionInput['propagationType']
+        fidNode = slicer.vtkMRMLMarkupsFiducialNode()
+        slicer.mrmlScene.AddNode(fidNode)
+        activeInputState.fidNodeID = fidNode.GetID()
+        disabledModify = fidNode.StartModify()
+        for row, position in enumerate(sessionInput['positions']):
+            markupsIndex = fidNode.AddFiducial(position[0], position[1], position[2])
+            fiducialLabel = sessionInput['fiducialLabels'][row]
+            fidNode.SetNthFiducialLabel(markupsIndex, fiducialLabel)
+            landmarkState = activeInputState.addLandmark(fidNode.GetNthMarkupID(markupsIndex), fiducialLabel,
+                                                         markupsIndex)
+            landmarkState.arrayName = sessionInput['arrayNames'][row]
+            landmarkState.modelName = sessionInput['modelNames'][row]
+        fidNode.EndModify(disabledModify)
+        landmarks = activeInputState.dictionaryLandmark
+        for name, values in sessionInput['columns'].iteritems():
+            landmarks.column(name)[:] = values
+        if len(landmarks):
+            activeInputState.landmarkCounter = int(landmarks.column('roiLabel').max())
+        self.observeFiducialNode(activeInputState, fidNode)
+
+        rois = sessionInput['rois']
+        if self.logic.getModelDescription(activeInput)['hash'] != sessionInput['model']['hash']:
+            messages.append(activeInput.GetName() + ": mesh modified since the session was saved, ROIs computed again")
+            landmarks.column('indexClosestPoint')[:] = self.logic.findClosestPointIndices(activeInput,
+                                                                                          sessionInput['positions'])
+            rois = dict()
+            for row, landmarkState in enumerate(landmarks.itervalues()):
+                if landmarkState.radiusROI > 0:
+                    rois[(row, 0)] = self.logic.getLandmarkROI(activeInput, landmarkState)
+        targets = list()  # (model index, node) of the propagated models whose ROIs are still valid
+        for modelIndex, target in enumerate(sessionInput['targets'], 1):
+            node = self.logic.findSessionModel(target)
+            if node is None:
+                messages.append(target['name'] + ": propagated model not found")
+                continue
+            activeInputState.dictionaryPropInput[node.GetID()] = dict()
+            if self.logic.getModelDescription(node)['hash'] != target['hash']:
+                messages.append(node.GetName() + ": mesh modified since the session was saved, propagate again")
+            else:
+                targets.append((modelIndex, node))
+        # Rows are restored in the saved order, the ROIs are written as saved
+        for row, landmarkState in enumerate(landmarks.itervalues()):
+            if (row, 0) not in rois:
+                continue
+            self.logic.updateLandmarkROI(activeInput, landmarkState, rois[(row, 0)])
+            for modelIndex, node in targets:
+                if (row, modelIndex) in rois:
+                    self.logic.updateLandmarkROI(node, landmarkState, rois[(row, modelIndex)])
+                elif activeInputState.propagationType == 1 and landmarkState.propagatedBool:
+                    self.logic.propagateLandmarkCorrespondent(activeInput, node, landmarkState)
+        return messages
+
+    def onIncrementalUpdateToggled(self, checked):
+        self.logic.incrementalROIUpdate = checked
 
     def onPropagationInputComboBoxCheckedNodesChanged(self):
         if self.inputModelSelector.currentNode():
@@ -381,69 +1093,168 @@ class PickAndPaintWidget:
             for model in list:
                 if model.GetID() != activeInput.GetID():
                     self.dictionaryInput[activeInput.GetID()].dictionaryPropInput[model.GetID()] = dict()
-            print self.dictionaryInput[activeInput.GetID()].dictionaryPropInput
 
+    @timedSlot
     def onPropagateButton(self):
-        print " ------------------------------------ onPropagateButton -------------------------------------- "
         if self.inputModelSelector.currentNode():
             activeInput = self.inputModelSelector.currentNode()
             if self.correspondentShapes.isChecked():
-                # print "CorrespondentShapes"
                 self.dictionaryInput[activeInput.GetID()].propagationType = 1
+                self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.setFlag(LandmarkTable.FLAG_PROPAGATED, True)
                 for value in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.itervalues():
-                    arrayName = value.arrayName
-                    value.propagatedBool = True
                     for IDModel in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iterkeys():
                         model = slicer.mrmlScene.GetNodeByID(IDModel)
-                        self.logic.propagateCorrespondent(activeInput, model, arrayName)
+                        self.logic.propagateLandmarkCorrespondent(activeInput, model, value)
             else:
-                # print "nonCorrespondentShapes"
                 self.dictionaryInput[activeInput.GetID()].propagationType = 2
-                for fiducialID, fiducialState in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.iteritems():
-                    fiducialState.propagatedBool = True
-                    for IDModel, dict in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iteritems():
+                self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.setFlag(LandmarkTable.FLAG_PROPAGATED, True)
+                if self.correspondenceMapCheckBox.checked:
+                    for IDModel in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iterkeys():
                         model = slicer.mrmlScene.GetNodeByID(IDModel)
-                        self.logic.propagateNonCorrespondent(self.dictionaryInput[activeInput.GetID()].fidNodeID,
-                                                             fiducialID,
-                                                             fiducialState,
-                                                             model)
+                        for fiducialState in self.dictionaryInput[activeInput.GetID()].dictionaryLandmark.itervalues():
+                            self.logic.propagateLandmarkThroughMap(activeInput, model, fiducialState,
+                                                                   self.rigidAlignmentCheckBox.checked)
+                    self.updateModelRegistry()
+                    self.UpdateInterface()
+                    return
+                if self.propagationProcessesSpinBox.value > 0:
+                    self.propagateInProcesses(activeInput)
+                    self.updateModelRegistry()
+                    self.UpdateInterface()
+                    return
+                # All the landmarks are propagated together on each model
+                for IDModel in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iterkeys():
+                    model = slicer.mrmlScene.GetNodeByID(IDModel)
+                    self.logic.propagateNonCorrespondentBatch(self.dictionaryInput[activeInput.GetID()], model)
+            self.updateModelRegistry()
             self.UpdateInterface()
 
 
+    @timed
+    def propagateInProcesses(self, activeInput):
+        activeInputState = self.dictionaryInput[activeInput.GetID()]
+        fidNode = slicer.mrmlScene.GetNodeByID(activeInputState.fidNodeID)
+        activeInputState.updateMarkupIndexes(fidNode)
+        # Keys, values and columns of the landmark table are all in row order
+        landmarkIDs = activeInputState.dictionaryLandmark.keys()
+        landmarkStates = activeInputState.dictionaryLandmark.values()
+        positions = self.logic.getFiducialPositions(fidNode, [activeInputState.getMarkupIndex(fidNode, ID) for ID in landmarkIDs])
+        radii = activeInputState.dictionaryLandmark.column('radiusROI').tolist()
+        modelIDs = list(activeInputState.dictionaryPropInput.keys())
+
+        self.propagationCancelled = False
+        self.propagationProgressBar.maximum = len(modelIDs)
+        self.propagationProgressBar.value = 0
+        self.propagationProgressBar.show()
+        self.propagationCancelButton.show()
+        self.propagateButton.enabled = False
+        engine = CohortPropagationEngine(self.propagationProcessesSpinBox.value,
+                                         topologyCache=self.logic.topologyCache)
+        try:
+            while (modelIDs or engine.pending) and not self.propagationCancelled:
+                while modelIDs and engine.canSubmit():
+                    modelID = modelIDs.pop(0)
+                    model = slicer.mrmlScene.GetNodeByID(modelID)
+                    if model:
+                        points, cellArrays = self.logic.getMeshArrays(model)
+                        engine.submit(modelID, points, cellArrays, positions, radii, self.logic.roiDistanceMode)
+                    else:
+                        self.propagationProgressBar.value += 1
+                for modelID, result, error in engine.collect():
+                    model = slicer.mrmlScene.GetNodeByID(modelID)
+                    if error is not None:
+                        instrumentation.count('propagationFailures')
+                        logging.error("Pick 'n Paint: propagation on %s failed: %s",
+                                      model.GetName() if model else modelID, error)
+                    elif model:
+                        closestPointIndices, rois, elapsedTime = result
+                        self.logic.applyPropagatedROIs(model, landmarkStates, rois)
+                        # Spent in a worker process, where the spans are not collected
+                        instrumentation.record('propagateLandmarksTask', elapsedTime)
+                        instrumentation.record('propagate:' + model.GetName(), elapsedTime)
+                    self.propagationProgressBar.value += 1
+                # Keeps the interface, and the cancel button, responsive
+                slicer.app.processEvents()
+            if self.propagationCancelled:
+                engine.cancel()
+        finally:
+            engine.shutdown()
+            self.propagationProgressBar.hide()
+            self.propagationCancelButton.hide()
+            self.propagateButton.enabled = True
+
+    def onPropagationCancelButton(self):
+        self.propagationCancelled = True
+
+    @timed
     def onMarkupAddedEvent (self, obj, event):
         if self.inputModelSelector.currentNode():
-            print" ------------------------------------ onMarkupAddedEvent --------------------------------------"
             activeInput = self.inputModelSelector.currentNode()
-            # print " Number of Fiducial ", obj.GetNumberOfMarkups()
             numOfMarkups = obj.GetNumberOfMarkups()
             markupID = obj.GetNthMarkupID(numOfMarkups-1)
+            activeInputState = self.dictionaryInput[activeInput.GetID()]
+            activeInputState.landmarkCounter += 1
+            landmarkNumber = activeInputState.landmarkCounter
 
-            self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[markupID] = self.fiducialState()
-
-            fiducialLabel = '  ' + str(numOfMarkups)
-            self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[markupID].fiducialLabel = fiducialLabel
-
+            fiducialLabel = '  ' + str(landmarkNumber)
             obj.SetNthFiducialLabel(numOfMarkups-1, fiducialLabel)
+            landmarkState = activeInputState.addLandmark(markupID, fiducialLabel, numOfMarkups-1)
 
-            arrayName = activeInput.GetName()+'_'+str(numOfMarkups)+"_ROI"
-            self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[markupID].arrayName = arrayName
+            arrayName = activeInput.GetName()+'_'+str(landmarkNumber)+"_ROI"
+            landmarkState.arrayName = arrayName
+            landmarkState.modelName = activeInput.GetName()
+            landmarkState.roiLabel = landmarkNumber
             #
             self.fiducialComboBoxROI.addItem(fiducialLabel)
             self.fiducialComboBoxROI.setCurrentIndex(self.fiducialComboBoxROI.count-1)
+            if self.logic.roiStorageMode == ROI_STORAGE_BITMASK and landmarkNumber > 64:
+                logging.warning("Pick 'n Paint: a bitmask holds at most 64 landmarks, the ROIs go to a label map")
+                self.roiStorageComboBox.setCurrentIndex(ROI_STORAGE_LABEL_MAP)
 
             self.UpdateInterface()
 
+    @timed
+    def onMarkupRemovedEvent(self, obj, event):
+        for inputID, value in self.dictionaryInput.iteritems():
+            if value.fidNodeID == obj.GetID():
+                removedLabels = value.updateMarkupIndexes(obj)
+                activeInput = self.inputModelSelector.currentNode()
+                if activeInput and activeInput.GetID() == inputID:
+                    for fiducialLabel in removedLabels:
+                        self.fiducialComboBoxROI.removeItem(self.fiducialComboBoxROI.findText(fiducialLabel))
+                break
+
     def onPointModifiedEvent ( self, obj, event):
-        print " ------------------------------------ onPointModifiedEvent -------------------------------------- "
-        if self.inputModelSelector.currentNode():
+        if self.refiningLandmark:
+            # Fired by the snapping of the refinement itself
+            return
+        self.pointModifiedScheduler.schedule()
+
+    @timedSlot
+    def refineActiveLandmark(self):
+        self.refiningLandmark = True
+        try:
+            self.updateActiveLandmark()
+        finally:
+            self.refiningLandmark = False
+
+    @timed
+    def updateActiveLandmark(self):
+        if self.inputModelSelector.currentNode() \
+                and self.dictionaryInput.has_key(self.inputModelSelector.currentNode().GetID()):
             activeInput = self.inputModelSelector.currentNode()
             fidNode = slicer.app.mrmlScene().GetNodeByID(self.dictionaryInput[activeInput.GetID()].fidNodeID)
-            # remove observer to make sure, the callback function won't be disturbed
-            fidNode.RemoveObserver(self.dictionaryInput[activeInput.GetID()].PointModifiedEventTag)
-            selectedFiducialID = self.logic.findIDFromLabel(self.dictionaryInput[activeInput.GetID()].dictionaryLandmark,
-                                                            self.fiducialComboBoxROI.currentText)
+            selectedFiducialID = self.dictionaryInput[activeInput.GetID()].findIDFromLabel(self.fiducialComboBoxROI.currentText)
+            if not selectedFiducialID:
+                return
             activeLandmarkState = self.dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFiducialID]
-            markupsIndex = fidNode.GetMarkupIndexByID(selectedFiducialID)
+            markupsIndex = self.dictionaryInput[activeInput.GetID()].getMarkupIndex(fidNode, selectedFiducialID)
+            if self.proxyCheckBox.checked and not self.refiningLandmark:
+                if activeLandmarkState.radiusROI > 0:
+                    self.logic.previewLandmarkROI(activeInput, fidNode, markupsIndex, activeLandmarkState,
+                                                  self.proxySizeSpinBox.value / 100.0)
+                self.refineTimer.start()
+                return
             if activeLandmarkState.mouvementSurfaceStatus:
                 activeLandmarkState.indexClosestPoint = self.logic.getClosestPointIndex(fidNode,
                                                                                         slicer.util.getNode(activeInput.GetID()),
@@ -455,105 +1266,263 @@ class PickAndPaintWidget:
 
             # Moving the region if we move the fiducial
             if activeLandmarkState.radiusROI > 0 and activeLandmarkState.radiusROI != 0:
-                listID = self.logic.defineNeighbor(activeInput,
-                                                   activeLandmarkState.indexClosestPoint,
-                                                   activeLandmarkState.radiusROI)
-                self.logic.addArrayFromIdList(listID, activeInput, activeLandmarkState.arrayName)
-                self.logic.displayROI(activeInput, activeLandmarkState.arrayName)
+                listID = self.logic.getLandmarkROI(activeInput, activeLandmarkState)
+                self.logic.updateLandmarkROI(activeInput, activeLandmarkState, listID)
+                self.logic.displayLandmarkROI(activeInput, activeLandmarkState)
 
                 # Moving the region on propagated models if the region has been propagated before
                 if self.dictionaryInput[activeInput.GetID()].dictionaryPropInput and activeLandmarkState.propagatedBool:
                     if self.correspondentShapes.isChecked():
-                        print " self.correspondentShapes.isChecked "
                         for nodeID in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iterkeys():
-                            print nodeID
                             node = slicer.mrmlScene.GetNodeByID(nodeID)
-                            self.logic.propagateCorrespondent(activeInput, node, activeLandmarkState.arrayName)
+                            self.logic.propagateLandmarkCorrespondent(activeInput, node, activeLandmarkState)
                     else:
-                        print " Not Checked "
                         for nodeID in self.dictionaryInput[activeInput.GetID()].dictionaryPropInput.iterkeys():
-                            print nodeID
                             node = slicer.mrmlScene.GetNodeByID(nodeID)
-                            self.logic.propagateNonCorrespondent(self.dictionaryInput[activeInput.GetID()].fidNodeID,
+                            if self.correspondenceMapCheckBox.checked:
+                                self.logic.propagateLandmarkThroughMap(activeInput, node, activeLandmarkState,
+                                                                       self.rigidAlignmentCheckBox.checked)
+                                continue
+                            self.logic.propagateNonCorrespondent(self.dictionaryInput[activeInput.GetID()],
                                                                  selectedFiducialID,
-                                                                 activeLandmarkState,
                                                                  node)
-            time.sleep(0.08)
-            self.dictionaryInput[activeInput.GetID()].PointModifiedEventTag = \
-                fidNode.AddObserver(fidNode.PointModifiedEvent, self.onPointModifiedEvent)
 
 
     def onReload(self, moduleName="PickAndPaint"):
         """Generic reload method for any scripted module.
         ModuleWizard will subsitute correct default moduleName.
         """
-        print " --------------------- RELOAD ------------------------ \n"
+        self.removeSceneObservers()
         globals()[moduleName] = slicer.util.reloadScriptedModule(moduleName)
 
-class PickAndPaintLogic:
-    def __init__(self):
-        pass
-
-    def findIDFromLabel(self, activeInputLandmarkDict, fiducialLabel):
-        print " findIDFromLabel "
-        fiducialID = None
-        for ID, value in activeInputLandmarkDict.iteritems():
-            if activeInputLandmarkDict[ID].fiducialLabel == fiducialLabel:
-                fiducialID = ID
+class ModelRegistry(object):
+    """ Data held for each model by the module, and its memory budget.
+
+    Derived data (point locator, adjacency and distance graph, vertex maps,
+    decimated proxy, distance fields of the landmarks placed on the model,
+    ROI arrays written on the model) can be rebuilt: caches on their next
+    use, ROI arrays from the ROI ids kept in writtenROIs. Once the total
+    goes over memoryBudget bytes, it is released for the models that are
+    not active, least recently used first.
+
+    dictionaryInput is the inputState dictionary of the widget: the
+    landmarks placed on each input and the ROIs written on every model.
+    """
+    CATEGORIES = ('roiArrays', 'locator', 'adjacency', 'vertexMaps', 'proxy', 'distanceFields')
+
+    def __init__(self, logic, memoryBudget=1024 * 1024 * 1024):
+        self.logic = logic
+        self.memoryBudget = memoryBudget
+        self.lastUse = collections.OrderedDict()  # Key = ID of model node, least recently used first
+        self.evictions = 0
+
+    def getModelIDs(self, dictionaryInput):
+        """ IDs of every model the module holds data for, least recently used first. """
+        modelIDs = set(dictionaryInput.keys())
+        for value in dictionaryInput.itervalues():
+            modelIDs.update(value.dictionaryPropInput.keys())
+        modelIDs.update(self.logic.adjacencyCache.keys())
+        modelIDs.update(self.logic.proxies.keys())
+        for referenceID, propagatedID in self.logic.correspondenceMaps.keys():
+            modelIDs.update([referenceID, propagatedID])
+        used = [modelID for modelID in self.lastUse.keys() if modelID in modelIDs]
+        return sorted(modelIDs.difference(used)) + used
+
+    def iterLandmarks(self, dictionaryInput):
+        for value in dictionaryInput.itervalues():
+            for landmarkState in value.dictionaryLandmark.itervalues():
+                yield landmarkState
+
+    def getMemory(self, modelID, dictionaryInput):
+        """ Returns the bytes of derived data held for the model, by category. """
+        logic = self.logic
+        adjacencyEntry = logic.adjacencyCache.get(modelID, {})
+        geometry = adjacencyEntry.get('geometry')
+        locatorSize = geometry.locator.getMemorySize() if geometry and geometry.locator else 0
+        proxyEntry = logic.proxies.get(modelID)
+        memory = {'roiArrays': memorySize([landmarkState.writtenROIs[modelID]
+                                           for landmarkState in self.iterLandmarks(dictionaryInput)
+                                           if landmarkState.writtenROIs.has_key(modelID)]),
+                  'locator': locatorSize,
+                  'adjacency': geometry.getMemorySize() - locatorSize if geometry else 0,
+                  'vertexMaps': memorySize([entry[1] for key, entry in logic.correspondenceMaps.iteritems()
+                                            if key[1] == modelID]),
+                  'proxy': memorySize(proxyEntry[1]) if proxyEntry else 0,
+                  'distanceFields': 0}
+        if dictionaryInput.has_key(modelID):
+            # Only the vertices and distances: the graph is counted with the adjacency
+            memory['distanceFields'] = memorySize([field[2:] for field in
+                                                   dictionaryInput[modelID].dictionaryLandmark.objectColumns['distanceField']
+                                                   if field is not None])
+        return memory
+
+    def touch(self, modelIDs, dictionaryInput):
+        """ Marks the models as the most recently used ones and writes back
+        the ROI arrays that were released for them.
+        """
+        for modelID in modelIDs:
+            self.lastUse.pop(modelID, None)
+            self.lastUse[modelID] = True
+            model = slicer.mrmlScene.GetNodeByID(modelID)
+            if model is None or model.GetPolyData() is None:
+                continue
+            for landmarkState in self.iterLandmarks(dictionaryInput):
+                written = landmarkState.writtenROIs.get(modelID)
+                if written is not None and written[0] is None:
+                    self.logic.updateLandmarkROI(model, landmarkState, written[1])
+
+    @timed
+    def release(self, modelID, dictionaryInput):
+        """ Releases the derived data of the model. Its ROI arrays are
+        removed from the model, their ids are kept to write them back.
+        """
+        self.logic.releaseDerivedData(modelID)
+        if dictionaryInput.has_key(modelID):
+            distanceFields = dictionaryInput[modelID].dictionaryLandmark.objectColumns['distanceField']
+            distanceFields[:] = [None] * len(distanceFields)
+        model = slicer.mrmlScene.GetNodeByID(modelID)
+        pointData = model.GetPolyData().GetPointData() if model and model.GetPolyData() else None
+        for landmarkState in self.iterLandmarks(dictionaryInput):
+            written = landmarkState.writtenROIs.get(modelID)
+            if written is None or written[0] is None:
+                continue
+            if pointData is not None and pointData.GetArray(written[0].GetName()) is written[0]:
+                pointData.RemoveArray(written[0].GetName())
+            landmarkState.writtenROIs[modelID] = (None, written[1])
+        if pointData is not None:
+            model.GetPolyData().Modified()
+        self.evictions += 1
+        instrumentation.count('modelEvictions')
+
+    def forget(self, modelID, dictionaryInput):
+        """ Drops everything held for a model removed from the scene. """
+        self.logic.releaseDerivedData(modelID)
+        for landmarkState in self.iterLandmarks(dictionaryInput):
+            landmarkState.writtenROIs.pop(modelID, None)
+        self.lastUse.pop(modelID, None)
+
+    def getTotalMemory(self, dictionaryInput):
+        return sum(sum(self.getMemory(modelID, dictionaryInput).values())
+                   for modelID in self.getModelIDs(dictionaryInput))
+
+    def enforceBudget(self, activeIDs, dictionaryInput):
+        """ Releases the derived data of inactive models, least recently
+        used first, until the total fits in the memory budget.
+        """
+        totalMemory = self.getTotalMemory(dictionaryInput)
+        for modelID in self.getModelIDs(dictionaryInput):
+            if totalMemory <= self.memoryBudget:
                 break
-        return fiducialID
+            if modelID in activeIDs:
+                continue
+            modelMemory = sum(self.getMemory(modelID, dictionaryInput).values())
+            if modelMemory == 0:
+                continue
+            self.release(modelID, dictionaryInput)
+            totalMemory -= modelMemory - sum(self.getMemory(modelID, dictionaryInput).values())
+
 
+class PickAndPaintLogic:
+    def __init__(self):
+        self.adjacencyCache = dict()  # Key = ID of model node
+        self.topologyCache = None  # On-disk MeshTopologyCache, see setTopologyCache
+        self.correspondenceMaps = dict()  # Key = (ID of reference model, ID of propagated model)
+        self.proxies = dict()  # Key = ID of model node, value = DecimatedProxy used while dragging landmarks
+        self.roiLookupTable = None
+        self.roiStorageMode = ROI_STORAGE_PER_LANDMARK
+        self.incrementalROIUpdate = True
+        self.roiDistanceMode = ROI_DISTANCE_HOPS
+
+    @timed
     def UpdateThreeDView(self, activeInput, dictionaryInput, landmarkLabel = None, functionCaller = None):
-        print " UpdateThreeDView() "
+        """ Shows the landmarks of the active input and the ROI of the selected
+        landmark. Only the markups and display nodes whose state differs are
+        modified, each node in a single StartModify/EndModify batch, and the
+        views render once at the end.
+        """
         activeInputID = activeInput.GetID()
-        if functionCaller == 'onCurrentNodeChanged':
-            # Fiducial Visibility
-            for keyInput, valueInput in dictionaryInput.iteritems():
-                fidNode = slicer.app.mrmlScene().GetNodeByID(valueInput.fidNodeID)
-                if keyInput != activeInputID:
-                    if valueInput.dictionaryLandmark:
-                        for landID in valueInput.dictionaryLandmark.iterkeys():
-                            print "ID=", landID
-                            landmarkIndex = fidNode.GetMarkupIndexByID(landID)
-                            print "Index= ", landmarkIndex
-                            fidNode.SetNthFiducialVisibility(landmarkIndex, False)
-                else:
-                    if valueInput.dictionaryLandmark:
-                        for landID in valueInput.dictionaryLandmark.iterkeys():
-                            landmarkIndex = fidNode.GetMarkupIndexByID(landID)
-                            fidNode.SetNthFiducialVisibility(landmarkIndex, True)
-
-        if functionCaller == 'UpdateInterface' and landmarkLabel:
-            selectedFidReflID = self.findIDFromLabel(dictionaryInput[activeInput.GetID()].dictionaryLandmark,
-                                                     landmarkLabel)
-            fidNode = slicer.app.mrmlScene().GetNodeByID(dictionaryInput[activeInputID].fidNodeID)
-            for key in dictionaryInput[activeInputID].dictionaryLandmark.iterkeys():
-                markupsIndex = fidNode.GetMarkupIndexByID(key)
-                if key != selectedFidReflID:
-                    fidNode.SetNthMarkupLocked(markupsIndex, True)
-                else:
-                    fidNode.SetNthMarkupLocked(markupsIndex, False)
-
-            displayNode = activeInput.GetModelDisplayNode()
-            displayNode.SetScalarVisibility(False)
-            if dictionaryInput[activeInput.GetID()].dictionaryPropInput:
-                for nodeID in dictionaryInput[activeInput.GetID()].dictionaryPropInput:
-                    node = slicer.mrmlScene.GetNodeByID(nodeID)
-                    node.GetDisplayNode().SetScalarVisibility(False)
-            if selectedFidReflID:
-                if dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].radiusROI > 0:
-                    displayNode.SetActiveScalarName(dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].arrayName)
-                    displayNode.SetScalarVisibility(True)
-                    for nodeID in dictionaryInput[activeInput.GetID()].dictionaryPropInput:
-                        node = slicer.mrmlScene.GetNodeByID(nodeID)
-                        arrayID = self.findArray(node.GetPolyData().GetPointData(),
-                                                 dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].arrayName)
-                        if arrayID != -1:
-                            node.GetDisplayNode().SetActiveScalarName(dictionaryInput[activeInput.GetID()].dictionaryLandmark[selectedFidReflID].arrayName)
-                            node.GetDisplayNode().SetScalarVisibility(True)
-
+        self.pauseRender()
+        try:
+            if functionCaller == 'onCurrentNodeChanged':
+                # Fiducial Visibility
+                for keyInput, valueInput in dictionaryInput.iteritems():
+                    fidNode = slicer.app.mrmlScene().GetNodeByID(valueInput.fidNodeID)
+                    if fidNode and valueInput.dictionaryLandmark:
+                        valueInput.updateMarkupIndexes(fidNode)
+                        self.setMarkupsVisibility(fidNode,
+                                                  [valueInput.getMarkupIndex(fidNode, landID)
+                                                   for landID in valueInput.dictionaryLandmark.iterkeys()],
+                                                  keyInput == activeInputID)
+
+            if functionCaller == 'UpdateInterface' and landmarkLabel:
+                activeInputState = dictionaryInput[activeInputID]
+                fidNode = slicer.app.mrmlScene().GetNodeByID(activeInputState.fidNodeID)
+                activeInputState.updateMarkupIndexes(fidNode)
+                selectedFidReflID = activeInputState.findIDFromLabel(landmarkLabel)
+                lockStates = [(activeInputState.getMarkupIndex(fidNode, key), key != selectedFidReflID)
+                              for key in activeInputState.dictionaryLandmark.iterkeys()]
+                self.setMarkupsLocked(fidNode, lockStates)
+
+                selectedLandmarkState = None
+                if selectedFidReflID and activeInputState.dictionaryLandmark[selectedFidReflID].radiusROI > 0:
+                    selectedLandmarkState = activeInputState.dictionaryLandmark[selectedFidReflID]
+                models = [activeInput] + [slicer.mrmlScene.GetNodeByID(nodeID)
+                                          for nodeID in activeInputState.dictionaryPropInput]
+                for node in models:
+                    scalarName = None
+                    if node and selectedLandmarkState:
+                        scalarName = self.prepareLandmarkROIDisplay(node, selectedLandmarkState)
+                    if node:
+                        self.setScalarDisplay(node, scalarName)
+        finally:
+            self.resumeRender()
+
+    def pauseRender(self):
+        if hasattr(slicer.app, 'pauseRender'):
+            slicer.app.pauseRender()
+
+    def resumeRender(self):
+        if hasattr(slicer.app, 'resumeRender'):
+            slicer.app.resumeRender()
+
+    def setMarkupsVisibility(self, fidNode, markupsIndices, visibility):
+        changedIndices = [markupsIndex for markupsIndex in markupsIndices
+                          if markupsIndex >= 0 and bool(fidNode.GetNthMarkupVisibility(markupsIndex)) != visibility]
+        if changedIndices:
+            disabledModify = fidNode.StartModify()
+            for markupsIndex in changedIndices:
+                fidNode.SetNthFiducialVisibility(markupsIndex, visibility)
+            fidNode.EndModify(disabledModify)
+
+    def setMarkupsLocked(self, fidNode, lockStates):
+        """ lockStates: list of (markups index, locked) """
+        changedStates = [(markupsIndex, locked) for markupsIndex, locked in lockStates
+                         if markupsIndex >= 0 and bool(fidNode.GetNthMarkupLocked(markupsIndex)) != locked]
+        if changedStates:
+            disabledModify = fidNode.StartModify()
+            for markupsIndex, locked in changedStates:
+                fidNode.SetNthMarkupLocked(markupsIndex, locked)
+            fidNode.EndModify(disabledModify)
+
+    def setScalarDisplay(self, inputModelNode, scalarName):
+        """ Shows the point data array scalarName on the model, or no scalars
+        when scalarName is None, touching the display node only if needed.
+        """
+        displayNode = inputModelNode.GetDisplayNode()
+        if not displayNode:
+            return
+        changeName = scalarName is not None and displayNode.GetActiveScalarName() != scalarName
+        changeVisibility = bool(displayNode.GetScalarVisibility()) != (scalarName is not None)
+        if changeName or changeVisibility:
+            disabledModify = displayNode.StartModify()
+            if changeName:
+                displayNode.SetActiveScalarName(scalarName)
+            if changeVisibility:
+                displayNode.SetScalarVisibility(scalarName is not None)
+            displayNode.EndModify(disabledModify)
+
+    @timed
     def replaceLandmark(self, inputModel, fidNode, fiducialID, indexClosestPoint):
-        print " --- replaceLandmark --- "
         polyData = inputModel.GetPolyData()
         fiducialCoord = numpy.zeros(3)
         polyData.GetPoints().GetPoint(indexClosestPoint, fiducialCoord)
@@ -562,136 +1531,516 @@ class PickAndPaintLogic:
                                        fiducialCoord[1],
                                        fiducialCoord[2])
 
+    @timed
     def getClosestPointIndex(self, fidNode,  input, fiducialID):
-        print " --- getClosestPointIndex --- "
         fiducialCoord = numpy.zeros(3)
         fidNode.GetNthFiducialPosition(fiducialID, fiducialCoord)
-        polyData = input.GetPolyData()
-
-        pointLocator = vtk.vtkPointLocator()
-        pointLocator.SetDataSet(polyData)
-        pointLocator.AutomaticOn()
-        pointLocator.BuildLocator()
-        indexClosestPoint = pointLocator.FindClosestPoint(fiducialCoord)
+        indexClosestPoint = int(self.getMeshGeometry(input).closestVertices(fiducialCoord)[0])
 
         return indexClosestPoint
 
 
+    def getFiducialPositions(self, fidNode, markupsIndices):
+        """ Returns the positions of the markups as a N x 3 array. """
+        positions = numpy.zeros((len(markupsIndices), 3))
+        fiducialCoord = numpy.zeros(3)
+        for row, markupsIndex in enumerate(markupsIndices):
+            fidNode.GetNthFiducialPosition(markupsIndex, fiducialCoord)
+            positions[row] = fiducialCoord
+        return positions
+
+    def findClosestPointIndices(self, inputModelNode, positions):
+        """ Returns the closest vertex of the model for each row of the N x 3
+        positions, all found with the point locator of its MeshGeometry.
+        """
+        return self.getMeshGeometry(inputModelNode).closestVertices(positions)
+
+    @timed
+    def snapLandmarks(self, inputModelNode, fidNode, markupsIndices):
+        """ Moves the markups on their closest vertex of the model. The
+        positions are read in one pass, snapped with the cached locator and
+        written back in a single StartModify/EndModify block. Returns the
+        closest vertex of each markup, -1 for the markups that are no longer
+        in the node (markups index -1).
+        """
+        markupsIndices = numpy.asarray(markupsIndices, numpy.int64)
+        indices = numpy.full(len(markupsIndices), -1, numpy.int64)
+        found = numpy.flatnonzero(markupsIndices >= 0)
+        if found.size == 0:
+            return indices
+        foundMarkupsIndices = markupsIndices[found].tolist()
+        indices[found] = self.findClosestPointIndices(inputModelNode,
+                                                      self.getFiducialPositions(fidNode, foundMarkupsIndices))
+        points = numpy_support.vtk_to_numpy(inputModelNode.GetPolyData().GetPoints().GetData())
+        disabledModify = fidNode.StartModify()
+        for markupsIndex, position in zip(foundMarkupsIndices, points[indices[found]].tolist()):
+            fidNode.SetNthFiducialPosition(markupsIndex, position[0], position[1], position[2])
+        fidNode.EndModify(disabledModify)
+        return indices
+
+
+    @timed
     def displayROI(self, inputModelNode, scalarName):
-        print " --- displayROI --- "
-        polyData = inputModelNode.GetPolyData()
-        polyData.Modified()
-        displayNode = inputModelNode.GetModelDisplayNode()
-        disabledModify = displayNode.StartModify()
-
-        displayNode.SetActiveScalarName(scalarName)
-        displayNode.SetScalarVisibility(True)
-
-        displayNode.EndModify(disabledModify)
-
-
-    def findArray(self, pointData, arrayName):
-        print " --- findArray --- "
-        arrayID = -1
-        if pointData.HasArray(arrayName) == 1:
-            for i in range(0, pointData.GetNumberOfArrays()):
-                if pointData.GetArrayName(i) == arrayName:
-                    arrayID = i
-                    break
-        return arrayID
-
-
-    def addArrayFromIdList(self, connectedIdList, inputModelNode, arrayName):
-        print " --- addArrayFromIdList --- "
-        polyData = inputModelNode.GetPolyData()
+        """ Shows the array scalarName on the model. The functions writing ROI
+        arrays already call polyData.Modified().
+        """
+        self.setScalarDisplay(inputModelNode, scalarName)
+
+
+    def getROILookupTable(self):
+        """ Lookup table shared by every ROI array. """
+        if self.roiLookupTable is None:
+            lut = vtk.vtkLookupTable()
+            tableSize = 2
+            lut.SetNumberOfTableValues(tableSize)
+            lut.Build()
+            lut.SetTableValue(0, 0.23, 0.11, 0.8, 1)
+            # lut.SetTableValue(1, 0.8, 0.4, 0.9, 1)
+            lut.SetTableValue(1, 0.8, 0.3, 0.7, 1)
+            self.roiLookupTable = lut
+        return self.roiLookupTable
+
+    def getPointDataArray(self, polyData, arrayName, arrayClass, dtype, create=True):
+        """ Returns the point data array arrayName and a numpy view on its
+        memory. When create is True, a missing array, or one that does not
+        have the expected type and size, is replaced by a new zeroed array of
+        class arrayClass. Otherwise (None, None) is returned for them.
+        """
         pointData = polyData.GetPointData()
-        numberofIds = connectedIdList.GetNumberOfIds()
-        hasArrayInt = pointData.HasArray(arrayName)
-
-        if hasArrayInt == 1:  #  ROI Array found
-            print "  MODIFIED "
+        numberOfPoints = polyData.GetNumberOfPoints()
+        array = pointData.GetArray(arrayName)
+        if array is not None and array.GetNumberOfComponents() == 1:
+            values = numpy_support.vtk_to_numpy(array)
+            if values.dtype == dtype and values.size == numberOfPoints:
+                return array, values
+        if not create:
+            return None, None
+        if array is not None:
             pointData.RemoveArray(arrayName)
-
-        print "  CREATED  "
-        arrayToAdd = vtk.vtkDoubleArray()
-        arrayToAdd.SetName(arrayName)
-        for i in range(0, polyData.GetNumberOfPoints()):
-                arrayToAdd.InsertNextValue(0.0)
-        for i in range(0, numberofIds):
-            arrayToAdd.SetValue(connectedIdList.GetId(i), 1.0)
-
-        lut = vtk.vtkLookupTable()
-        tableSize = 2
-        lut.SetNumberOfTableValues(tableSize)
-        lut.Build()
-        lut.SetTableValue(0, 0.23, 0.11, 0.8, 1)
-        # lut.SetTableValue(1, 0.8, 0.4, 0.9, 1)
-        lut.SetTableValue(1, 0.8, 0.3, 0.7, 1)
-
-        arrayToAdd.SetLookupTable(lut)
-        pointData.AddArray(arrayToAdd)
+        array = arrayClass()
+        array.SetName(arrayName)
+        array.SetNumberOfTuples(numberOfPoints)
+        pointData.AddArray(array)
+        instrumentation.count('arraysCreated')
+        # View on the memory of the VTK array, nothing is copied
+        values = numpy_support.vtk_to_numpy(array)
+        values[:] = 0
+        return array, values
+
+    def getROIArrayName(self, landmarkState):
+        """ Name of the point data array holding the ROI of the landmark. """
+        return roiArrayName(self.roiStorageMode, landmarkState.modelName, landmarkState.roiLabel,
+                            landmarkState.arrayName)
+
+    def getROIBitmaskArray(self, polyData, arrayName, roiLabel, create=True):
+        """ uint32 bitmask, switched to uint64 once a label above 32 is used. """
+        array, values = self.getPointDataArray(polyData, arrayName, vtk.vtkTypeUInt32Array, numpy.uint32, create=False)
+        if values is None:
+            array, values = self.getPointDataArray(polyData, arrayName, vtk.vtkTypeUInt64Array, numpy.uint64, create=False)
+        if values is not None and (values.dtype == numpy.uint64 or roiLabel <= 32):
+            return array, values
+        if not create:
+            return None, None
+        oldValues = values
+        if roiLabel <= 32:
+            array, values = self.getPointDataArray(polyData, arrayName, vtk.vtkTypeUInt32Array, numpy.uint32)
+        else:
+            if oldValues is not None:
+                oldValues = oldValues.copy()
+            array, values = self.getPointDataArray(polyData, arrayName, vtk.vtkTypeUInt64Array, numpy.uint64)
+            if oldValues is not None:
+                values[:] = oldValues
+        return array, values
+
+    @timed
+    def updateLandmarkROI(self, inputModelNode, landmarkState, ids):
+        """ Writes the ROI of the landmark on the model in the current storage
+        mode. In incremental mode, when the array written last time is still
+        on the model, only the vertices entering or leaving the ROI change.
+        """
+        polyData = inputModelNode.GetPolyData()
+        label = landmarkState.roiLabel
+        if self.roiStorageMode == ROI_STORAGE_PER_LANDMARK:
+            # Signed: mappers send unsigned char scalars directly as colors
+            # instead of going through the lookup table
+            array, values = self.getPointDataArray(polyData, landmarkState.arrayName,
+                                                   vtk.vtkSignedCharArray, numpy.int8)
+            array.SetLookupTable(self.getROILookupTable())
+        elif self.roiStorageMode == ROI_STORAGE_LABEL_MAP:
+            array, values = self.getPointDataArray(polyData, self.getROIArrayName(landmarkState),
+                                                   vtk.vtkUnsignedShortArray, numpy.uint16)
+        else:
+            if not 0 < label <= 64:
+                logging.error("Pick 'n Paint: a bitmask holds at most 64 landmarks")
+                return False
+            array, values = self.getROIBitmaskArray(polyData, self.getROIArrayName(landmarkState), label)
+
+        previous = landmarkState.writtenROIs.get(inputModelNode.GetID())
+        previousIds = None
+        if self.incrementalROIUpdate and previous is not None and previous[0] is array:
+            previousIds = previous[1]
+        otherROIs = None
+        if self.roiStorageMode == ROI_STORAGE_LABEL_MAP:
+            # Vertices leaving the ROI go back to the other landmarks of the label map
+            otherROIs = [(otherState.roiLabel, otherState.writtenROIs[inputModelNode.GetID()][1])
+                         for otherState in landmarkState.table.itervalues()
+                         if otherState.roiLabel != label and otherState.modelName == landmarkState.modelName
+                         and otherState.writtenROIs.get(inputModelNode.GetID(), (None,))[0] is array]
+        if not writeROIMask(values, self.roiStorageMode, label, ids, previousIds, otherROIs):
+            return True
+        landmarkState.writtenROIs[inputModelNode.GetID()] = (array, ids)
+        array.Modified()
         polyData.Modified()
         return True
 
+    @timed
+    def setROIStorageMode(self, storageMode, landmarkStates):
+        """ Moves the ROIs written by the landmarks to the arrays of the new
+        storage mode, on every model they were written on. The arrays of the
+        previous mode, and its display arrays, are removed from the models.
+        """
+        if storageMode == self.roiStorageMode:
+            return
+        rewrites = list()
+        for landmarkState in landmarkStates:
+            for modelID, (array, ids) in landmarkState.writtenROIs.items():
+                if array is None:
+                    # Released by the model registry, written back in the new mode when used again
+                    continue
+                del landmarkState.writtenROIs[modelID]
+                model = slicer.mrmlScene.GetNodeByID(modelID)
+                if model is None or model.GetPolyData() is None:
+                    continue
+                polyData = model.GetPolyData()
+                pointData = polyData.GetPointData()
+                if pointData.GetArray(array.GetName()) is array:
+                    pointData.RemoveArray(array.GetName())
+                if pointData.HasArray(landmarkState.modelName + "_ROI_Display"):
+                    pointData.RemoveArray(landmarkState.modelName + "_ROI_Display")
+                polyData.Modified()
+                if len(ids):
+                    rewrites.append((model, landmarkState, ids))
+        self.roiStorageMode = storageMode
+        for model, landmarkState, ids in rewrites:
+            self.updateLandmarkROI(model, landmarkState, ids)
+
+    @timed
+    def displayLandmarkROI(self, inputModelNode, landmarkState):
+        """ Shows the ROI of the landmark on the model. """
+        scalarName = self.prepareLandmarkROIDisplay(inputModelNode, landmarkState)
+        if scalarName is None:
+            logging.warning("Pick 'n Paint: no ROI array found, please define one before")
+            return
+        self.displayROI(inputModelNode, scalarName)
+
+    def prepareLandmarkROIDisplay(self, inputModelNode, landmarkState):
+        """ Returns the name of the array showing the ROI of the landmark on
+        the model, or None if the model has no ROI for it. In the compact
+        storage modes the landmark is selected by thresholding the
+        label/bitmask array into a single 8-bit display array, so only one
+        extra array per model is needed whatever the number of landmarks.
+        """
+        if self.roiStorageMode == ROI_STORAGE_PER_LANDMARK:
+            if not inputModelNode.GetPolyData().GetPointData().HasArray(landmarkState.arrayName):
+                return None
+            return landmarkState.arrayName
 
-    def GetConnectedVertices(self, polyData, pointID):
-        # print " --- GetConnectedVertices --- "
-        cellList = vtk.vtkIdList()
-        idsList = vtk.vtkIdList()
-        idsList.InsertNextId(pointID)
-        # Get cells that vertex 'pointID' belongs to
-        polyData.GetPointCells(pointID, cellList)
-        numberOfIds = cellList.GetNumberOfIds()
-        for i in range(0, numberOfIds):
-            # Get points which compose all cells
-            pointIdList = vtk.vtkIdList()
-            polyData.GetCellPoints(cellList.GetId(i), pointIdList)
-            for i in range(0, pointIdList.GetNumberOfIds()):
-                if pointIdList.GetId(i) != pointID:
-                    idsList.InsertUniqueId(pointIdList.GetId(i))
-        return idsList
-
-
-    def defineNeighbor(self, inputModelNode, indexClosestPoint , distance):
-        print" --- defineNeighbor --- "
-        def add2IdLists(list1, list2):
-            for i in range(0, list2.GetNumberOfIds()):
-                list1.InsertUniqueId(list2.GetId(i))
-            return list1
         polyData = inputModelNode.GetPolyData()
-        connectedVerticesList = self.GetConnectedVertices(polyData, indexClosestPoint)
-        if distance > 1:
-            for dist in range(1, int(distance)):
-                for i in range(0, connectedVerticesList.GetNumberOfIds()):
-                    connectedList = self.GetConnectedVertices(polyData, connectedVerticesList.GetId(i))
-                    verticesListTemp = add2IdLists(connectedVerticesList, connectedList)
-                connectedVerticesList = verticesListTemp
-        return connectedVerticesList
-
-
-    def propagateCorrespondent(self, referenceInputModel, propagatedInputModel, arrayName):
-        print " ---- propagateCorrespondent ---- "
-        referencePointData = referenceInputModel.GetPolyData().GetPointData()
-        propagatedPointData = propagatedInputModel.GetPolyData().GetPointData()
-        arrayIDReference = self.findArray(referencePointData, arrayName)
-        arrayToPropagate = referencePointData.GetArray(arrayIDReference)
-        propagatedPointData.AddArray(arrayToPropagate)
-        self.displayROI(propagatedInputModel, arrayName)
-        arrayIDPropagated = self.findArray(propagatedPointData, arrayName)
-        if arrayIDReference != -1:
-            arrayToPropagate = referencePointData.GetArray(arrayIDReference)
-            if arrayIDPropagated != -1:
-                propagatedPointData.RemoveArray(arrayIDPropagated)
-            propagatedPointData.AddArray(arrayToPropagate)
-            self.displayROI(propagatedInputModel, arrayName)
+        if self.roiStorageMode == ROI_STORAGE_LABEL_MAP:
+            array, values = self.getPointDataArray(polyData, self.getROIArrayName(landmarkState),
+                                                   vtk.vtkUnsignedShortArray, numpy.uint16, create=False)
+        else:
+            array, values = self.getROIBitmaskArray(polyData, self.getROIArrayName(landmarkState),
+                                                    landmarkState.roiLabel, create=False)
+        if values is None:
+            return None
+        selected = roiSelection(values, self.roiStorageMode, landmarkState.roiLabel)
+        displayArrayName = landmarkState.modelName + "_ROI_Display"
+        displayArray, displayValues = self.getPointDataArray(polyData, displayArrayName,
+                                                             vtk.vtkSignedCharArray, numpy.int8)
+        displayArray.SetLookupTable(self.getROILookupTable())
+        if (displayValues != selected).any():
+            displayValues[:] = selected
+            displayArray.Modified()
+            polyData.Modified()
+        return displayArrayName
+
+
+    def setTopologyCache(self, directory, maximumSize):
+        """ Keeps the adjacency and edge lengths of the models in directory,
+        up to maximumSize bytes, so they are mapped instead of rebuilt when
+        the same meshes are loaded again. None turns the cache off.
+        """
+        if directory is None:
+            self.topologyCache = None
+        elif self.topologyCache is not None and self.topologyCache.directory == directory:
+            self.topologyCache.setMaximumSize(maximumSize)
+        else:
+            try:
+                self.topologyCache = MeshTopologyCache(directory, maximumSize)
+            except OSError, e:
+                logging.error("Pick 'n Paint: cannot create the topology cache directory: %s", e)
+                self.topologyCache = None
+
+    def getMeshGeometry(self, inputModelNode):
+        """ Returns the MeshGeometry of the model. Its adjacency is rebuilt
+        only when the cells or the number of points change, or mapped from the
+        on-disk topology cache; when only the points move, it is given a copy
+        of the new points and builds its distance graphs again.
+        """
+        polyData = inputModelNode.GetPolyData()
+        cellArrays = [polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()]
+        key = (polyData.GetNumberOfPoints(), max([cellArray.GetMTime() for cellArray in cellArrays]))
+        points = polyData.GetPoints()
+        pointsKey = (points.GetMTime(), points.GetData().GetMTime())
+        entry = self.adjacencyCache.get(inputModelNode.GetID())
+        if entry and entry['polyData'] is polyData and entry['key'] == key:
+            if entry['pointsKey'] != pointsKey:
+                entry['geometry'].setPoints(numpy.array(numpy_support.vtk_to_numpy(points.GetData())))
+                entry['pointsKey'] = pointsKey
+            return entry['geometry']
+        pointArray, cellArrays = polyDataToNumpy(polyData)
+        # A copy: the distance graphs must not change under the fields computed on them
+        geometry = MeshGeometry(numpy.array(pointArray), cellArrays, self.topologyCache)
+        self.adjacencyCache[inputModelNode.GetID()] = {'polyData': polyData,
+                                                       'key': key,
+                                                       'pointsKey': pointsKey,
+                                                       'geometry': geometry}
+        return geometry
+
+    @timed
+    def getVertexAdjacency(self, inputModelNode):
+        """ Returns the CSR vertex adjacency (indptr, indices) of the model. """
+        return self.getMeshGeometry(inputModelNode).getAdjacency()
+
+    @timed
+    def getDistanceGraph(self, inputModelNode):
+        """ Returns what the distance fields of the current radius unit are
+        computed on (see distanceGraph). The same object is returned while the
+        mesh is not modified, so landmark distance fields stay valid.
+        """
+        return self.getMeshGeometry(inputModelNode).getDistanceGraph(self.roiDistanceMode)
+
+    def getLocatorCandidates(self, inputModelNode, indexClosestPoint, radius):
+        """ Returns the ids of the points at most radius away from the point
+        indexClosestPoint, from a radius query on the point locator of its
+        MeshGeometry.
+        """
+        return self.getMeshGeometry(inputModelNode).verticesWithinRadius(indexClosestPoint, radius)
+
+    def getNeighborIds(self, inputModelNode, indexClosestPoint, distance):
+        """ Returns the ids of the vertices in the ROI as a numpy array, in
+        the current radius unit. In edges, the ring of direct neighbors is
+        always included, so radius values below 2 give the same ROI as 1.
+        """
+        candidates = None
+        if self.roiDistanceMode == ROI_DISTANCE_EUCLIDEAN and indexClosestPoint >= 0:
+            # Only test the points found by the locator instead of all of them
+            candidates = self.getLocatorCandidates(inputModelNode, indexClosestPoint, distance)
+        return self.getMeshGeometry(inputModelNode).neighborIds(indexClosestPoint, distance, self.roiDistanceMode,
+                                                                candidates)
+
+    @timed
+    def getLandmarkROI(self, inputModelNode, landmarkState):
+        """ Returns the ids of the vertices in the ROI of the landmark, by
+        thresholding its distance field with radiusROI. The field is kept in
+        the landmark state until its indexClosestPoint or the mesh changes,
+        and only computed as far as the radius needs.
+        """
+        geometry = self.getMeshGeometry(inputModelNode)
+        candidates = None
+        if self.roiDistanceMode == ROI_DISTANCE_EUCLIDEAN and landmarkState.indexClosestPoint >= 0:
+            extent = geometry.fieldExtent(landmarkState.indexClosestPoint, landmarkState.distanceField,
+                                          landmarkState.radiusROI, self.roiDistanceMode)
+            if extent is not None:
+                candidates = self.getLocatorCandidates(inputModelNode, landmarkState.indexClosestPoint, extent)
+        field, ids = geometry.landmarkROI(landmarkState.indexClosestPoint, landmarkState.distanceField,
+                                          landmarkState.radiusROI, self.roiDistanceMode, candidates)
+        landmarkState.distanceField = field
+        return ids
+
+    @timed
+    def propagateLandmarkCorrespondent(self, referenceInputModel, propagatedInputModel, landmarkState):
+        """ Shares the array holding the ROI of the landmark with the
+        propagated model and displays the landmark ROI on it. A shared array
+        is already up to date. When the propagated model has its own copy
+        (e.g. from a non correspondent propagation), the reference ROI is
+        written in it, incrementally if possible.
+        """
+        arrayName = self.getROIArrayName(landmarkState)
+        arrayToPropagate = referenceInputModel.GetPolyData().GetPointData().GetArray(arrayName)
+        if arrayToPropagate is None:
+            logging.warning("Pick 'n Paint: no ROI array found, please define one before")
+            return
+        propagatedPolyData = propagatedInputModel.GetPolyData()
+        propagatedArray = propagatedPolyData.GetPointData().GetArray(arrayName)
+        referenceROI = landmarkState.writtenROIs.get(referenceInputModel.GetID())
+        if propagatedArray is arrayToPropagate:
+            propagatedPolyData.Modified()
+        elif propagatedArray is not None and referenceROI is not None:
+            self.updateLandmarkROI(propagatedInputModel, landmarkState, referenceROI[1])
         else:
-            print " NO ROI ARRAY FOUND. PLEASE DEFINE ONE BEFORE."
-            pass
+            propagatedPolyData.GetPointData().AddArray(arrayToPropagate)
+            propagatedPolyData.Modified()
+        self.displayLandmarkROI(propagatedInputModel, landmarkState)
 
-    def propagateNonCorrespondent(self, fidNodeID, fiducialID, fiducialState,  propagatedInput):
-        fidNode = slicer.app.mrmlScene().GetNodeByID(fidNodeID)
-        index = fidNode.GetMarkupIndexByID(fiducialID)
+    def getMeshArrays(self, inputModelNode):
+        """ Returns the N x 3 points (a view on the VTK array) and the
+        (offsets, connectivity) cell arrays of the model.
+        """
+        return polyDataToNumpy(inputModelNode.GetPolyData())
+
+    def applyPropagatedROIs(self, propagatedInput, landmarkStates, rois):
+        """ Writes ROIs computed outside of Slicer, in the order of landmarkStates. """
+        for fiducialState, listID in zip(landmarkStates, rois):
+            self.updateLandmarkROI(propagatedInput, fiducialState, listID)
+
+    @timed
+    def propagateNonCorrespondentBatch(self, activeInputState, propagatedInput):
+        """ Propagates every landmark of the input on one model: the landmarks
+        are snapped with a single locator query pass and their ROIs are grown
+        on the same adjacency. Returns the time spent, in seconds, which is
+        also recorded in the 'propagate:<model name>' timing.
+        """
+        startTime = time.time()
+        fidNode = slicer.app.mrmlScene().GetNodeByID(activeInputState.fidNodeID)
+        activeInputState.updateMarkupIndexes(fidNode)
+        dictionaryLandmark = activeInputState.dictionaryLandmark
+        landmarkIDs = list(dictionaryLandmark.keys())
+        positions = self.getFiducialPositions(fidNode, [activeInputState.getMarkupIndex(fidNode, ID) for ID in landmarkIDs])
+        closestPointIndices = self.findClosestPointIndices(propagatedInput, positions)
+        for landmarkID, indexClosestPoint in zip(landmarkIDs, closestPointIndices):
+            fiducialState = dictionaryLandmark[landmarkID]
+            listID = self.getNeighborIds(propagatedInput, indexClosestPoint, fiducialState.radiusROI)
+            self.updateLandmarkROI(propagatedInput, fiducialState, listID)
+        elapsedTime = time.time() - startTime
+        instrumentation.record('propagate:' + propagatedInput.GetName(), elapsedTime)
+        return elapsedTime
+
+    @timed
+    def propagateNonCorrespondent(self, activeInputState, fiducialID, propagatedInput):
+        fidNode = slicer.app.mrmlScene().GetNodeByID(activeInputState.fidNodeID)
+        fiducialState = activeInputState.dictionaryLandmark[fiducialID]
+        index = activeInputState.getMarkupIndex(fidNode, fiducialID)
         indexClosestPoint = self.getClosestPointIndex(fidNode, propagatedInput, index)
-        listID = self.defineNeighbor(propagatedInput, indexClosestPoint, fiducialState.radiusROI)
-        self.addArrayFromIdList(listID, propagatedInput, fiducialState.arrayName)
-        self.displayROI(propagatedInput, fiducialState.arrayName)
+        listID = self.getNeighborIds(propagatedInput, indexClosestPoint, fiducialState.radiusROI)
+        self.updateLandmarkROI(propagatedInput, fiducialState, listID)
+        self.displayLandmarkROI(propagatedInput, fiducialState)
+
+    def getCorrespondenceMap(self, referenceInputModel, propagatedInputModel, rigid=False):
+        """ Returns the VertexCorrespondence from the reference model to the
+        propagated model, computed again only when the points of one of them
+        change or the rigid alignment is turned on or off.
+        """
+        referencePoints = referenceInputModel.GetPolyData().GetPoints()
+        propagatedPoints = propagatedInputModel.GetPolyData().GetPoints()
+        key = (referencePoints.GetMTime(), referencePoints.GetData().GetMTime(), referencePoints.GetNumberOfPoints(),
+               propagatedPoints.GetMTime(), propagatedPoints.GetData().GetMTime(), propagatedPoints.GetNumberOfPoints(),
+               rigid)
+        mapKey = (referenceInputModel.GetID(), propagatedInputModel.GetID())
+        entry = self.correspondenceMaps.get(mapKey)
+        if entry is None or entry[0] != key:
+            correspondence = VertexCorrespondence(numpy_support.vtk_to_numpy(referencePoints.GetData()),
+                                                  numpy_support.vtk_to_numpy(propagatedPoints.GetData()),
+                                                  rigid)
+            entry = self.correspondenceMaps[mapKey] = (key, correspondence)
+        return entry[1]
+
+    @timed
+    def propagateLandmarkThroughMap(self, referenceInputModel, propagatedInputModel, landmarkState, rigid=False):
+        """ Propagates the ROI of the landmark on a non correspondent model
+        by mapping the reference ROI through the vertex map between the
+        models: no snapping and no ROI growth on the propagated model.
+        """
+        referenceROI = landmarkState.writtenROIs.get(referenceInputModel.GetID())
+        if referenceROI is None:
+            logging.warning("Pick 'n Paint: no ROI array found, please define one before")
+            return
+        correspondence = self.getCorrespondenceMap(referenceInputModel, propagatedInputModel, rigid)
+        self.updateLandmarkROI(propagatedInputModel, landmarkState, correspondence.mapROI(referenceROI[1]))
+        self.displayLandmarkROI(propagatedInputModel, landmarkState)
+
+    @timed
+    def writeROIStatistics(self, writer, referenceInputModel, inputModelNode, landmarkStates, scalarName,
+                           correspondent=True):
+        """ Writes the statistics of the scalar over the ROIs of the landmarks
+        on the model (see roiStatistics). Landmarks without a ROI on the model
+        are skipped.
+        """
+        rois, labels = list(), list()
+        for landmarkState in landmarkStates:
+            written = landmarkState.writtenROIs.get(inputModelNode.GetID())
+            if written is None and correspondent and landmarkState.propagatedBool:
+                # Correspondent propagation shares the ROI array of the reference
+                written = landmarkState.writtenROIs.get(referenceInputModel.GetID())
+            if written is not None:
+                rois.append(written[1])
+                labels.append(landmarkState.fiducialLabel)
+        if not rois:
+            return
+        referencePoints = numpy_support.vtk_to_numpy(referenceInputModel.GetPolyData().GetPoints().GetData())
+        values = meshScalar(inputModelNode.GetPolyData(), scalarName, referencePoints, correspondent)
+        statistics = roiStatistics(values, rois, vertexAreas(*self.getMeshArrays(inputModelNode)))
+        writer.write(inputModelNode.GetName(), labels, scalarName, statistics)
+
+    def releaseDerivedData(self, modelID):
+        """ Drops the caches built for the model: MeshGeometry (adjacency,
+        distance graphs and point locator), vertex maps from or to it,
+        decimated proxy.
+        """
+        self.adjacencyCache.pop(modelID, None)
+        self.proxies.pop(modelID, None)
+        for mapKey in list(self.correspondenceMaps.keys()):
+            if modelID in mapKey:
+                del self.correspondenceMaps[mapKey]
+
+    def getModelDescription(self, inputModelNode):
+        """ Identifies the model in session files, see saveSession. """
+        points, cellArrays = self.getMeshArrays(inputModelNode)
+        return {'id': inputModelNode.GetID(),
+                'name': inputModelNode.GetName(),
+                'hash': meshHash(points, cellArrays),
+                'numberOfPoints': len(points)}
+
+    def findSessionModel(self, description):
+        """ Returns the model node described in a session file: the node
+        with the same ID if it still has the same name, otherwise the first
+        model with that name, or None.
+        """
+        node = slicer.mrmlScene.GetNodeByID(description['id'])
+        if node is not None and node.IsA('vtkMRMLModelNode') and node.GetName() == description['name']:
+            return node
+        nodes = slicer.mrmlScene.GetNodesByClassByName('vtkMRMLModelNode', description['name'])
+        if nodes.GetNumberOfItems() == 0:
+            return None
+        return nodes.GetItemAsObject(0)
+
+    def getDecimatedProxy(self, inputModelNode, fraction):
+        """ Returns the DecimatedProxy of the model, built again only when its
+        points or cells change or for another fraction.
+        """
+        polyData = inputModelNode.GetPolyData()
+        points = polyData.GetPoints()
+        cellArrays = [polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()]
+        key = (points.GetMTime(), points.GetData().GetMTime(), polyData.GetNumberOfPoints(),
+               max([cellArray.GetMTime() for cellArray in cellArrays]), fraction)
+        entry = self.proxies.get(inputModelNode.GetID())
+        if entry is None or entry[0] != key:
+            instrumentation.count('proxyBuilds')
+            proxy = DecimatedProxy(polyData, fraction, self.getVertexAdjacency(inputModelNode))
+            entry = self.proxies[inputModelNode.GetID()] = (key, proxy)
+        return entry[1]
+
+    @timed
+    def previewLandmarkROI(self, inputModelNode, fidNode, markupsIndex, landmarkState, fraction):
+        """ Shows the ROI of the landmark at the current position of its
+        markup, grown on the decimated proxy of the model. The markup is not
+        snapped and indexClosestPoint is left as it is: the full resolution
+        ROI is computed when the landmark is released.
+        """
+        fiducialCoord = numpy.zeros(3)
+        fidNode.GetNthFiducialPosition(markupsIndex, fiducialCoord)
+        proxy = self.getDecimatedProxy(inputModelNode, fraction)
+        listID = proxy.previewROI(fiducialCoord, landmarkState.radiusROI, self.roiDistanceMode)
+        self.updateLandmarkROI(inputModelNode, landmarkState, listID)
+        self.displayLandmarkROI(inputModelNode, landmarkState)
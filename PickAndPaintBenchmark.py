@@ -0,0 +1,308 @@
+""" Benchmark of the Pick 'n Paint hot paths on synthetic meshes, without
+Slicer (needs VTK and numpy).
+
+    python PickAndPaintBenchmark.py --output today.json
+    python PickAndPaintBenchmark.py --output today.json --baseline last-week.json --threshold 1.25
+
+Meshes of --sizes points are generated with vtkSphereSource or by
+subdividing an icosahedron (--surface), and the PickAndPaintCore and
+command line code behind the logic methods is timed on them:
+
+    adjacency                  MeshGeometry.getAdjacency (getVertexAdjacency, cache miss)
+    locatorBuild               MeshGeometry.getLocator, first snap on a model (getClosestPointIndex)
+    closestPoint               MeshGeometry.closestVertices, for --landmarks landmarks (snapLandmarks)
+    roi                        MeshGeometry.neighborIds, in euclidean on the verticesWithinRadius
+                               candidates (getNeighborIds), per --radii and --distance
+    roiThreshold               MeshGeometry.landmarkROI on a cached distance field (getLandmarkROI)
+    writeROI                   writeROIMask (updateLandmarkROI), per storage mode
+    writeROIIncremental        writeROIMask of a landmark moved by one vertex, per storage mode
+    proxyPreview               DecimatedProxy.previewROI, 10% of the vertices (previewLandmarkROI)
+    propagateCorrespondent     PickAndPaintCLI.addROIArrays of the reference ROIs on --cohort meshes
+    propagateNonCorrespondent  PickAndPaintCLI.landmarkROIs on --cohort meshes (propagateNonCorrespondentBatch)
+    propagateInProcesses       CohortPropagationEngine with --processes workers on --cohort meshes
+    propagateThroughMap        VertexCorrespondence built and mapping the ROIs (propagateLandmarkThroughMap)
+
+The logic finds the closest vertices and the euclidean candidates with the
+PointLocator of the MeshGeometry of each model: a scipy k-d tree, or a
+vtkStaticPointLocator when scipy is missing.
+
+Each case is run --repeat times and the median is kept. The results go to
+a JSON file. With --baseline, cases slower than threshold x their baseline
+time are reported and the exit code is 1.
+"""
+import argparse
+import json
+import math
+import platform
+import sys
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from PickAndPaintCore import ROI_STORAGE_LABEL_MAP, ROI_DISTANCE_EUCLIDEAN, polyDataToNumpy, MeshGeometry, \
+    roiMaskDtype, writeROIMask, DecimatedProxy, VertexCorrespondence, CohortPropagationEngine
+from PickAndPaintCLI import STORAGE_MODES, DISTANCE_MODES, landmarkROIs, addROIArrays
+
+# Timings below this many seconds are too noisy to be compared with a ratio
+NOISE_FLOOR = 0.002
+
+
+def makeMesh(numberOfPoints, surface='sphere'):
+    """ Returns a closed triangle mesh of radius 50 mm with about
+    numberOfPoints points.
+    """
+    if surface == 'sphere':
+        # theta x (phi - 2) + 2 points
+        resolution = max(8, int(round(math.sqrt(numberOfPoints))))
+        source = vtk.vtkSphereSource()
+        source.SetRadius(50.0)
+        source.SetThetaResolution(resolution)
+        source.SetPhiResolution(resolution + 2)
+        source.Update()
+        return source.GetOutput()
+    # Icosahedron: 12 points, each loop subdivision multiplies the triangles by 4
+    source = vtk.vtkPlatonicSolidSource()
+    source.SetSolidTypeToIcosahedron()
+    triangles = vtk.vtkTriangleFilter()
+    triangles.SetInputConnection(source.GetOutputPort())
+    cleaner = vtk.vtkCleanPolyData()
+    cleaner.SetInputConnection(triangles.GetOutputPort())
+    subdivision = vtk.vtkLinearSubdivisionFilter()
+    subdivision.SetInputConnection(cleaner.GetOutputPort())
+    subdivision.SetNumberOfSubdivisions(max(0, int(math.ceil(math.log(max(numberOfPoints, 12) / 10.0, 4)))))
+    subdivision.Update()
+    polyData = subdivision.GetOutput()
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    points *= 50.0 / numpy.linalg.norm(points, axis=1)[:, numpy.newaxis]  # Project on the sphere
+    polyData.GetPoints().Modified()
+    return polyData
+
+
+def perturbedCopy(polyData, seed):
+    """ Returns a copy of the mesh with scaled and jittered points, as a non
+    correspondent cohort member would be.
+    """
+    random = numpy.random.RandomState(seed)
+    copy = vtk.vtkPolyData()
+    copy.DeepCopy(polyData)
+    points = numpy_support.vtk_to_numpy(copy.GetPoints().GetData())
+    points *= random.uniform(0.9, 1.1, 3)
+    points += random.normal(0.0, 0.05, points.shape)
+    copy.GetPoints().Modified()
+    return copy
+
+
+def landmarkPositions(polyData, numberOfLandmarks, seed=0):
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    random = numpy.random.RandomState(seed)
+    return points[random.choice(len(points), numberOfLandmarks, replace=False)].astype(numpy.float64)
+
+
+def medianTime(function, repeat):
+    """ Returns the median time of repeat calls of function, in seconds. """
+    times = list()
+    for i in range(0, repeat):
+        startTime = time.time()
+        function()
+        times.append(time.time() - startTime)
+    return float(numpy.median(times))
+
+
+def benchmarkMesh(polyData, args, record):
+    """ Times every case on one mesh. record(case, seconds, **parameters)
+    stores a result.
+    """
+    points, cellArrays = polyDataToNumpy(polyData)
+    numberOfPoints = len(points)
+    record('adjacency', medianTime(lambda: MeshGeometry(points, cellArrays).getAdjacency(), args.repeat))
+    geometry = MeshGeometry(numpy.array(points), cellArrays)
+    adjacency = geometry.getAdjacency()
+
+    record('locatorBuild', medianTime(lambda: MeshGeometry(geometry.points, cellArrays).getLocator(), args.repeat))
+    seeds = geometry.closestVertices(landmarkPositions(polyData, max(args.landmarks)))  # Builds its locator
+    for numberOfLandmarks in args.landmarks:
+        positions = landmarkPositions(polyData, numberOfLandmarks)
+        record('closestPoint', medianTime(lambda: geometry.closestVertices(positions), args.repeat),
+               landmarks=numberOfLandmarks)
+    # Where the first landmark goes when it is dragged by one vertex
+    movedSeed = adjacency[1][adjacency[0][seeds[0]]]
+
+    proxy = DecimatedProxy(polyData, 0.1, adjacency)
+    position = points[seeds[0]].astype(numpy.float64)
+    for distance in args.distance:
+        metric = DISTANCE_MODES[distance]
+        for radius in args.radii:
+            def roi():
+                candidates = None
+                if metric == ROI_DISTANCE_EUCLIDEAN:
+                    candidates = geometry.verticesWithinRadius(seeds[0], radius)
+                return geometry.neighborIds(seeds[0], radius, metric, candidates)
+            record('roi', medianTime(roi, args.repeat), distance=distance, radius=radius)
+            field = geometry.landmarkROI(seeds[0], None, radius, metric)[0]
+            record('roiThreshold', medianTime(lambda: geometry.landmarkROI(seeds[0], field, radius, metric),
+                                              args.repeat),
+                   distance=distance, radius=radius)
+            ids = geometry.neighborIds(seeds[0], radius, metric)
+            movedIds = geometry.neighborIds(movedSeed, radius, metric)
+            for storage, storageMode in sorted(STORAGE_MODES.items()):
+                values = numpy.zeros(numberOfPoints, roiMaskDtype(storageMode))
+                record('writeROI', medianTime(lambda: writeROIMask(values, storageMode, 1, ids), args.repeat),
+                       distance=distance, radius=radius, storage=storage, roiSize=int(ids.size))
+
+                def writeROIIncremental():
+                    writeROIMask(values, storageMode, 1, movedIds, ids)
+                    writeROIMask(values, storageMode, 1, ids, movedIds)
+                record('writeROIIncremental', medianTime(writeROIIncremental, args.repeat) / 2,
+                       distance=distance, radius=radius, storage=storage, roiSize=int(ids.size))
+            record('proxyPreview', medianTime(lambda: proxy.previewROI(position, radius, metric), args.repeat),
+                   distance=distance, radius=radius)
+
+    metric = DISTANCE_MODES[args.distance[0]]
+    for cohortSize in args.cohort:
+        cohort = [perturbedCopy(polyData, seed) for seed in range(0, cohortSize)]
+        for numberOfLandmarks in args.landmarks:
+            landmarkSeeds = seeds[:numberOfLandmarks]
+            positions = points[landmarkSeeds].astype(numpy.float64)
+            radii = [args.radii[0]] * numberOfLandmarks
+            rois = geometry.landmarkROIs(landmarkSeeds, radii, metric)
+            roiLabels = list(range(1, numberOfLandmarks + 1))
+
+            def propagateCorrespondent():
+                for model in cohort:
+                    addROIArrays(model, rois, roiLabels, 'Model', ROI_STORAGE_LABEL_MAP)
+            record('propagateCorrespondent', medianTime(propagateCorrespondent, args.repeat),
+                   cohort=cohortSize, landmarks=numberOfLandmarks)
+
+            def propagateNonCorrespondent():
+                for model in cohort:
+                    landmarkROIs(model, positions, radii, metric)
+            record('propagateNonCorrespondent', medianTime(propagateNonCorrespondent, args.repeat),
+                   cohort=cohortSize, landmarks=numberOfLandmarks, distance=args.distance[0],
+                   radius=args.radii[0])
+
+            def propagateInProcesses():
+                engine = CohortPropagationEngine(args.processes)
+                try:
+                    remaining = list(range(0, cohortSize))
+                    collected = 0
+                    while collected < cohortSize:
+                        while remaining and engine.canSubmit():
+                            index = remaining.pop(0)
+                            modelPoints, modelCells = polyDataToNumpy(cohort[index])
+                            engine.submit(index, modelPoints, modelCells, positions, radii, metric)
+                        for index, result, error in engine.collect():
+                            if error is not None:
+                                raise RuntimeError(error)
+                            collected += 1
+                finally:
+                    engine.shutdown()
+            record('propagateInProcesses', medianTime(propagateInProcesses, args.repeat),
+                   cohort=cohortSize, landmarks=numberOfLandmarks, distance=args.distance[0],
+                   radius=args.radii[0], processes=args.processes)
+
+            def propagateThroughMap():
+                for model in cohort:
+                    modelPoints = numpy_support.vtk_to_numpy(model.GetPoints().GetData())
+                    correspondence = VertexCorrespondence(points, modelPoints)
+                    values = numpy.zeros(len(modelPoints), roiMaskDtype(ROI_STORAGE_LABEL_MAP))
+                    for roiLabel, ids in zip(roiLabels, rois):
+                        writeROIMask(values, ROI_STORAGE_LABEL_MAP, roiLabel, correspondence.mapROI(ids))
+            record('propagateThroughMap', medianTime(propagateThroughMap, args.repeat),
+                   cohort=cohortSize, landmarks=numberOfLandmarks, distance=args.distance[0],
+                   radius=args.radii[0])
+
+
+def caseKey(result):
+    """ Identifies a case across runs: everything but the measures. """
+    return tuple(sorted((name, value) for name, value in result.items()
+                        if name not in ('seconds', 'roiSize', 'points')))
+
+
+def compareToBaseline(results, baseline, threshold):
+    """ Returns the (key, baseline seconds, seconds) of the cases slower than
+    threshold times their baseline.
+    """
+    baselineTimes = dict((caseKey(result), result['seconds']) for result in baseline['results'])
+    regressions = list()
+    for result in results:
+        key = caseKey(result)
+        if key not in baselineTimes:
+            continue
+        reference = max(baselineTimes[key], NOISE_FLOOR)
+        if result['seconds'] > NOISE_FLOOR and result['seconds'] > threshold * reference:
+            regressions.append((key, baselineTimes[key], result['seconds']))
+    return regressions
+
+
+def integerList(text):
+    return [int(value) for value in text.split(',')]
+
+
+def floatList(text):
+    return [float(value) for value in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Pick 'n Paint hot paths on synthetic meshes.")
+    parser.add_argument('--sizes', type=integerList, default=[10000, 100000, 500000, 2000000],
+                        help="comma separated numbers of points of the meshes (default: 10000,100000,500000,2000000)")
+    parser.add_argument('--surface', choices=['sphere', 'subdivided'], default='sphere',
+                        help="vtkSphereSource or subdivided icosahedron (default: sphere)")
+    parser.add_argument('--radii', type=floatList, default=[1.0, 5.0, 20.0],
+                        help="comma separated ROI radii (default: 1,5,20)")
+    parser.add_argument('--distance', type=lambda text: text.split(','), default=['edges'],
+                        help="comma separated radius units among edges, geodesic and euclidean (default: edges)")
+    parser.add_argument('--landmarks', type=integerList, default=[1, 10, 50],
+                        help="comma separated numbers of landmarks (default: 1,10,50)")
+    parser.add_argument('--cohort', type=integerList, default=[1, 10],
+                        help="comma separated numbers of propagated meshes (default: 1,10)")
+    parser.add_argument('--processes', type=int, default=2,
+                        help="worker processes of the propagateInProcesses case (default: 2)")
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each case, the median is kept (default: 5)")
+    parser.add_argument('--output', help="JSON file where the results are written")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare with")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="slowdown ratio reported as a regression (default: 1.25)")
+    args = parser.parse_args(argv)
+    for distance in args.distance:
+        if distance not in DISTANCE_MODES:
+            parser.error("unknown distance '%s'" % distance)
+
+    results = list()
+    for size in args.sizes:
+        polyData = makeMesh(size, args.surface)
+        print("%s of %d points (%d requested)" % (args.surface, polyData.GetNumberOfPoints(), size))
+
+        def record(case, seconds, **parameters):
+            result = dict(parameters, case=case, size=size, points=polyData.GetNumberOfPoints(), seconds=seconds)
+            results.append(result)
+            details = ", ".join("%s=%s" % item for item in sorted(parameters.items()))
+            print("  %-26s %10.3f ms  %s" % (case, 1000.0 * seconds, details))
+        benchmarkMesh(polyData, args, record)
+
+    report = {'environment': {'python': platform.python_version(),
+                              'numpy': numpy.__version__,
+                              'vtk': vtk.vtkVersion.GetVTKVersion(),
+                              'platform': platform.platform(),
+                              'processor': platform.processor()},
+              'settings': {'surface': args.surface, 'repeat': args.repeat},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            json.dump(report, outputFile, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = compareToBaseline(results, baseline, args.threshold)
+        for key, baselineSeconds, seconds in regressions:
+            print("REGRESSION %s: %.3f ms -> %.3f ms" % (dict(key), 1000.0 * baselineSeconds, 1000.0 * seconds))
+        print("%d regressions over %.2fx the baseline" % (len(regressions), args.threshold))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+""" Command line Pick 'n Paint: paints landmark ROIs on a reference mesh and
+propagates them on a directory of meshes, without Slicer.
+
+    python PickAndPaintCLI.py reference.vtk landmarks.fcsv targets/ output/ \
+        --radii 3,5,5 --mode non-correspondent --jobs 8
+
+The landmarks are snapped on the closest vertex of the reference mesh and
+their ROIs are the vertices at most 'radius' away, like in the module: in
+edges, or in mm along the surface (--distance geodesic) or in a straight
+line (--distance euclidean).
+With correspondent meshes the ROIs keep the same vertex ids on every target,
+otherwise the snapped landmarks are snapped again on each target. Meshes are
+read, processed and written one at a time (one per job with --jobs).
+
+With --statistics, the mean, standard deviation, percentiles and area of a
+per-vertex scalar (--scalar: a point data array, or DistanceToReference)
+over each ROI of each mesh are written to a .csv or .parquet file as the
+meshes are processed.
+
+Landmark coordinates are used as they are, in the coordinate system of the
+mesh files.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from PickAndPaintCore import ROI_STORAGE_PER_LANDMARK, ROI_STORAGE_LABEL_MAP, ROI_STORAGE_BITMASK, \
+    ROI_DISTANCE_HOPS, ROI_DISTANCE_GEODESIC, ROI_DISTANCE_EUCLIDEAN, \
+    polyDataToNumpy, MeshGeometry, buildROIArrays, MeshTopologyCache, DISTANCE_TO_REFERENCE, vertexAreas, meshScalar, roiStatistics, \
+    StatisticsWriter
+
+MESH_READERS = {'.vtk': vtk.vtkPolyDataReader,
+                '.vtp': vtk.vtkXMLPolyDataReader,
+                '.stl': vtk.vtkSTLReader,
+                '.ply': vtk.vtkPLYReader,
+                '.obj': vtk.vtkOBJReader}
+
+MESH_WRITERS = {'.vtk': vtk.vtkPolyDataWriter,
+                '.vtp': vtk.vtkXMLPolyDataWriter}
+
+STORAGE_MODES = {'per-landmark': ROI_STORAGE_PER_LANDMARK,
+                 'labels': ROI_STORAGE_LABEL_MAP,
+                 'bitmask': ROI_STORAGE_BITMASK}
+
+DISTANCE_MODES = {'edges': ROI_DISTANCE_HOPS,
+                  'geodesic': ROI_DISTANCE_GEODESIC,
+                  'euclidean': ROI_DISTANCE_EUCLIDEAN}
+
+
+def readMesh(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in MESH_READERS:
+        raise ValueError("Unsupported mesh format: " + path)
+    reader = MESH_READERS[extension]()
+    reader.SetFileName(path)
+    reader.Update()
+    polyData = reader.GetOutput()
+    if polyData is None or polyData.GetNumberOfPoints() == 0:
+        raise ValueError("Could not read a mesh from " + path)
+    return polyData
+
+
+def writeMesh(polyData, path):
+    writer = MESH_WRITERS[os.path.splitext(path)[1].lower()]()
+    writer.SetFileName(path)
+    writer.SetInputData(polyData)
+    if hasattr(writer, 'SetFileTypeToBinary'):
+        writer.SetFileTypeToBinary()
+    writer.Write()
+
+
+def readLandmarks(path):
+    """ Returns the labels, the N x 3 positions and the radii (None when the
+    file does not give them) of the landmarks of a Slicer .fcsv file, a Slicer
+    markups .json file or a JSON list of {"label", "position", "radius"}.
+    """
+    labels, positions, radii = list(), list(), list()
+    if path.lower().endswith('.fcsv'):
+        with open(path) as landmarkFile:
+            for row in csv.reader(line for line in landmarkFile if not line.startswith('#')):
+                if len(row) < 4:
+                    continue
+                positions.append([float(value) for value in row[1:4]])
+                labels.append(row[11] if len(row) > 11 else str(len(labels) + 1))
+                radii.append(None)
+    else:
+        with open(path) as landmarkFile:
+            content = json.load(landmarkFile)
+        if isinstance(content, dict):
+            points = list()
+            for markup in content.get('markups', []):
+                points.extend(markup.get('controlPoints', []))
+        else:
+            points = content
+        for point in points:
+            positions.append([float(value) for value in point['position']])
+            labels.append(point.get('label', str(len(labels) + 1)))
+            radii.append(point.get('radius'))
+    return labels, numpy.array(positions, numpy.float64).reshape(-1, 3), radii
+
+
+def landmarkROIs(polyData, positions, radii, metric=ROI_DISTANCE_HOPS, topologyCache=None):
+    """ Snaps the landmarks on the mesh and returns the closest point index
+    and the ROI ids of each of them.
+    """
+    geometry = MeshGeometry(*polyDataToNumpy(polyData), topologyCache=topologyCache)
+    indices = geometry.closestVertices(positions)
+    return indices, geometry.landmarkROIs(indices, radii, metric)
+
+
+def addROIArrays(polyData, rois, roiLabels, modelName, storageMode):
+    for arrayName, values in buildROIArrays(polyData.GetNumberOfPoints(), rois, roiLabels, modelName, storageMode):
+        array = numpy_support.numpy_to_vtk(values, deep=1)
+        array.SetName(arrayName)
+        polyData.GetPointData().AddArray(array)
+
+
+def outputPath(outputDirectory, meshPath, outputFormat):
+    name = os.path.splitext(os.path.basename(meshPath))[0]
+    return os.path.join(outputDirectory, name + '.' + outputFormat)
+
+
+def meshStatistics(polyData, rois, settings):
+    """ Returns the statistics of the --scalar over the ROIs of the mesh,
+    or None without --statistics.
+    """
+    if not settings['scalar']:
+        return None
+    values = meshScalar(polyData, settings['scalar'], settings['referencePoints'], settings['correspondent'])
+    return roiStatistics(values, rois, vertexAreas(*polyDataToNumpy(polyData)))
+
+
+def processTarget(task):
+    """ Paints the ROIs on one target mesh and writes it. Runs in the worker
+    processes with --jobs. Returns the mesh path, an error message or None,
+    the time spent and the ROI statistics (or None).
+    """
+    meshPath, settings = task
+    startTime = time.time()
+    try:
+        polyData = readMesh(meshPath)
+        if settings['correspondent']:
+            if polyData.GetNumberOfPoints() != settings['numberOfPoints']:
+                return meshPath, "not correspondent to the reference (different number of points)", 0.0, None
+            rois = settings['rois']
+        else:
+            rois = landmarkROIs(polyData, settings['positions'], settings['radii'], settings['metric'],
+                                settings['topologyCache'])[1]
+        statistics = meshStatistics(polyData, rois, settings)
+        addROIArrays(polyData, rois, settings['roiLabels'], settings['modelName'], settings['storageMode'])
+        writeMesh(polyData, outputPath(settings['outputDirectory'], meshPath, settings['outputFormat']))
+    except Exception as e:
+        return meshPath, str(e), time.time() - startTime, None
+    return meshPath, None, time.time() - startTime, statistics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Paint landmark ROIs on a reference mesh and propagate them "
+                                                 "on a directory of meshes.")
+    parser.add_argument('reference', help="reference mesh (.vtk, .vtp, .stl, .ply or .obj)")
+    parser.add_argument('landmarks', help="landmarks placed on the reference mesh (.fcsv or .json)")
+    parser.add_argument('targets', help="directory of the meshes to propagate the ROIs on")
+    parser.add_argument('output', help="directory where the ROI-annotated meshes are written")
+    parser.add_argument('--radius', type=float, default=1.0,
+                        help="radius of the ROIs, for the landmarks without one (default: 1)")
+    parser.add_argument('--radii', help="comma separated radius of each landmark, in the order of the file")
+    parser.add_argument('--distance', choices=['edges', 'geodesic', 'euclidean'], default='edges',
+                        help="unit of the radii: number of edges, or mm along the surface edges or "
+                             "in a straight line (default: edges)")
+    parser.add_argument('--mode', choices=['correspondent', 'non-correspondent'], default='non-correspondent',
+                        help="correspondent meshes share the vertex ids of the reference (default: non-correspondent)")
+    parser.add_argument('--storage', choices=sorted(STORAGE_MODES.keys()), default='per-landmark',
+                        help="one array per landmark, one label map or one bitmask (default: per-landmark)")
+    parser.add_argument('--format', choices=['vtk', 'vtp'], default='vtp', dest='outputFormat',
+                        help="format of the written meshes (default: vtp)")
+    parser.add_argument('--cache', help="directory caching the adjacency and edge lengths of the meshes "
+                                        "between runs (default: no cache)")
+    parser.add_argument('--cache-size', type=int, default=2048, dest='cacheSize',
+                        help="size of the cache directory, in MB (default: 2048)")
+    parser.add_argument('--statistics', help="file (.csv, or .parquet with pyarrow) receiving the statistics "
+                                             "of --scalar over each ROI of each mesh")
+    parser.add_argument('--scalar', default=DISTANCE_TO_REFERENCE,
+                        help="point data array the statistics are computed on, or %s (default)"
+                             % DISTANCE_TO_REFERENCE)
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="number of meshes processed in parallel")
+    args = parser.parse_args(argv)
+
+    labels, positions, fileRadii = readLandmarks(args.landmarks)
+    if len(positions) == 0:
+        parser.error("no landmark found in " + args.landmarks)
+    if args.radii:
+        radii = [float(value) for value in args.radii.split(',')]
+        if len(radii) != len(positions):
+            parser.error("--radii gives %d values for %d landmarks" % (len(radii), len(positions)))
+    else:
+        radii = [args.radius if radius is None else float(radius) for radius in fileRadii]
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    try:
+        statisticsWriter = StatisticsWriter(args.statistics) if args.statistics else None
+    except (ValueError, IOError) as e:
+        parser.error(str(e))
+
+    # Reference: snap the landmarks on the surface and paint their ROIs
+    reference = readMesh(args.reference)
+    referencePoints = numpy_support.vtk_to_numpy(reference.GetPoints().GetData())
+    metric = DISTANCE_MODES[args.distance]
+    topologyCache = MeshTopologyCache(args.cache, args.cacheSize * 1024 * 1024) if args.cache else None
+    indices, rois = landmarkROIs(reference, positions, radii, metric, topologyCache)
+    modelName = os.path.splitext(os.path.basename(args.reference))[0]
+    roiLabels = list(range(1, len(positions) + 1))
+    storageMode = STORAGE_MODES[args.storage]
+    # The distance to the reference needs its points in every worker
+    scalar = args.scalar if statisticsWriter else None
+    distanceReference = numpy.array(referencePoints) if scalar == DISTANCE_TO_REFERENCE else None
+    statistics = meshStatistics(reference, rois, {'scalar': scalar,
+                                                  'referencePoints': distanceReference,
+                                                  'correspondent': True})
+    if statistics is not None:
+        statisticsWriter.write(modelName, labels, scalar, statistics)
+    addROIArrays(reference, rois, roiLabels, modelName, storageMode)
+    writeMesh(reference, outputPath(args.output, args.reference, args.outputFormat))
+    for label, radius, roi in zip(labels, radii, rois):
+        print("%s: radius %g, %d vertices" % (label, radius, len(roi)))
+
+    settings = {'correspondent': args.mode == 'correspondent',
+                'numberOfPoints': reference.GetNumberOfPoints(),
+                'rois': rois,
+                'positions': referencePoints[indices],  # snapped landmarks
+                'radii': radii,
+                'metric': metric,
+                'topologyCache': topologyCache,
+                'scalar': scalar,
+                'referencePoints': distanceReference,
+                'roiLabels': roiLabels,
+                'modelName': modelName,
+                'storageMode': storageMode,
+                'outputDirectory': args.output,
+                'outputFormat': args.outputFormat}
+    referencePath = os.path.abspath(args.reference)
+    meshPaths = [os.path.join(args.targets, name) for name in sorted(os.listdir(args.targets))
+                 if os.path.splitext(name)[1].lower() in MESH_READERS
+                 and os.path.abspath(os.path.join(args.targets, name)) != referencePath]
+    tasks = ((meshPath, settings) for meshPath in meshPaths)
+
+    failures = 0
+    startTime = time.time()
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap_unordered(processTarget, tasks)
+    else:
+        pool = None
+        results = (processTarget(task) for task in tasks)
+    for count, (meshPath, error, elapsedTime, statistics) in enumerate(results):
+        if error:
+            failures += 1
+            print("[%d/%d] %s: FAILED, %s" % (count + 1, len(meshPaths), meshPath, error))
+        else:
+            print("[%d/%d] %s: %.3f s" % (count + 1, len(meshPaths), meshPath, elapsedTime))
+        if statistics is not None:
+            statisticsWriter.write(os.path.splitext(os.path.basename(meshPath))[0], labels, scalar, statistics)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if statisticsWriter is not None:
+        statisticsWriter.close()
+    print("%d meshes in %.1f s, %d failed" % (len(meshPaths), time.time() - startTime, failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
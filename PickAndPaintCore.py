@@ -0,0 +1,1411 @@
+""" Mesh computations of Pick 'n Paint that only need VTK and numpy.
+
+Nothing here imports slicer or qt, so these functions can run in worker
+processes and outside of Slicer. They work on plain arrays (N x 3 points,
+(offsets, connectivity) cell arrays) and return vertex id arrays or ROI
+masks; PickAndPaintLogic only moves data between them and the MRML nodes.
+
+    geometry = MeshGeometry(*polyDataToNumpy(polyData))
+    indices = geometry.closestVertices(positions)
+    rois = geometry.landmarkROIs(indices, radii, ROI_DISTANCE_GEODESIC)
+    values = numpy.zeros(len(geometry.points), numpy.uint16)
+    for label, ids in enumerate(rois, 1):
+        writeROIMask(values, ROI_STORAGE_LABEL_MAP, label, ids)
+"""
+import csv
+import hashlib
+import heapq
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+from PickAndPaintInstrumentation import instrumentation, timed
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # Closest vertex maps fall back on a VTK point locator
+    cKDTree = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # ROI statistics can only be written to .csv files
+    pyarrow = None
+
+# Largest value of the radius slider, in edges and in mm
+MAXIMUM_RADIUS_ROI = 20.0
+MAXIMUM_RADIUS_ROI_MM = 200.0
+
+#  Storage of the ROI arrays on a model
+ROI_STORAGE_PER_LANDMARK = 0  # One 0/1 array per landmark: <model>_<n>_ROI
+ROI_STORAGE_LABEL_MAP = 1     # One uint16 array, label n on the vertices of landmark n: <model>_ROI_Labels
+                              # (the last landmark painted on a vertex wins, see writeROIMask)
+ROI_STORAGE_BITMASK = 2       # One uint32/uint64 array, bit n-1 set for landmark n: <model>_ROI_Bits
+
+#  Meaning of the ROI radius
+ROI_DISTANCE_HOPS = 0       # Number of edges from the landmark vertex
+ROI_DISTANCE_GEODESIC = 1   # Shortest path along the edges, in mm
+ROI_DISTANCE_EUCLIDEAN = 2  # Straight line distance (sphere around the landmark), in mm
+
+# Encodings of the ROIs in session files, see packROI
+ROI_PACKED_IDS = 0   # Sorted uint32 vertex ids
+ROI_PACKED_BITS = 1  # One bit per vertex (numpy.packbits)
+
+SESSION_VERSION = 1
+
+# Scalar of the ROI statistics computed from the meshes instead of read from a point data array
+DISTANCE_TO_REFERENCE = 'DistanceToReference'
+STATISTICS_PERCENTILES = (5, 25, 50, 75, 95)
+STATISTICS_COLUMNS = ('model', 'landmark', 'scalar', 'vertices', 'area', 'mean', 'std', 'min') + \
+    tuple('p%d' % percentile for percentile in STATISTICS_PERCENTILES) + ('max',)
+
+
+def cellArrayToNumpy(cellArray):
+    """ Returns the offsets and the connectivity of a vtkCellArray as int64 arrays:
+    the points of cell i are connectivity[offsets[i]:offsets[i+1]].
+    """
+    if hasattr(cellArray, 'GetOffsetsArray'):  # VTK >= 9
+        offsets = numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray())
+        connectivity = numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray())
+        return offsets.astype(numpy.int64), connectivity.astype(numpy.int64)
+
+    numberOfCells = cellArray.GetNumberOfCells()
+    if numberOfCells == 0:
+        return numpy.zeros(1, numpy.int64), numpy.zeros(0, numpy.int64)
+    legacy = numpy_support.vtk_to_numpy(cellArray.GetData()).astype(numpy.int64)
+    # Legacy layout: [n, id_0, ..., id_n-1, n, ...]
+    cellSize = legacy[0]
+    if legacy.size == numberOfCells * (cellSize + 1) and (legacy[::cellSize + 1] == cellSize).all():
+        offsets = numpy.arange(numberOfCells + 1, dtype=numpy.int64) * cellSize
+        connectivity = legacy.reshape(numberOfCells, cellSize + 1)[:, 1:].ravel()
+        return offsets, connectivity
+    # Mixed cell sizes: walk the records once to find where each one starts
+    sizes = numpy.empty(numberOfCells, numpy.int64)
+    location = 0
+    for i in range(0, numberOfCells):
+        sizes[i] = legacy[location]
+        location += sizes[i] + 1
+    offsets = numpy.zeros(numberOfCells + 1, numpy.int64)
+    offsets[1:] = numpy.cumsum(sizes)
+    isPointId = numpy.ones(legacy.size, bool)
+    isPointId[offsets[:-1] + numpy.arange(numberOfCells)] = False
+    return offsets, legacy[isPointId]
+
+
+def polyDataToNumpy(polyData):
+    """ Returns the N x 3 points of a vtkPolyData (a view on the VTK array)
+    and the (offsets, connectivity) arrays of its verts, lines, polys and
+    strips.
+    """
+    points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+    cellArrays = [cellArrayToNumpy(cellArray) for cellArray in
+                  [polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()]]
+    return points, cellArrays
+
+
+@timed
+def buildVertexAdjacency(numberOfPoints, cellArrays):
+    """ Builds the vertex adjacency of a mesh in compressed sparse row form.
+
+    cellArrays is a list of (offsets, connectivity) pairs as returned by
+    cellArrayToNumpy. Two vertices are neighbors when they share a cell, like
+    with vtkPolyData.GetPointCells/GetCellPoints. The neighbors of vertex i are
+    indices[indptr[i]:indptr[i+1]], sorted and without duplicates.
+    """
+    keys = list()
+    for offsets, connectivity in cellArrays:
+        sizes = numpy.diff(offsets)
+        for cellSize in numpy.unique(sizes):
+            if cellSize < 2:
+                continue
+            starts = offsets[:-1][sizes == cellSize]
+            cells = connectivity[starts[:, numpy.newaxis] + numpy.arange(cellSize)]
+            for a in range(0, cellSize):
+                for b in range(0, cellSize):
+                    if a != b:
+                        keys.append(cells[:, a] * numberOfPoints + cells[:, b])
+    if keys:
+        keys = sortedUnique(numpy.concatenate(keys))
+    else:
+        keys = numpy.zeros(0, numpy.int64)
+    rows = keys // numberOfPoints
+    indices = keys % numberOfPoints
+    indptr = numpy.zeros(numberOfPoints + 1, numpy.int64)
+    indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=numberOfPoints))
+    return indptr, indices
+
+
+def sortedUnique(values):
+    """ Same as numpy.unique for a 1D integer array, through a plain sort. """
+    values = numpy.sort(values)
+    if values.size:
+        keep = numpy.ones(values.size, bool)
+        keep[1:] = values[1:] != values[:-1]
+        values = values[keep]
+    return values
+
+
+def gatherNeighbors(indptr, indices, vertices):
+    """ Returns the concatenated neighbor lists of the given vertices. """
+    starts = indptr[vertices]
+    lengths = indptr[vertices + 1] - starts
+    positions = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+    positions += numpy.arange(positions.size)
+    return indices[positions]
+
+
+@timed
+def hopDistanceField(indptr, indices, seed, maxHops):
+    """ Returns the vertices at most maxHops edges away from seed, sorted by
+    distance (seed first), and their distance in edges as a uint8 array.
+
+    Frontier-only breadth first search: each ring only expands the vertices
+    found by the previous one.
+    """
+    visited = numpy.zeros(indptr.size - 1, bool)
+    visited[seed] = True
+    frontier = numpy.array([seed], numpy.int64)
+    rings = [frontier]
+    for hop in range(0, maxHops):
+        neighbors = gatherNeighbors(indptr, indices, frontier)
+        frontier = sortedUnique(neighbors[~visited[neighbors]])
+        if frontier.size == 0:
+            break
+        visited[frontier] = True
+        rings.append(frontier)
+    distances = numpy.concatenate([numpy.full(ring.size, hop, numpy.uint8) for hop, ring in enumerate(rings)])
+    return numpy.concatenate(rings), distances
+
+
+def hopNeighborhood(indptr, indices, seed, hops):
+    """ Returns the vertices at most 'hops' edges away from seed, seed first. """
+    return hopDistanceField(indptr, indices, seed, hops)[0]
+
+
+@timed
+def buildEdgeLengths(points, indptr, indices):
+    """ Returns the length of each edge of the CSR adjacency, aligned with
+    indices, as float32.
+    """
+    rows = numpy.repeat(numpy.arange(indptr.size - 1), numpy.diff(indptr))
+    offsets = numpy.asarray(points[indices], numpy.float64) - points[rows]
+    return numpy.sqrt(numpy.einsum('ij,ij->i', offsets, offsets)).astype(numpy.float32)
+
+
+@timed
+def geodesicDistanceField(indptr, indices, edgeLengths, seed, maxDistance):
+    """ Returns the vertices whose shortest path along the edges to seed is
+    at most maxDistance long, sorted by distance (seed first), and their
+    distance as a float32 array.
+
+    Dijkstra with a binary heap, bounded by maxDistance: vertices farther
+    away are never pushed, so the cost depends on the size of the ROI and
+    not on the size of the mesh.
+    """
+    bestDistances = {seed: 0.0}
+    settled, settledDistances = list(), list()
+    heap = [(0.0, seed)]
+    while heap:
+        distance, vertex = heapq.heappop(heap)
+        if distance > bestDistances[vertex]:
+            continue  # Outdated entry, the vertex was reached by a shorter path
+        settled.append(vertex)
+        settledDistances.append(distance)
+        start, end = int(indptr[vertex]), int(indptr[vertex + 1])
+        for neighbor, length in zip(indices[start:end].tolist(), edgeLengths[start:end].tolist()):
+            candidate = distance + length
+            if candidate <= maxDistance and candidate < bestDistances.get(neighbor, numpy.inf):
+                bestDistances[neighbor] = candidate
+                heapq.heappush(heap, (candidate, neighbor))
+    return numpy.array(settled, numpy.int64), numpy.array(settledDistances, numpy.float32)
+
+
+@timed
+def euclideanDistanceField(points, seed, maxDistance, candidates=None):
+    """ Returns the vertices at most maxDistance away from seed in a straight
+    line, sorted by distance (seed first), and their distance as a float32
+    array. candidates restricts the search, e.g. to the result of a point
+    locator radius query. Otherwise all the points are tested.
+    """
+    if candidates is None:
+        candidates = numpy.arange(len(points))
+    offsets = numpy.asarray(points[candidates], numpy.float64) - points[seed]
+    distances = numpy.sqrt(numpy.einsum('ij,ij->i', offsets, offsets))
+    inside = distances <= maxDistance
+    candidates, distances = candidates[inside], distances[inside]
+    order = numpy.argsort(distances, kind='mergesort')
+    return candidates[order].astype(numpy.int64), distances[order].astype(numpy.float32)
+
+
+def loadOrBuild(cache, key, names, build):
+    """ Returns the list of arrays named names, from the MeshTopologyCache
+    cache for the mesh key, or from build() and then stored in the cache.
+    Without cache or key, simply returns build().
+    """
+    if cache is None or key is None:
+        return build()
+    arrays = cache.load(key, names)
+    if arrays is not None:
+        return [arrays[name] for name in names]
+    values = build()
+    cache.store(key, dict(zip(names, values)))
+    return values
+
+
+def loadOrBuildVertexAdjacency(numberOfPoints, cellArrays, cache=None, key=None):
+    """ buildVertexAdjacency, through the on-disk cache when given one. """
+    return tuple(loadOrBuild(cache, key, ['indptr', 'indices'],
+                             lambda: buildVertexAdjacency(numberOfPoints, cellArrays)))
+
+
+def distanceGraph(metric, points, adjacency, cache=None, key=None):
+    """ Returns what the distance fields of the metric are computed on: the
+    (indptr, indices) adjacency for edge hops, the adjacency and its edge
+    lengths for geodesic distances, the points for euclidean distances.
+    Edge lengths go through the on-disk cache when given one.
+    """
+    if metric == ROI_DISTANCE_HOPS:
+        return adjacency
+    if metric == ROI_DISTANCE_GEODESIC:
+        edgeLengths = loadOrBuild(cache, key, ['edgeLengths'],
+                                  lambda: [buildEdgeLengths(points, adjacency[0], adjacency[1])])[0]
+        return (adjacency[0], adjacency[1], edgeLengths)
+    return points
+
+
+def distanceField(metric, graph, seed, maxDistance, candidates=None):
+    """ Returns the vertices around seed up to maxDistance and their distance
+    for the metric, computed on the distanceGraph of the metric.
+    """
+    if metric == ROI_DISTANCE_HOPS:
+        return hopDistanceField(graph[0], graph[1], seed, int(maxDistance))
+    if metric == ROI_DISTANCE_GEODESIC:
+        return geodesicDistanceField(graph[0], graph[1], graph[2], seed, maxDistance)
+    return euclideanDistanceField(graph, seed, maxDistance, candidates)
+
+
+def maximumRadius(metric):
+    """ Largest ROI radius in the unit of the metric. """
+    return MAXIMUM_RADIUS_ROI if metric == ROI_DISTANCE_HOPS else MAXIMUM_RADIUS_ROI_MM
+
+
+def roiThreshold(metric, radius):
+    """ Largest distance of a vertex in the ROI. In edge hops, the ring of
+    direct neighbors is always included, so radius values below 2 give the
+    same ROI as 1.
+    """
+    if metric == ROI_DISTANCE_HOPS:
+        return max(1, int(radius))
+    return radius
+
+
+def roiNeighborhood(metric, graph, seed, radius, candidates=None):
+    """ Returns the vertices of the ROI of the given radius around seed, seed
+    first. candidates restricts the euclidean search (see distanceField).
+    """
+    return distanceField(metric, graph, seed, roiThreshold(metric, radius), candidates)[0]
+
+
+def distanceFieldExtent(graph, indexClosestPoint, field, maxDistance):
+    """ Returns how far the distance field of a landmark has to be computed
+    to reach maxDistance, or None when field already does. A field only
+    missing distance goes twice as far as before, so dragging the radius
+    slider up computes it again a few times only.
+    """
+    if field is None or field[0] != indexClosestPoint or field[1] is not graph:
+        return maxDistance
+    if field[4] < maxDistance:
+        return max(maxDistance, 2 * field[4])
+    return None
+
+
+def updateDistanceField(graph, indexClosestPoint, field, metric=ROI_DISTANCE_HOPS, candidates=None,
+                        maxDistance=MAXIMUM_RADIUS_ROI):
+    """ Returns field, the (indexClosestPoint, graph, ids, distances, extent)
+    distance field of a landmark: the vertices up to extent from it. It is
+    recomputed when missing, computed for another point or distance graph,
+    or not reaching maxDistance (see distanceFieldExtent). candidates must
+    hold the vertices up to that extent.
+    """
+    extent = distanceFieldExtent(graph, indexClosestPoint, field, maxDistance)
+    if extent is None:
+        return field
+    if indexClosestPoint < 0:
+        ids, distances = numpy.zeros(0, numpy.int64), numpy.zeros(0, numpy.float32)
+    else:
+        instrumentation.count('distanceFields')
+        ids, distances = distanceField(metric, graph, indexClosestPoint, extent, candidates)
+    return (indexClosestPoint, graph, ids, distances, extent)
+
+
+def computeLandmarkROI(graph, indexClosestPoint, field, radius, metric=ROI_DISTANCE_HOPS):
+    """ Returns the up to date distance field of a landmark and the ids of
+    the vertices of its ROI for the given radius. Only uses numpy, so it can
+    run outside of the main thread.
+    """
+    threshold = roiThreshold(metric, radius)
+    field = updateDistanceField(graph, indexClosestPoint, field, metric, maxDistance=threshold)
+    return field, field[2][field[3] <= threshold]
+
+
+@timed
+def meshHash(points, cellArrays):
+    """ Returns a hex digest of the points and (offsets, connectivity) cell
+    arrays of a mesh. Two meshes with the same hash have the same geometry
+    and topology, whatever node or file they come from.
+    """
+    hasher = hashlib.sha1()
+    for array in [points] + [array for cellArray in cellArrays for array in cellArray]:
+        array = numpy.ascontiguousarray(array)
+        hasher.update(str((array.dtype.str, array.shape)).encode('ascii'))
+        hasher.update(array.view(numpy.uint8).reshape(-1))
+    return hasher.hexdigest()
+
+
+class MeshTopologyCache(object):
+    """ Directory of .npy files holding arrays derived from meshes (CSR
+    adjacency, edge lengths), one sub-directory per meshHash. Arrays are
+    loaded memory-mapped, so a known mesh costs a hash and a few file opens
+    instead of a rebuild.
+
+    When the directory grows over maximumSize bytes, the least recently
+    loaded meshes are removed.
+    """
+    def __init__(self, directory, maximumSize=2 * 1024 * 1024 * 1024):
+        self.directory = directory
+        self.maximumSize = maximumSize
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def load(self, key, names):
+        """ Returns the arrays of the mesh key as a dict of read-only
+        memory-maps, or None if one of them is not in the cache.
+        """
+        meshDirectory = os.path.join(self.directory, key)
+        arrays = dict()
+        try:
+            for name in names:
+                arrays[name] = numpy.load(os.path.join(meshDirectory, name + '.npy'), mmap_mode='r')
+            os.utime(meshDirectory, None)  # Least recently loaded meshes are evicted first
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            instrumentation.count('topologyCacheMisses')
+            return None
+        self.hits += 1
+        instrumentation.count('topologyCacheHits')
+        return arrays
+
+    def store(self, key, arrays):
+        """ Writes the arrays (dict of name to numpy array) of the mesh key.
+        Files are written under a temporary name and renamed, so concurrent
+        Slicer sessions never load half written arrays.
+        """
+        meshDirectory = os.path.join(self.directory, key)
+        try:
+            if not os.path.isdir(meshDirectory):
+                os.makedirs(meshDirectory)
+            for name, array in arrays.items():
+                path = os.path.join(meshDirectory, name + '.npy')
+                temporaryPath = path + '.%d.tmp' % os.getpid()
+                with open(temporaryPath, 'wb') as arrayFile:
+                    numpy.save(arrayFile, numpy.ascontiguousarray(array))
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(temporaryPath, path)
+        except (IOError, OSError):
+            return False  # The cache is an optimization: a full or read-only disk is not an error
+        self.evict(keepKey=key)
+        return True
+
+    def entries(self):
+        """ Returns the (last load time, size in bytes, key) of the cached meshes. """
+        entries = list()
+        for key in os.listdir(self.directory):
+            meshDirectory = os.path.join(self.directory, key)
+            if not os.path.isdir(meshDirectory):
+                continue
+            size = sum(os.path.getsize(os.path.join(meshDirectory, name)) for name in os.listdir(meshDirectory))
+            entries.append((os.path.getmtime(meshDirectory), size, key))
+        return entries
+
+    def size(self):
+        return sum(entry[1] for entry in self.entries())
+
+    def evict(self, keepKey=None):
+        entries = sorted(self.entries())
+        totalSize = sum(entry[1] for entry in entries)
+        for loadTime, size, key in entries:
+            if totalSize <= self.maximumSize:
+                break
+            if key == keepKey:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            totalSize -= size
+
+    def setMaximumSize(self, maximumSize):
+        self.maximumSize = maximumSize
+        self.evict()
+
+    def clear(self):
+        for loadTime, size, key in self.entries():
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def getStatistics(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': self.size(),
+                'maximumSize': self.maximumSize}
+
+
+def roiDifference(previousIds, ids):
+    """ Returns the vertices entering (added) and leaving (removed) a ROI
+    going from previousIds to ids, both arrays of unique vertex ids.
+    """
+    added = numpy.setdiff1d(ids, previousIds, assume_unique=True)
+    removed = numpy.setdiff1d(previousIds, ids, assume_unique=True)
+    return added, removed
+
+
+def pointsToPolyData(points):
+    """ Returns a vtkPolyData holding a copy of the N x 3 points and no cells. """
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(points, numpy.float64), deep=1))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    return polyData
+
+
+class PointLocator(object):
+    """ Closest point queries on N x 3 points, with a k-d tree (scipy) or a
+    VTK static point locator. Build one per point set and query it as many
+    times as needed.
+    """
+    bytesPerPoint = 16  # rough size of the bucket structure of the VTK locator for one point
+
+    def __init__(self, points):
+        instrumentation.count('locatorBuilds')
+        self.tree = None
+        self.locator = None
+        if cKDTree is not None:
+            self.tree = cKDTree(points)
+        else:
+            self.polyData = pointsToPolyData(points)
+            self.locator = vtk.vtkStaticPointLocator()
+            self.locator.SetDataSet(self.polyData)
+            self.locator.BuildLocator()
+
+    def query(self, positions):
+        """ Index of the closest point of each row of the M x 3 positions. """
+        positions = numpy.asarray(positions, numpy.float64).reshape(-1, 3)
+        if self.tree is not None:
+            return self.tree.query(positions)[1].astype(numpy.int64)
+        return numpy.fromiter((self.locator.FindClosestPoint(position) for position in positions.tolist()),
+                              numpy.int64, len(positions))
+
+    def queryRadius(self, position, radius):
+        """ Sorted indices of the points at most radius away from position. """
+        if self.tree is not None:
+            return numpy.sort(numpy.asarray(self.tree.query_ball_point(position, radius), numpy.int64))
+        idList = vtk.vtkIdList()
+        self.locator.FindPointsWithinRadius(radius, position, idList)
+        return numpy.sort(numpy.fromiter((idList.GetId(i) for i in range(0, idList.GetNumberOfIds())),
+                                         numpy.int64, idList.GetNumberOfIds()))
+
+    def getMemorySize(self):
+        """ Estimated bytes of the tree, or of the VTK locator and its copy of the points. """
+        if self.tree is not None:
+            return memorySize(self.tree.data, self.tree.indices)
+        return memorySize(self.polyData) + self.polyData.GetNumberOfPoints() * self.bytesPerPoint
+
+
+@timed
+def closestVertexMap(points, targetPoints):
+    """ Returns the index of the closest of the targetPoints for each of the
+    points (see PointLocator).
+    """
+    return PointLocator(targetPoints).query(points)
+
+
+@timed
+def rigidAlignment(points, targetPoints, maximumIterations=50):
+    """ Returns points moved by the rigid transform aligning them on
+    targetPoints (vtkIterativeClosestPointTransform, centroids matched first).
+    """
+    # The target needs cells for the cell locator of the transform
+    vertices = vtk.vtkVertexGlyphFilter()
+    vertices.SetInputData(pointsToPolyData(targetPoints))
+    vertices.Update()
+    icp = vtk.vtkIterativeClosestPointTransform()
+    icp.SetSource(pointsToPolyData(points))
+    icp.SetTarget(vertices.GetOutput())
+    icp.GetLandmarkTransform().SetModeToRigidBody()
+    icp.StartByMatchingCentroidsOn()
+    icp.SetMaximumNumberOfIterations(maximumIterations)
+    icp.SetMaximumNumberOfLandmarks(min(len(points), 1000))
+    icp.Update()
+    matrix = numpy.array([[icp.GetMatrix().GetElement(row, column) for column in range(0, 4)]
+                          for row in range(0, 4)])
+    return numpy.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+
+
+class VertexCorrespondence(object):
+    """ Vertex map between a reference mesh and a non correspondent target
+    mesh, to propagate ROIs without snapping landmarks or growing ROIs on
+    the target.
+
+    referenceToTarget holds the closest target vertex of each reference
+    vertex. The target vertices are also grouped by their closest reference
+    vertex (CSR indptr, indices), so that dense targets have no hole in the
+    propagated ROIs. Mapping a ROI is a gather of O(ROI size).
+    """
+    def __init__(self, referencePoints, targetPoints, rigid=False):
+        if rigid:
+            referencePoints = rigidAlignment(referencePoints, targetPoints)
+        self.referenceToTarget = closestVertexMap(referencePoints, targetPoints)
+        targetToReference = closestVertexMap(targetPoints, referencePoints)
+        self.indices = numpy.argsort(targetToReference, kind='mergesort')
+        self.indptr = numpy.zeros(len(referencePoints) + 1, numpy.int64)
+        self.indptr[1:] = numpy.cumsum(numpy.bincount(targetToReference, minlength=len(referencePoints)))
+
+    def mapIndex(self, referenceIndex):
+        """ Target vertex of the reference vertex referenceIndex. """
+        if referenceIndex < 0:
+            return -1
+        return int(self.referenceToTarget[referenceIndex])
+
+    def mapROI(self, referenceIds):
+        """ Target vertices of the ROI made of the referenceIds vertices. """
+        referenceIds = numpy.asarray(referenceIds, numpy.int64)
+        return sortedUnique(numpy.concatenate([self.referenceToTarget[referenceIds],
+                                               gatherNeighbors(self.indptr, self.indices, referenceIds)]))
+
+
+class DecimatedProxy(object):
+    """ Coarse copy of a mesh, with about fraction of its vertices, to preview
+    ROIs while a landmark is dragged. The preview ROI is grown on the proxy
+    and mapped back on the full mesh through a VertexCorrespondence, so its
+    cost barely depends on the size of the full mesh.
+
+    The proxy is built by vtkQuadricClustering, which is one pass over the
+    mesh where vtkQuadricDecimation takes tens of seconds on large meshes.
+    Radii in edges are converted to mm with the length of the full mesh edges
+    around the landmark, given the adjacency of the full mesh, or their
+    estimated mean length otherwise.
+    """
+    def __init__(self, polyData, fraction=0.1, adjacency=None):
+        numberOfPoints = polyData.GetNumberOfPoints()
+        # A cluster of a surface mesh holds about 4 vertices per division squared
+        divisions = max(8, int(math.sqrt(fraction * numberOfPoints / 4.0)))
+        clustering = vtk.vtkQuadricClustering()
+        clustering.SetInputData(polyData)
+        clustering.SetNumberOfDivisions(divisions, divisions, divisions)
+        clustering.Update()
+        self.polyData = clustering.GetOutput()
+        self.points, cellArrays = polyDataToNumpy(self.polyData)
+        self.adjacency = buildVertexAdjacency(len(self.points), cellArrays)
+        self.edgeLengths = buildEdgeLengths(self.points, self.adjacency[0], self.adjacency[1])
+        fullPoints = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        self.correspondence = VertexCorrespondence(self.points, fullPoints)
+        if adjacency is not None:
+            # Mean length of the full mesh edges of the vertex closest to each proxy vertex
+            indptr, indices = adjacency[0], adjacency[1]
+            vertices = self.correspondence.referenceToTarget
+            counts = indptr[vertices + 1] - indptr[vertices]
+            lengths = numpy.linalg.norm(fullPoints[numpy.repeat(vertices, counts)]
+                                        - fullPoints[gatherNeighbors(indptr, indices, vertices)], axis=1)
+            groups = numpy.repeat(numpy.arange(len(vertices)), counts)
+            self.fullEdgeLengths = numpy.bincount(groups, lengths, len(vertices)) / numpy.maximum(counts, 1)
+        else:
+            # Edges of the full mesh are shorter by the square root of the vertex ratio
+            meanLength = float(self.edgeLengths.mean()) if self.edgeLengths.size else 0.0
+            self.fullEdgeLengths = numpy.full(len(self.points),
+                                              meanLength * math.sqrt(float(len(self.points)) / numberOfPoints))
+        self.locator = vtk.vtkStaticPointLocator()
+        self.locator.SetDataSet(self.polyData)
+        self.locator.BuildLocator()
+
+    def previewROI(self, position, radius, metric=ROI_DISTANCE_HOPS):
+        """ Returns the full mesh vertices of the ROI of the given radius
+        around the proxy vertex closest to position.
+        """
+        seed = self.locator.FindClosestPoint(position)
+        if seed < 0:
+            return numpy.zeros(0, numpy.int64)
+        if metric == ROI_DISTANCE_EUCLIDEAN:
+            ids = euclideanDistanceField(self.points, seed, radius)[0]
+        else:
+            if metric == ROI_DISTANCE_HOPS:
+                radius = roiThreshold(metric, radius) * self.fullEdgeLengths[seed]
+            ids = geodesicDistanceField(self.adjacency[0], self.adjacency[1], self.edgeLengths, seed, radius)[0]
+        return self.correspondence.mapROI(ids)
+
+
+class MeshGeometry(object):
+    """ What the ROIs of one mesh are computed on, from plain arrays: the
+    N x 3 points and the (offsets, connectivity) cell arrays, then lazily
+    the vertex adjacency and the distance graph of each metric. The logic
+    keeps one per model node, the command line tool and the worker
+    processes one per mesh they process.
+
+    A distance graph stays the same object until setPoints, so the distance
+    fields computed on it stay valid (see updateDistanceField). With a
+    MeshTopologyCache, the adjacency and geodesic edge lengths go through it,
+    keyed by the meshHash of the arrays.
+    """
+    def __init__(self, points, cellArrays, topologyCache=None):
+        self.points = points
+        # Only kept after the adjacency is built to hash moved points for the cache
+        self.cellArrays = cellArrays
+        self.topologyCache = topologyCache
+        self.key = None
+        self.adjacency = None
+        self.distanceGraphs = dict()  # Key = metric
+        self.locator = None
+
+    def getKey(self):
+        if self.key is None and self.topologyCache is not None:
+            self.key = meshHash(self.points, self.cellArrays)
+        return self.key
+
+    def getAdjacency(self):
+        """ CSR vertex adjacency (indptr, indices). """
+        if self.adjacency is None:
+            instrumentation.count('adjacencyBuilds')
+            self.adjacency = loadOrBuildVertexAdjacency(len(self.points), self.cellArrays, self.topologyCache,
+                                                        self.getKey())
+            if self.topologyCache is None:
+                self.cellArrays = None
+        return self.adjacency
+
+    def setPoints(self, points):
+        """ New positions of the same vertices: the adjacency is kept, the
+        distance graphs are built again when needed.
+        """
+        self.points = points
+        self.key = None
+        self.distanceGraphs.clear()
+        self.locator = None
+
+    def getDistanceGraph(self, metric):
+        """ What the distance fields of the metric are computed on, see distanceGraph. """
+        graph = self.distanceGraphs.get(metric)
+        if graph is None:
+            adjacency = self.getAdjacency()
+            key = self.getKey() if metric == ROI_DISTANCE_GEODESIC else None
+            graph = self.distanceGraphs[metric] = distanceGraph(metric, self.points, adjacency,
+                                                                self.topologyCache, key)
+        return graph
+
+    def fieldExtent(self, seed, field, radius, metric=ROI_DISTANCE_HOPS):
+        """ How far the distance field of a landmark snapped on seed has to
+        be computed for a ROI of the given radius, None when field is up to
+        date (see distanceFieldExtent).
+        """
+        return distanceFieldExtent(self.getDistanceGraph(metric), seed, field, roiThreshold(metric, radius))
+
+    def getMemorySize(self):
+        """ Bytes held by the arrays, the graphs and the point locator. """
+        return memorySize(self.points, self.cellArrays, self.adjacency, self.distanceGraphs) \
+            + (self.locator.getMemorySize() if self.locator is not None else 0)
+
+    def getLocator(self):
+        """ PointLocator of the points, built on the first query and kept until setPoints. """
+        if self.locator is None:
+            self.locator = PointLocator(self.points)
+        return self.locator
+
+    def closestVertices(self, positions):
+        """ Closest vertex of each of the M x 3 positions. """
+        return self.getLocator().query(positions)
+
+    def verticesWithinRadius(self, seed, radius):
+        """ Vertices at most radius (in mm) away from the vertex seed. """
+        return self.getLocator().queryRadius(self.points[seed], radius)
+
+    def neighborIds(self, seed, radius, metric=ROI_DISTANCE_HOPS, candidates=None):
+        """ Vertices of the ROI of the given radius around the vertex seed,
+        none for a landmark that is not snapped (seed < 0).
+        """
+        if seed < 0:
+            return numpy.zeros(0, numpy.int64)
+        return roiNeighborhood(metric, self.getDistanceGraph(metric), seed, radius, candidates)
+
+    def landmarkROI(self, seed, field, radius, metric=ROI_DISTANCE_HOPS, candidates=None):
+        """ Returns the distance field of a landmark snapped on seed, up to
+        date and reaching the radius, and the ids of its ROI thresholded in
+        the field.
+        """
+        threshold = roiThreshold(metric, radius)
+        field = updateDistanceField(self.getDistanceGraph(metric), seed, field, metric, candidates, threshold)
+        return field, field[2][field[3] <= threshold]
+
+    def landmarkROIs(self, indices, radii, metric=ROI_DISTANCE_HOPS):
+        """ ROI ids of landmarks snapped on the vertices indices. """
+        return [self.neighborIds(index, radius, metric) for index, radius in zip(indices, radii)]
+
+
+@timed
+def propagateLandmarksTask(meshPaths, positions, radii, metric=ROI_DISTANCE_HOPS, topologyCache=None):
+    """ Worker side of CohortPropagationEngine: snaps the landmarks on the
+    mesh stored in meshPaths and grows their ROIs with the metric. Returns
+    the closest point indices, the ids of each ROI and the time spent, in
+    seconds.
+    """
+    startTime = time.time()
+    points = numpy.load(meshPaths['points'], mmap_mode='r')
+    cellArrays = [(numpy.load(offsetsPath, mmap_mode='r'), numpy.load(connectivityPath, mmap_mode='r'))
+                  for offsetsPath, connectivityPath in meshPaths['cells']]
+    geometry = MeshGeometry(points, cellArrays, topologyCache)
+    closestIndices = geometry.closestVertices(positions)
+    rois = [ids.astype(numpy.int32) for ids in geometry.landmarkROIs(closestIndices, radii, metric)]
+    return closestIndices, rois, time.time() - startTime
+
+
+class CohortPropagationEngine(object):
+    """ Propagates landmark ROIs on many non-correspondent meshes in a
+    multiprocessing pool.
+
+    The points and cells of each mesh are written as .npy files in a working
+    directory and memory-mapped by the workers, so only file names, landmark
+    positions and the resulting ROI ids go through pickling. At most
+    maximumPending meshes are on disk at the same time: the caller submits
+    meshes while canSubmit() is True and collects results as they complete.
+    With a MeshTopologyCache, the workers load and store the adjacency and
+    edge lengths of the meshes in it.
+    """
+    def __init__(self, numberOfProcesses=None, maximumPending=None, topologyCache=None):
+        self.numberOfProcesses = numberOfProcesses or multiprocessing.cpu_count()
+        self.maximumPending = maximumPending or 2 * self.numberOfProcesses
+        self.topologyCache = topologyCache
+        self.workingDirectory = tempfile.mkdtemp(prefix='PickAndPaint_')
+        self.pool = multiprocessing.Pool(self.numberOfProcesses)
+        self.pending = dict()  # Key = AsyncResult, value = (key, meshPaths)
+        self.submittedCount = 0
+        self.cancelled = False
+
+    def canSubmit(self):
+        return not self.cancelled and len(self.pending) < self.maximumPending
+
+    def writeMesh(self, points, cellArrays):
+        directory = tempfile.mkdtemp(dir=self.workingDirectory)
+        meshPaths = {'directory': directory,
+                     'points': os.path.join(directory, 'points.npy'),
+                     'cells': list()}
+        numpy.save(meshPaths['points'], numpy.ascontiguousarray(points))
+        for i, (offsets, connectivity) in enumerate(cellArrays):
+            offsetsPath = os.path.join(directory, 'offsets%d.npy' % i)
+            connectivityPath = os.path.join(directory, 'connectivity%d.npy' % i)
+            numpy.save(offsetsPath, offsets)
+            numpy.save(connectivityPath, connectivity)
+            meshPaths['cells'].append((offsetsPath, connectivityPath))
+        return meshPaths
+
+    def submit(self, key, points, cellArrays, positions, radii, metric=ROI_DISTANCE_HOPS):
+        """ Queues the propagation of the landmarks (M x 3 positions and their
+        radii) on the mesh given by its N x 3 points and its cell arrays, as
+        (offsets, connectivity) pairs. key identifies the mesh in the results.
+        """
+        meshPaths = self.writeMesh(points, cellArrays)
+        arguments = (meshPaths, numpy.asarray(positions, numpy.float64), list(radii), metric, self.topologyCache)
+        task = self.pool.apply_async(propagateLandmarksTask, arguments)
+        self.pending[task] = (key, meshPaths)
+        self.submittedCount += 1
+
+    def collect(self, timeout=0.05):
+        """ Returns the (key, result, error) of the tasks that completed
+        within timeout seconds. result is (closestIndices, rois, seconds), or
+        None when the task failed and error holds the message.
+        """
+        if not self.pending:
+            return []
+        next(iter(self.pending)).wait(timeout)
+        results = list()
+        for task in [task for task in self.pending if task.ready()]:
+            key, meshPaths = self.pending.pop(task)
+            try:
+                result, error = task.get(), None
+            except Exception as exception:
+                result, error = None, str(exception) or exception.__class__.__name__
+            shutil.rmtree(meshPaths['directory'], ignore_errors=True)
+            results.append((key, result, error))
+        return results
+
+    def cancel(self):
+        """ Drops the pending tasks and stops the workers, running ones
+        included.
+        """
+        self.cancelled = True
+        self.pool.terminate()
+        self.pending.clear()
+
+    def shutdown(self):
+        """ Stops the workers. Tasks still pending, e.g. after an exception
+        in the caller, are dropped.
+        """
+        if self.pending:
+            self.cancel()
+        else:
+            self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.workingDirectory, ignore_errors=True)
+
+def memorySize(*values):
+    """ Returns the bytes held by the numpy arrays and VTK data objects in
+    values, which may be nested in tuples, lists, dictionaries and the
+    attributes of objects (e.g. a VertexCorrespondence). Objects reached
+    several times are counted once.
+    """
+    total = 0
+    seen = set()
+    stack = list(values)
+    while stack:
+        value = stack.pop()
+        if value is None or id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, numpy.ndarray):
+            total += value.nbytes
+        elif isinstance(value, (tuple, list)):
+            stack.extend(value)
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif hasattr(value, 'GetActualMemorySize'):  # vtkDataObject, vtkDataArray (in kibibytes)
+            total += 1024 * value.GetActualMemorySize()
+        elif hasattr(value, '__dict__') and not isinstance(value, vtk.vtkObjectBase):
+            stack.extend(vars(value).values())
+    return total
+
+
+def roiArrayName(storageMode, modelName, roiLabel, arrayName=None):
+    """ Name of the point data array holding the ROI of landmark roiLabel of
+    the model modelName: arrayName, or <model>_<label>_ROI without it, for
+    one array per landmark.
+    """
+    if storageMode == ROI_STORAGE_LABEL_MAP:
+        return modelName + "_ROI_Labels"
+    if storageMode == ROI_STORAGE_BITMASK:
+        return modelName + "_ROI_Bits"
+    return arrayName or modelName + '_' + str(roiLabel) + "_ROI"
+
+
+def roiMaskDtype(storageMode, roiLabel=1):
+    """ numpy type of a ROI array holding the landmark roiLabel. """
+    if storageMode == ROI_STORAGE_LABEL_MAP:
+        return numpy.uint16
+    if storageMode == ROI_STORAGE_BITMASK:
+        if not 0 < roiLabel <= 64:
+            raise ValueError("A bitmask holds at most 64 landmarks")
+        return numpy.uint32 if roiLabel <= 32 else numpy.uint64
+    return numpy.int8
+
+
+def writeROIMask(values, storageMode, roiLabel, ids, previousIds=None, otherROIs=None):
+    """ Writes the ROI ids of the landmark roiLabel in values, a ROI array
+    of the storage mode (0/1 array of the landmark, label map or bitmask).
+    With previousIds, the ROI written last time in values, only the vertices
+    entering or leaving the ROI are written. Returns False when nothing
+    changed.
+
+    In a label map, a vertex shared by several ROIs holds the label of the
+    landmark written last. otherROIs gives the (roiLabel, ids) of the other
+    landmarks of the label map: the vertices leaving the ROI get the label
+    of the last of them holding the vertex instead of 0, so their ROIs keep
+    no hole.
+    """
+    if storageMode == ROI_STORAGE_PER_LANDMARK:
+        def clear(removed):
+            values[removed if removed is not None else slice(None)] = 0
+
+        def paint(added):
+            values[added] = 1
+    elif storageMode == ROI_STORAGE_LABEL_MAP:
+        def clear(removed):
+            if removed is None:
+                cleared = numpy.flatnonzero(values == roiLabel)
+            else:
+                cleared = removed[values[removed] == roiLabel]
+            values[cleared] = 0
+            for otherLabel, otherIds in otherROIs or []:
+                if cleared.size == 0:
+                    break
+                values[numpy.intersect1d(cleared, otherIds)] = otherLabel
+
+        def paint(added):
+            values[added] = roiLabel
+    else:
+        bit = values.dtype.type(1) << values.dtype.type(roiLabel - 1)
+
+        def clear(removed):
+            if removed is None:
+                values[:] &= ~bit
+            else:
+                values[removed] &= ~bit
+
+        def paint(added):
+            values[added] |= bit
+
+    if previousIds is not None:
+        added, removed = roiDifference(previousIds, ids)
+        if added.size == 0 and removed.size == 0:
+            return False
+        clear(removed)
+        paint(added)
+    else:
+        clear(None)
+        paint(ids)
+    return True
+
+
+def roiSelection(values, storageMode, roiLabel):
+    """ 0/1 mask of the vertices of the landmark roiLabel in a ROI array. """
+    if storageMode == ROI_STORAGE_LABEL_MAP:
+        return values == roiLabel
+    if storageMode == ROI_STORAGE_BITMASK:
+        return (values >> values.dtype.type(roiLabel - 1)) & values.dtype.type(1)
+    return values != 0
+
+
+def buildROIArrays(numberOfPoints, rois, roiLabels, modelName, storageMode=ROI_STORAGE_PER_LANDMARK):
+    """ Returns the point data arrays holding the ROIs, as a list of (name,
+    numpy array) pairs named like the module does. rois are id arrays and
+    roiLabels the number of their landmark (1 for the first one).
+    """
+    if storageMode == ROI_STORAGE_PER_LANDMARK:
+        arrays = list()
+        for ids, roiLabel in zip(rois, roiLabels):
+            values = numpy.zeros(numberOfPoints, numpy.int8)
+            writeROIMask(values, storageMode, roiLabel, ids)
+            arrays.append((roiArrayName(storageMode, modelName, roiLabel), values))
+        return arrays
+    values = numpy.zeros(numberOfPoints, roiMaskDtype(storageMode, max(roiLabels)))
+    for ids, roiLabel in zip(rois, roiLabels):
+        writeROIMask(values, storageMode, roiLabel, ids)
+    return [(roiArrayName(storageMode, modelName, None), values)]
+
+
+def vertexAreas(points, cellArrays):
+    """ Returns the area of each vertex: a third of the area of the
+    polygons around it, polygons being split in fans of triangles. Strips
+    are not counted.
+    """
+    offsets, connectivity = cellArrays[2]
+    numberOfTriangles = numpy.maximum(numpy.diff(offsets) - 2, 0)
+    firsts = numpy.repeat(offsets[:-1], numberOfTriangles)
+    steps = numpy.arange(firsts.size) - numpy.repeat(numpy.cumsum(numberOfTriangles) - numberOfTriangles,
+                                                     numberOfTriangles)
+    corners = [connectivity[firsts], connectivity[firsts + steps + 1], connectivity[firsts + steps + 2]]
+    triangleAreas = 0.5 * numpy.linalg.norm(numpy.cross(points[corners[1]] - points[corners[0]],
+                                                        points[corners[2]] - points[corners[0]]), axis=1)
+    areas = numpy.zeros(len(points))
+    for corner in corners:
+        areas += numpy.bincount(corner, triangleAreas / 3.0, len(points))
+    return areas
+
+
+def distanceToReference(points, referencePoints, correspondent=True):
+    """ Returns the distance of each vertex to the same vertex of the
+    reference mesh, or to its closest reference vertex if the meshes are not
+    correspondent.
+    """
+    if not correspondent:
+        referencePoints = referencePoints[closestVertexMap(points, referencePoints)]
+    return numpy.linalg.norm(points - referencePoints, axis=1)
+
+
+def meshScalar(polyData, scalarName, referencePoints=None, correspondent=True):
+    """ Returns the values of a per-vertex scalar of the mesh: the point
+    data array scalarName, or DISTANCE_TO_REFERENCE, the distance to the
+    referencePoints mesh.
+    """
+    if scalarName == DISTANCE_TO_REFERENCE:
+        points = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())
+        return distanceToReference(points, referencePoints, correspondent)
+    array = polyData.GetPointData().GetArray(scalarName)
+    if array is None:
+        raise ValueError("No point data array named " + scalarName)
+    return numpy_support.vtk_to_numpy(array)
+
+
+@timed
+def roiStatistics(values, rois, areas=None, percentiles=STATISTICS_PERCENTILES):
+    """ Returns the statistics of a per-vertex scalar over each ROI, as
+    numpy columns with one value per ROI: vertices, area (when the vertex
+    areas are given), mean, std, min, p<percentile> and max. Vector values
+    are reduced to their norm. Empty ROIs get NaN.
+
+    The values of all the ROIs are gathered at once and the statistics are
+    computed per ROI with grouped numpy reductions, without a Python loop
+    over the ROIs.
+    """
+    values = numpy.asarray(values, numpy.float64)
+    if values.ndim == 2:
+        values = numpy.linalg.norm(values, axis=1)
+    numberOfROIs = len(rois)
+    counts = numpy.array([len(ids) for ids in rois], numpy.int64)
+    ids = numpy.concatenate([numpy.asarray(ids, numpy.int64) for ids in rois] + [numpy.zeros(0, numpy.int64)])
+    groups = numpy.repeat(numpy.arange(numberOfROIs), counts)
+    gathered = values[ids]
+    statistics = {'vertices': counts}
+    if areas is not None:
+        statistics['area'] = numpy.bincount(groups, areas[ids], numberOfROIs)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = numpy.bincount(groups, gathered, numberOfROIs) / counts
+        deviations = gathered - mean[groups]
+        statistics['mean'] = mean
+        statistics['std'] = numpy.sqrt(numpy.bincount(groups, deviations * deviations, numberOfROIs) / counts)
+    # Values sorted within each ROI: order statistics are read at offsets of the ROI start
+    sortedValues = numpy.append(gathered[numpy.lexsort((gathered, groups))], numpy.nan)
+    starts = numpy.cumsum(counts) - counts
+    empty = counts == 0
+    lasts = numpy.where(empty, sortedValues.size - 1, starts + counts - 1)
+    statistics['min'] = sortedValues[numpy.where(empty, sortedValues.size - 1, starts)]
+    statistics['max'] = sortedValues[lasts]
+    for percentile in percentiles:
+        position = starts + (counts - 1) * (percentile / 100.0)
+        below = numpy.where(empty, sortedValues.size - 1, numpy.floor(position).astype(numpy.int64))
+        above = numpy.minimum(below + 1, lasts)
+        weight = position - numpy.floor(position)
+        statistics['p%d' % percentile] = sortedValues[below] * (1.0 - weight) + sortedValues[above] * weight
+    return statistics
+
+
+class StatisticsWriter(object):
+    """ Writes ROI statistics as they are computed, one model at a time, so
+    that a whole cohort never has to be in memory: rows are appended to a
+    .csv file, or written as one row group per model to a .parquet file
+    (needs pyarrow).
+    """
+    def __init__(self, path, columns=STATISTICS_COLUMNS):
+        self.columns = columns
+        self.parquet = path.lower().endswith('.parquet')
+        if self.parquet and pyarrow is None:
+            raise ValueError("Writing .parquet files needs pyarrow")
+        self.path = path
+        self.parquetWriter = None
+        self.csvFile = None
+        if not self.parquet:
+            self.csvFile = open(path, 'wb') if sys.version_info[0] < 3 else open(path, 'w', newline='')
+            self.csvWriter = csv.writer(self.csvFile)
+            self.csvWriter.writerow(columns)
+
+    def write(self, modelName, landmarkLabels, scalarName, statistics):
+        """ Writes the rows of one model, statistics being the columns
+        returned by roiStatistics for the ROIs of the landmarks.
+        """
+        numberOfRows = len(landmarkLabels)
+        columns = dict(statistics)
+        columns['model'] = [modelName] * numberOfRows
+        columns['landmark'] = [str(label).strip() for label in landmarkLabels]
+        columns['scalar'] = [scalarName] * numberOfRows
+        columns = [columns[name] if name in columns else numpy.full(numberOfRows, numpy.nan)
+                   for name in self.columns]
+        if self.parquet:
+            table = pyarrow.Table.from_arrays([pyarrow.array(column) for column in columns], names=list(self.columns))
+            if self.parquetWriter is None:
+                self.parquetWriter = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self.parquetWriter.write_table(table)
+        else:
+            self.csvWriter.writerows(zip(*[list(column) for column in columns]))
+
+    def close(self):
+        if self.parquetWriter is not None:
+            self.parquetWriter.close()
+            self.parquetWriter = None
+        if self.csvFile is not None:
+            self.csvFile.close()
+            self.csvFile = None
+
+
+def columnProperty(name, cast):
+    def getValue(self):
+        return cast(self.table.columns[name][self.row])
+
+    def setValue(self, value):
+        self.table.columns[name][self.row] = value
+    return property(getValue, setValue)
+
+
+def objectColumnProperty(name):
+    def getValue(self):
+        return self.table.objectColumns[name][self.row]
+
+    def setValue(self, value):
+        self.table.objectColumns[name][self.row] = value
+    return property(getValue, setValue)
+
+
+def flagProperty(flag):
+    def getValue(self):
+        return bool(self.table.columns['flags'][self.row] & flag)
+
+    def setValue(self, value):
+        if value:
+            self.table.columns['flags'][self.row] |= flag
+        else:
+            self.table.columns['flags'][self.row] &= ~numpy.uint8(flag)
+    return property(getValue, setValue)
+
+
+class LandmarkTable(object):
+    """ State of the landmarks of one input, one row per landmark: numeric
+    fields in numpy columns (growing by doubling), the others in lists.
+    Works like the dictionary of landmark states it replaces: keyed by
+    markups ID, with LandmarkRow views as values. Bulk operations use the
+    columns directly, e.g. table.column('fiducialScale')[:] = scale.
+
+    Rows are removed by moving the last row in their place, so the order of
+    the rows is not the order of the markups.
+    """
+    FLAG_MOVE_ON_SURFACE = 1
+    FLAG_PROPAGATED = 2
+
+    NUMERIC_COLUMNS = (('fiducialScale', numpy.float64, 2.0),
+                       ('radiusROI', numpy.float64, 0.0),
+                       ('indexClosestPoint', numpy.int64, -1),
+                       ('roiLabel', numpy.int32, 0),  # Label/bit of the landmark in the compact ROI arrays
+                       ('flags', numpy.uint8, FLAG_MOVE_ON_SURFACE))
+    OBJECT_COLUMNS = ('fiducialLabel',
+                      'arrayName',
+                      'modelName',  # Name of the model the landmark was placed on
+                      'distanceField',  # (indexClosestPoint, graph, ids, distances, extent) of the last distance field
+                      'writtenROIs')  # ROI last written on each model: Key = ID of model node, value = (array, ids)
+
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.columns = dict((name, numpy.full(capacity, default, dtype))
+                            for name, dtype, default in self.NUMERIC_COLUMNS)
+        self.objectColumns = dict((name, list()) for name in self.OBJECT_COLUMNS)
+        self.ids = list()  # Markups ID of each row
+        self.views = list()  # LandmarkRow of each row
+        self.rowOfID = dict()
+
+    def column(self, name):
+        """ Numpy view on the used rows of a numeric column. """
+        return self.columns[name][:self.size]
+
+    def addRow(self, landmarkID):
+        """ Adds a landmark with default values and returns its LandmarkRow. """
+        if self.size == len(self.columns['flags']):
+            for name, dtype, default in self.NUMERIC_COLUMNS:
+                grown = numpy.full(2 * self.size, default, dtype)
+                grown[:self.size] = self.columns[name]
+                self.columns[name] = grown
+        for name in self.OBJECT_COLUMNS:
+            self.objectColumns[name].append(dict() if name == 'writtenROIs' else None)
+        view = LandmarkRow(self, self.size)
+        self.ids.append(landmarkID)
+        self.views.append(view)
+        self.rowOfID[landmarkID] = self.size
+        self.size += 1
+        return view
+
+    def remove(self, landmarkID):
+        row = self.rowOfID.pop(landmarkID)
+        last = self.size - 1
+        self.views[row].row = None  # Views of removed landmarks cannot be used anymore
+        if row != last:
+            for name, dtype, default in self.NUMERIC_COLUMNS:
+                self.columns[name][row] = self.columns[name][last]
+            for name in self.OBJECT_COLUMNS:
+                self.objectColumns[name][row] = self.objectColumns[name][last]
+            self.ids[row] = self.ids[last]
+            self.views[row] = self.views[last]
+            self.views[row].row = row
+            self.rowOfID[self.ids[row]] = row
+        for name, dtype, default in self.NUMERIC_COLUMNS:
+            self.columns[name][last] = default
+        for name in self.OBJECT_COLUMNS:
+            self.objectColumns[name].pop()
+        self.ids.pop()
+        self.views.pop()
+        self.size -= 1
+
+    def setFlag(self, flag, value, rows=slice(None)):
+        flags = self.column('flags')
+        if value:
+            flags[rows] |= flag
+        else:
+            flags[rows] &= ~numpy.uint8(flag)
+
+    def clear(self):
+        for landmarkID in list(self.ids):
+            self.remove(landmarkID)
+
+    # Dictionary interface
+    def __getitem__(self, landmarkID):
+        return self.views[self.rowOfID[landmarkID]]
+
+    def __delitem__(self, landmarkID):
+        self.remove(landmarkID)
+
+    def __contains__(self, landmarkID):
+        return landmarkID in self.rowOfID
+
+    def has_key(self, landmarkID):
+        return landmarkID in self.rowOfID
+
+    def get(self, landmarkID, default=None):
+        row = self.rowOfID.get(landmarkID)
+        return default if row is None else self.views[row]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def keys(self):
+        return list(self.ids)
+
+    def values(self):
+        return list(self.views)
+
+    def items(self):
+        return list(zip(self.ids, self.views))
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        return iter(list(self.views))
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+class LandmarkRow(object):
+    """ View on one row of a LandmarkTable, with the attributes of the
+    former landmark state objects.
+    """
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    fiducialScale = columnProperty('fiducialScale', float)
+    radiusROI = columnProperty('radiusROI', float)
+    indexClosestPoint = columnProperty('indexClosestPoint', int)
+    roiLabel = columnProperty('roiLabel', int)
+    mouvementSurfaceStatus = flagProperty(LandmarkTable.FLAG_MOVE_ON_SURFACE)
+    propagatedBool = flagProperty(LandmarkTable.FLAG_PROPAGATED)
+    fiducialLabel = objectColumnProperty('fiducialLabel')
+    arrayName = objectColumnProperty('arrayName')
+    modelName = objectColumnProperty('modelName')
+    distanceField = objectColumnProperty('distanceField')
+    writtenROIs = objectColumnProperty('writtenROIs')
+
+
+def packROI(ids, numberOfPoints):
+    """ Returns (encoding, data) for the ROI made of the ids vertices: the
+    ids as uint32, or one bit per vertex for large ROIs, whichever is smaller.
+    """
+    ids = numpy.asarray(ids)
+    if 4 * ids.size <= (numberOfPoints + 7) // 8:
+        return ROI_PACKED_IDS, numpy.sort(ids).astype(numpy.uint32)
+    mask = numpy.zeros(numberOfPoints, bool)
+    mask[ids] = True
+    return ROI_PACKED_BITS, numpy.packbits(mask)
+
+
+def unpackROI(encoding, data, numberOfPoints):
+    """ Returns the sorted int64 vertex ids of a ROI packed by packROI. """
+    if encoding == ROI_PACKED_IDS:
+        return data.astype(numpy.int64)
+    return numpy.flatnonzero(numpy.unpackbits(data)[:numberOfPoints])
+
+
+@timed
+def saveSession(path, inputs):
+    """ Writes the landmarks and ROIs of the inputs of a session to an
+    uncompressed .npz file. Each input is a dictionary of:
+
+        model            {'id', 'name', 'hash', 'numberOfPoints'} of the model
+                         the landmarks are placed on ('hash' is meshHash)
+        targets          the same for each model the ROIs were propagated on
+        propagationType  as in the module
+        landmarks        LandmarkTable of the landmarks
+        positions        N x 3 positions of the landmarks, in row order
+
+    The ROI last written on the model and on each target (writtenROIs) is
+    stored with packROI, so restoring a session does not grow any ROI.
+    Distance fields are not stored.
+    """
+    description = {'version': SESSION_VERSION, 'inputs': list()}
+    arrays = dict()
+    for inputIndex, sessionInput in enumerate(inputs):
+        table = sessionInput['landmarks']
+        models = [sessionInput['model']] + list(sessionInput['targets'])
+        description['inputs'].append({'model': sessionInput['model'],
+                                      'targets': list(sessionInput['targets']),
+                                      'propagationType': sessionInput['propagationType'],
+                                      'ids': list(table.ids),
+                                      'fiducialLabels': table.objectColumns['fiducialLabel'],
+                                      'arrayNames': table.objectColumns['arrayName'],
+                                      'modelNames': table.objectColumns['modelName']})
+        prefix = 'input%d_' % inputIndex
+        for name, dtype, default in table.NUMERIC_COLUMNS:
+            arrays[prefix + name] = table.column(name)
+        arrays[prefix + 'positions'] = numpy.asarray(sessionInput['positions'], numpy.float64).reshape(-1, 3)
+        # All the ROIs of the input in two buffers, indexed by
+        # (row, model index, encoding, offset, length) rows
+        index, packedIds, packedBits = list(), list(), list()
+        offsets = [0, 0]
+        for row, writtenROIs in enumerate(table.objectColumns['writtenROIs']):
+            for modelIndex, model in enumerate(models):
+                written = writtenROIs.get(model['id'])
+                if written is None:
+                    continue
+                encoding, data = packROI(written[1], model['numberOfPoints'])
+                (packedIds if encoding == ROI_PACKED_IDS else packedBits).append(data)
+                index.append((row, modelIndex, encoding, offsets[encoding], data.size))
+                offsets[encoding] += data.size
+        arrays[prefix + 'roiIndex'] = numpy.array(index, numpy.int64).reshape(-1, 5)
+        arrays[prefix + 'roiIds'] = numpy.concatenate(packedIds) if packedIds else numpy.zeros(0, numpy.uint32)
+        arrays[prefix + 'roiBits'] = numpy.concatenate(packedBits) if packedBits else numpy.zeros(0, numpy.uint8)
+    arrays['session'] = numpy.frombuffer(json.dumps(description).encode('utf-8'), numpy.uint8)
+    with open(path, 'wb') as sessionFile:
+        numpy.savez(sessionFile, **arrays)
+
+
+@timed
+def loadSession(path):
+    """ Reads a file written by saveSession. Returns the inputs as
+    dictionaries of model, targets and propagationType like saveSession
+    takes them, and of:
+
+        ids, fiducialLabels, arrayNames, modelNames   one value per landmark
+        columns    numeric columns of the LandmarkTable, by name
+        positions  N x 3 positions of the landmarks
+        rois       Key = (landmark row, model index), value = vertex ids, the
+                   model index being 0 for the model and i for targets[i - 1]
+    """
+    with numpy.load(path, allow_pickle=False) as content:
+        description = json.loads(content['session'].tobytes().decode('utf-8'))
+        if description.get('version') != SESSION_VERSION:
+            raise ValueError("Unsupported session version: %s" % description.get('version'))
+        inputs = list()
+        for inputIndex, sessionInput in enumerate(description['inputs']):
+            prefix = 'input%d_' % inputIndex
+            sessionInput['columns'] = dict((name, content[prefix + name])
+                                           for name, dtype, default in LandmarkTable.NUMERIC_COLUMNS)
+            sessionInput['positions'] = content[prefix + 'positions']
+            models = [sessionInput['model']] + sessionInput['targets']
+            buffers = (content[prefix + 'roiIds'], content[prefix + 'roiBits'])
+            rois = dict()
+            for row, modelIndex, encoding, offset, length in content[prefix + 'roiIndex'].tolist():
+                rois[(row, modelIndex)] = unpackROI(encoding, buffers[encoding][offset:offset + length],
+                                                    models[modelIndex]['numberOfPoints'])
+            sessionInput['rois'] = rois
+            inputs.append(sessionInput)
+    return inputs
@@ -0,0 +1,231 @@
+""" Timing instrumentation of Pick 'n Paint: spans around callbacks and
+logic stages, per stage latency histograms, counters and an optional
+Chrome trace (chrome://tracing, Perfetto) export.
+
+    from PickAndPaintInstrumentation import instrumentation, timed
+
+    @timed
+    def getNeighborIds(self, ...):
+        ...
+
+    with instrumentation.span('snapLandmarks'):
+        ...
+
+    instrumentation.count('locatorBuilds')
+    instrumentation.record('propagateLandmarksTask', secondsInWorker)
+
+Disabled (the default), a timed function costs one attribute test and
+count() returns at once. Nothing here imports slicer or qt.
+"""
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# Histogram buckets: HISTOGRAM_BUCKETS_PER_OCTAVE per doubling of the
+# duration, from 1 microsecond to about 1000 seconds
+HISTOGRAM_BUCKETS_PER_OCTAVE = 4
+HISTOGRAM_SIZE = 30 * HISTOGRAM_BUCKETS_PER_OCTAVE
+
+
+class StageStatistics(object):
+    """ Count, total, maximum and log-scale histogram of the durations of a stage. """
+    __slots__ = ('count', 'total', 'maximum', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.histogram = [0] * HISTOGRAM_SIZE
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+        bucket = 0
+        if duration > 1e-6:
+            bucket = min(HISTOGRAM_SIZE - 1, int(math.log(duration * 1e6, 2) * HISTOGRAM_BUCKETS_PER_OCTAVE))
+        self.histogram[bucket] += 1
+
+    def percentile(self, fraction):
+        """ Upper bound of the bucket holding the given fraction of the durations, in seconds. """
+        target = fraction * self.count
+        cumulated = 0
+        for bucket, count in enumerate(self.histogram):
+            cumulated += count
+            if count and cumulated >= target:
+                return min(self.maximum, 1e-6 * 2 ** (float(bucket + 1) / HISTOGRAM_BUCKETS_PER_OCTAVE))
+        return self.maximum
+
+
+class NullSpan(object):
+    """ Span returned while the instrumentation is disabled. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.startTime = 0.0
+
+    def __enter__(self):
+        self.startTime = clock()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.instrumentation.addSpan(self.name, self.startTime, clock() - self.startTime)
+        return False
+
+
+class Instrumentation(object):
+    """ Collects the spans and counters of the module. Spans are only timed
+    while enabled, trace events are only kept while traceEnabled, at most
+    maximumTraceEvents of them.
+    """
+    def __init__(self, maximumTraceEvents=1000000):
+        self.enabled = False
+        self.traceEnabled = False
+        self.maximumTraceEvents = maximumTraceEvents
+        self.lock = threading.Lock()
+        self.origin = clock()
+        self.stages = dict()  # Key = stage name, value = StageStatistics
+        self.counters = dict()
+        self.traceEvents = list()
+        self.droppedTraceEvents = 0
+
+    def enable(self, enabled=True, trace=False):
+        self.enabled = enabled
+        self.traceEnabled = enabled and trace
+
+    def span(self, name):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def addSpan(self, name, startTime, duration):
+        with self.lock:
+            statistics = self.stages.get(name)
+            if statistics is None:
+                statistics = self.stages[name] = StageStatistics()
+            statistics.add(duration)
+            if self.traceEnabled:
+                self.addTraceEvent({'name': name, 'ph': 'X',
+                                    'ts': 1e6 * (startTime - self.origin), 'dur': 1e6 * duration})
+
+    def record(self, name, duration):
+        """ Adds a span of duration seconds ending now, measured elsewhere
+        (e.g. in a worker process).
+        """
+        if not self.enabled:
+            return
+        self.addSpan(name, clock() - duration, duration)
+
+    def count(self, name, increment=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            value = self.counters[name] = self.counters.get(name, 0) + increment
+            if self.traceEnabled:
+                self.addTraceEvent({'name': name, 'ph': 'C',
+                                    'ts': 1e6 * (clock() - self.origin), 'args': {name: value}})
+
+    def addTraceEvent(self, event):
+        if len(self.traceEvents) >= self.maximumTraceEvents:
+            self.droppedTraceEvents += 1
+            return
+        event['pid'] = os.getpid()
+        event['tid'] = threading.current_thread().ident
+        event['cat'] = 'PickAndPaint'
+        self.traceEvents.append(event)
+
+    def reset(self):
+        with self.lock:
+            self.origin = clock()
+            self.stages.clear()
+            self.counters.clear()
+            del self.traceEvents[:]
+            self.droppedTraceEvents = 0
+
+    def getStatistics(self):
+        """ Returns {stage: {count, total, mean, p50, p90, p99, max}} in
+        seconds, and the counters.
+        """
+        with self.lock:
+            stages = dict()
+            for name, statistics in self.stages.items():
+                stages[name] = {'count': statistics.count,
+                                'total': statistics.total,
+                                'mean': statistics.total / statistics.count,
+                                'p50': statistics.percentile(0.5),
+                                'p90': statistics.percentile(0.9),
+                                'p99': statistics.percentile(0.99),
+                                'max': statistics.maximum}
+            return {'stages': stages, 'counters': dict(self.counters)}
+
+    def report(self):
+        """ Returns the statistics as a text table, slowest stages first. """
+        statistics = self.getStatistics()
+        lines = ["%-40s %8s %10s %10s %10s %10s" % ('stage', 'count', 'mean ms', 'p90 ms', 'max ms', 'total ms')]
+        for name, stage in sorted(statistics['stages'].items(), key=lambda item: -item[1]['total']):
+            lines.append("%-40s %8d %10.3f %10.3f %10.3f %10.1f" % (name, stage['count'], 1e3 * stage['mean'],
+                                                                    1e3 * stage['p90'], 1e3 * stage['max'],
+                                                                    1e3 * stage['total']))
+        for name, value in sorted(statistics['counters'].items()):
+            lines.append("%-40s %8d" % (name, value))
+        return "\n".join(lines)
+
+    def exportTrace(self, path):
+        """ Writes the trace events to path in the Chrome trace JSON format. """
+        with self.lock:
+            trace = {'traceEvents': list(self.traceEvents),
+                     'displayTimeUnit': 'ms',
+                     'otherData': {'droppedEvents': self.droppedTraceEvents}}
+        with open(path, 'w') as traceFile:
+            json.dump(trace, traceFile)
+
+
+# Instrumentation shared by the whole module
+instrumentation = Instrumentation()
+
+
+def timed(function):
+    """ Decorator recording each call of function as a span named after it. """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not instrumentation.enabled:
+            return function(*args, **kwargs)
+        startTime = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            instrumentation.addSpan(name, startTime, clock() - startTime)
+    return wrapper
+
+
+def timedSlot(function):
+    """ timed, for methods connected to Qt signals. PythonQt only passes as
+    many signal arguments as a slot declares, which it cannot tell through
+    a wrapper taking *args, so the wrapper drops the extra arguments itself.
+    """
+    code = getattr(function, '__code__', None) or function.func_code
+    numberOfArguments = code.co_argcount
+    wrapper = timed(function)
+
+    @functools.wraps(function)
+    def slot(*args):
+        return wrapper(*args[:numberOfArguments])
+    return slot
@@ -0,0 +1,270 @@
+""" Tests of the Slicer-free mesh computations of PickAndPaintCore.
+
+    python -m pytest Testing
+"""
+import math
+
+import numpy
+import pytest
+import vtk
+
+from PickAndPaintCore import ROI_DISTANCE_HOPS, ROI_DISTANCE_GEODESIC, ROI_DISTANCE_EUCLIDEAN, \
+    ROI_STORAGE_PER_LANDMARK, ROI_STORAGE_LABEL_MAP, ROI_STORAGE_BITMASK, ROI_PACKED_IDS, ROI_PACKED_BITS, \
+    polyDataToNumpy, buildVertexAdjacency, MeshGeometry, roiMaskDtype, writeROIMask, roiSelection, \
+    buildROIArrays, packROI, unpackROI, LandmarkTable, saveSession, loadSession, roiStatistics
+
+GRID_SIZE = 4
+
+
+def gridMesh():
+    """ 4 x 4 grid of unit spacing in the z = 0 plane, vertex i + 4 j at
+    (i, j), each square split in two triangles along its (i, j) - (i + 1,
+    j + 1) diagonal. Returns the points and the cell arrays.
+    """
+    points = numpy.array([(i, j, 0.0) for j in range(GRID_SIZE) for i in range(GRID_SIZE)])
+    triangles = list()
+    for j in range(GRID_SIZE - 1):
+        for i in range(GRID_SIZE - 1):
+            a, b, c, d = i + GRID_SIZE * j, i + 1 + GRID_SIZE * j, i + 1 + GRID_SIZE * (j + 1), i + GRID_SIZE * (j + 1)
+            triangles.extend([(a, b, c), (a, c, d)])
+    empty = (numpy.zeros(1, numpy.int64), numpy.zeros(0, numpy.int64))
+    polys = (numpy.arange(0, 3 * len(triangles) + 1, 3, dtype=numpy.int64),
+             numpy.array(triangles, numpy.int64).ravel())
+    return points, [empty, empty, polys, empty]
+
+
+def neighbors(adjacency, vertex):
+    indptr, indices = adjacency
+    return set(indices[indptr[vertex]:indptr[vertex + 1]].tolist())
+
+
+def test_adjacency_shares_cells():
+    points, cellArrays = gridMesh()
+    adjacency = buildVertexAdjacency(len(points), cellArrays)
+    assert len(adjacency[0]) == len(points) + 1
+    assert neighbors(adjacency, 0) == set([1, 4, 5])
+    assert neighbors(adjacency, 5) == set([0, 1, 4, 6, 9, 10])
+    assert neighbors(adjacency, 15) == set([10, 11, 14])
+    # Symmetric, without self loops
+    for vertex in range(len(points)):
+        assert vertex not in neighbors(adjacency, vertex)
+        for neighbor in neighbors(adjacency, vertex):
+            assert vertex in neighbors(adjacency, neighbor)
+
+
+def test_polydata_arrays():
+    source = vtk.vtkSphereSource()
+    source.Update()
+    polyData = source.GetOutput()
+    points, cellArrays = polyDataToNumpy(polyData)
+    assert points.shape == (polyData.GetNumberOfPoints(), 3)
+    offsets, connectivity = cellArrays[2]
+    assert len(offsets) == polyData.GetNumberOfPolys() + 1
+    idList = vtk.vtkIdList()
+    polyData.GetCellPoints(0, idList)
+    assert connectivity[offsets[0]:offsets[1]].tolist() == [idList.GetId(i) for i in range(idList.GetNumberOfIds())]
+
+
+@pytest.mark.parametrize('metric, seed, radius, expected', [
+    (ROI_DISTANCE_HOPS, 5, 1, [0, 1, 4, 5, 6, 9, 10]),
+    (ROI_DISTANCE_HOPS, 5, 0.5, [0, 1, 4, 5, 6, 9, 10]),  # The ring of direct neighbors is always in
+    (ROI_DISTANCE_HOPS, 0, 2, [0, 1, 2, 4, 5, 6, 8, 9, 10]),
+    (ROI_DISTANCE_GEODESIC, 0, 1.0, [0, 1, 4]),
+    (ROI_DISTANCE_GEODESIC, 0, 1.5, [0, 1, 4, 5]),
+    (ROI_DISTANCE_GEODESIC, 0, 2.0, [0, 1, 2, 4, 5, 8]),
+    (ROI_DISTANCE_GEODESIC, 0, 1.0 + math.sqrt(2.0), [0, 1, 2, 4, 5, 6, 8, 9]),
+    (ROI_DISTANCE_EUCLIDEAN, 0, 1.5, [0, 1, 4, 5]),
+    (ROI_DISTANCE_EUCLIDEAN, 0, 2.3, [0, 1, 2, 4, 5, 6, 8, 9]),
+])
+def test_neighborhoods(metric, seed, radius, expected):
+    geometry = MeshGeometry(*gridMesh())
+    ids = geometry.neighborIds(seed, radius, metric)
+    assert ids[0] == seed
+    assert sorted(ids.tolist()) == expected
+    field, ids = geometry.landmarkROI(seed, None, radius, metric)
+    assert sorted(ids.tolist()) == expected
+
+
+@pytest.mark.parametrize('metric', [ROI_DISTANCE_HOPS, ROI_DISTANCE_GEODESIC, ROI_DISTANCE_EUCLIDEAN])
+def test_landmark_field_grows_with_radius(metric):
+    geometry = MeshGeometry(*gridMesh())
+    field, ids = geometry.landmarkROI(0, None, 1, metric)
+    assert geometry.fieldExtent(0, field, 1, metric) is None
+    assert geometry.fieldExtent(0, field, 3, metric) is not None
+    field, ids = geometry.landmarkROI(0, field, 3, metric)
+    assert sorted(ids.tolist()) == sorted(geometry.neighborIds(0, 3, metric).tolist())
+    # A smaller radius is thresholded in the same field
+    assert geometry.landmarkROI(0, field, 1, metric)[0] is field
+
+
+def test_moved_points_rebuild_distance_graphs():
+    points, cellArrays = gridMesh()
+    geometry = MeshGeometry(points, cellArrays)
+    adjacency = geometry.getAdjacency()
+    field, ids = geometry.landmarkROI(0, None, 1.0, ROI_DISTANCE_GEODESIC)
+    geometry.setPoints(points * 2.0)
+    assert geometry.getAdjacency() is adjacency
+    assert geometry.fieldExtent(0, field, 1.0, ROI_DISTANCE_GEODESIC) is not None
+    assert geometry.neighborIds(0, 1.0, ROI_DISTANCE_GEODESIC).tolist() == [0]
+
+
+def test_closest_vertices():
+    geometry = MeshGeometry(*gridMesh())
+    positions = numpy.array([(0.1, -0.2, 0.3), (2.6, 1.4, 0.0), (10.0, 10.0, 0.0)])
+    assert geometry.closestVertices(positions).tolist() == [0, 7, 15]
+    assert geometry.closestVertices([1.0, 1.0, 0.0]).tolist() == [5]
+
+
+def test_vertices_within_radius():
+    points, cellArrays = gridMesh()
+    geometry = MeshGeometry(points, cellArrays)
+    assert geometry.verticesWithinRadius(5, 1.0).tolist() == [1, 4, 5, 6, 9]
+    assert geometry.verticesWithinRadius(0, 1.5).tolist() == [0, 1, 4, 5]
+    geometry.setPoints(points * 2.0)
+    assert geometry.verticesWithinRadius(5, 1.0).tolist() == [5]
+
+
+def test_unsnapped_landmark_has_no_roi():
+    geometry = MeshGeometry(*gridMesh())
+    assert geometry.neighborIds(-1, 3).size == 0
+
+
+@pytest.mark.parametrize('storageMode', [ROI_STORAGE_PER_LANDMARK, ROI_STORAGE_LABEL_MAP, ROI_STORAGE_BITMASK])
+def test_incremental_writes_match_full_writes(storageMode):
+    random = numpy.random.RandomState(0)
+    incremental = numpy.zeros(100, roiMaskDtype(storageMode, 3))
+    full = incremental.copy()
+    previousIds = None
+    for step in range(5):
+        ids = numpy.unique(random.randint(0, 100, 20))
+        writeROIMask(incremental, storageMode, 3, ids, previousIds)
+        writeROIMask(full, storageMode, 3, ids)
+        assert (incremental == full).all()
+        assert numpy.flatnonzero(roiSelection(incremental, storageMode, 3)).tolist() == ids.tolist()
+        previousIds = ids
+    assert not writeROIMask(incremental, storageMode, 3, previousIds, previousIds)
+
+
+def test_label_map_writes():
+    values = numpy.zeros(6, roiMaskDtype(ROI_STORAGE_LABEL_MAP))
+    assert values.dtype == numpy.uint16
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 2, numpy.array([0, 1]))
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 5, numpy.array([3, 4]))
+    assert values.tolist() == [2, 2, 0, 5, 5, 0]
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 2, numpy.array([1, 2]), numpy.array([0, 1]))
+    assert values.tolist() == [0, 2, 2, 5, 5, 0]
+    assert roiSelection(values, ROI_STORAGE_LABEL_MAP, 5).tolist() == [False, False, False, True, True, False]
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_label_map_keeps_overlapped_rois(incremental):
+    values = numpy.zeros(6, roiMaskDtype(ROI_STORAGE_LABEL_MAP))
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 1, numpy.array([0, 1, 2]))
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 2, numpy.array([2, 3]))
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 3, numpy.array([1, 2, 4]))
+    assert values.tolist() == [1, 3, 3, 2, 3, 0]
+    # Landmark 3 moves away: its vertices go back to the landmarks still holding them
+    otherROIs = [(1, numpy.array([0, 1, 2])), (2, numpy.array([2, 3]))]
+    previousIds = numpy.array([1, 2, 4]) if incremental else None
+    writeROIMask(values, ROI_STORAGE_LABEL_MAP, 3, numpy.array([5]), previousIds, otherROIs)
+    assert values.tolist() == [1, 1, 2, 2, 0, 3]
+
+
+def test_bitmask_writes():
+    values = numpy.zeros(4, roiMaskDtype(ROI_STORAGE_BITMASK, 32))
+    assert values.dtype == numpy.uint32
+    writeROIMask(values, ROI_STORAGE_BITMASK, 1, numpy.array([0, 1]))
+    writeROIMask(values, ROI_STORAGE_BITMASK, 32, numpy.array([1, 2]))
+    assert values.tolist() == [1, 1 + 2 ** 31, 2 ** 31, 0]
+    writeROIMask(values, ROI_STORAGE_BITMASK, 1, numpy.array([3]), numpy.array([0, 1]))
+    assert values.tolist() == [0, 2 ** 31, 2 ** 31, 1]
+
+
+def test_bitmask_widens_to_uint64():
+    assert roiMaskDtype(ROI_STORAGE_BITMASK, 33) == numpy.uint64
+    assert roiMaskDtype(ROI_STORAGE_BITMASK, 64) == numpy.uint64
+    with pytest.raises(ValueError):
+        roiMaskDtype(ROI_STORAGE_BITMASK, 65)
+    arrays = buildROIArrays(4, [numpy.array([0]), numpy.array([0, 3])], [1, 64], 'Model', ROI_STORAGE_BITMASK)
+    assert len(arrays) == 1
+    name, values = arrays[0]
+    assert name == 'Model_ROI_Bits'
+    assert values.dtype == numpy.uint64
+    assert values.tolist() == [1 + 2 ** 63, 0, 0, 2 ** 63]
+    assert roiSelection(values, ROI_STORAGE_BITMASK, 64).tolist() == [1, 0, 0, 1]
+    with pytest.raises(ValueError):
+        buildROIArrays(4, [numpy.array([0])], [65], 'Model', ROI_STORAGE_BITMASK)
+
+
+def test_per_landmark_arrays():
+    arrays = buildROIArrays(3, [numpy.array([0]), numpy.array([1, 2])], [1, 2], 'Model')
+    assert [name for name, values in arrays] == ['Model_1_ROI', 'Model_2_ROI']
+    assert [values.tolist() for name, values in arrays] == [[1, 0, 0], [0, 1, 1]]
+
+
+@pytest.mark.parametrize('ids, encoding', [
+    ([7, 3, 900], ROI_PACKED_IDS),
+    (list(range(0, 1000, 2)), ROI_PACKED_BITS),
+    ([], ROI_PACKED_IDS),
+])
+def test_pack_roi_round_trip(ids, encoding):
+    packedEncoding, data = packROI(numpy.array(ids, numpy.int64), 1000)
+    assert packedEncoding == encoding
+    unpacked = unpackROI(packedEncoding, data, 1000)
+    assert unpacked.dtype == numpy.int64
+    assert unpacked.tolist() == sorted(ids)
+
+
+def test_session_round_trip(tmp_path):
+    points, cellArrays = gridMesh()
+    landmarks = LandmarkTable()
+    for row, radius in enumerate([1.0, 2.5]):
+        landmark = landmarks.addRow('vtkMRMLMarkupsFiducialNode1_%d' % row)
+        landmark.fiducialLabel = '  %d' % (row + 1)
+        landmark.arrayName = 'Model_%d_ROI' % (row + 1)
+        landmark.modelName = 'Model'
+        landmark.roiLabel = row + 1
+        landmark.radiusROI = radius
+        landmark.indexClosestPoint = 5 * row
+        landmark.writtenROIs['vtkMRMLModelNode1'] = (None, numpy.array([5 * row, 1, 4]))
+    model = {'id': 'vtkMRMLModelNode1', 'name': 'Model', 'hash': 'abc', 'numberOfPoints': len(points)}
+    path = str(tmp_path / 'session.npz')
+    saveSession(path, [{'model': model, 'targets': [], 'propagationType': 1, 'landmarks': landmarks,
+                        'positions': points[[0, 5]]}])
+    sessionInput, = loadSession(path)
+    assert sessionInput['model'] == model
+    assert sessionInput['ids'] == landmarks.ids
+    assert sessionInput['fiducialLabels'] == ['  1', '  2']
+    assert sessionInput['columns']['radiusROI'].tolist() == [1.0, 2.5]
+    assert numpy.allclose(sessionInput['positions'], points[[0, 5]])
+    assert sessionInput['rois'][(0, 0)].tolist() == [0, 1, 4]
+    assert sessionInput['rois'][(1, 0)].tolist() == [1, 4, 5]
+
+
+def test_roi_statistics():
+    values = numpy.array([1.0, 2.0, 3.0, 4.0, 10.0])
+    areas = numpy.array([1.0, 1.0, 2.0, 2.0, 0.5])
+    statistics = roiStatistics(values, [numpy.array([3, 0, 2, 1]), numpy.array([4]), numpy.array([], numpy.int64)],
+                               areas, percentiles=(25, 50))
+    assert statistics['vertices'].tolist() == [4, 1, 0]
+    assert statistics['area'][:2].tolist() == [6.0, 0.5]
+    # 1, 2, 3, 4: mean 2.5, population std sqrt(1.25), p25 between 1 and 2 at 0.75
+    assert statistics['mean'][0] == pytest.approx(2.5)
+    assert statistics['std'][0] == pytest.approx(math.sqrt(1.25))
+    assert statistics['min'][0] == 1.0 and statistics['max'][0] == 4.0
+    assert statistics['p25'][0] == pytest.approx(1.75)
+    assert statistics['p50'][0] == pytest.approx(2.5)
+    # One vertex
+    for column in ['mean', 'min', 'max', 'p25', 'p50']:
+        assert statistics[column][1] == 10.0
+    assert statistics['std'][1] == 0.0
+    # Empty ROI
+    for column in ['mean', 'std', 'min', 'max', 'p25', 'p50']:
+        assert math.isnan(statistics[column][2])
+
+
+def test_roi_statistics_of_vectors():
+    values = numpy.array([[3.0, 4.0, 0.0], [0.0, 0.0, 1.0]])
+    statistics = roiStatistics(values, [numpy.array([0, 1])])
+    assert statistics['mean'][0] == pytest.approx(3.0)
+    assert 'area' not in statistics